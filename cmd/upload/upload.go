@@ -31,6 +31,8 @@ func main() {
 	var outputDirFn string
 	var inputDirHost string
 	var outputDirHost string
+	var storeDirFn string
+	var storeDirHost string
 	var threads int
 	var environment string
 	var timeout int
@@ -41,6 +43,8 @@ func main() {
 	flag.StringVar(&outputDirFn, "output-dir-fn", "", "internal output directory")
 	flag.StringVar(&inputDirHost, "input-dir-host", "", "host input directory")
 	flag.StringVar(&outputDirHost, "output-dir-host", "", "host output directory")
+	flag.StringVar(&storeDirFn, "store-dir-fn", "store", "internal acquisition store directory")
+	flag.StringVar(&storeDirHost, "store-dir-host", "", "host acquisition store directory (shared tmpfs), disabled if empty")
 	flag.IntVar(&threads, "threads", 2, "number of threads")
 	flag.StringVar(&environment, "env", "tflite", "environment")
 	flag.IntVar(&timeout, "timeout", 60, "timeout in seconds")
@@ -101,10 +105,11 @@ func main() {
 	// curl http://localhost:8080/upload --data "{\"name\": \"$2\", \"env\": \"$3\", \"threads\": $4, \"zip\": \"$(zip -r - ./* | base64 | tr -d '\n')\"}"
 
 	upload := struct {
-		Name    string `json:"name"`
-		Env     string `json:"env"`
-		Threads int    `json:"threads"`
-		Zip     string `json:"zip"`
+		Name    string   `json:"name"`
+		Env     string   `json:"env"`
+		Threads int      `json:"threads"`
+		Zip     string   `json:"zip"`
+		Envs    []string `json:"envs"`
 		Mounts  []struct {
 			Dir    string `json:"mount_dir"`
 			Target string `json:"mount_target"`
@@ -115,6 +120,7 @@ func main() {
 		Env:     environment,
 		Threads: threads,
 		Zip:     string(dst),
+		Envs:    []string{},
 		Mounts: []struct {
 			Dir    string `json:"mount_dir"`
 			Target string `json:"mount_target"`
@@ -133,6 +139,20 @@ func main() {
 		},
 	}
 
+	// share decoded acquisitions between all functions through a common store
+	if storeDirHost != "" {
+		upload.Mounts = append(upload.Mounts, struct {
+			Dir    string `json:"mount_dir"`
+			Target string `json:"mount_target"`
+			Rw     bool   `json:"mount_rw"`
+		}{
+			Dir:    storeDirHost,
+			Target: storeDirFn,
+			Rw:     true,
+		})
+		upload.Envs = append(upload.Envs, "TFAAS_STORE_DIR="+path.Join("/files", storeDirFn))
+	}
+
 	u, err := json.Marshal(upload)
 
 	if err != nil {
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
-import os
 import numpy as np
-import tflite_runtime.interpreter as tflite
-from PIL import Image
 import traceback
-import threading
 import typing
 
+import fnlib.bands
+import fnlib.encode
+import fnlib.model
+
 # Define class
 class_labels = [
     "AnnualCrop",
@@ -26,49 +26,35 @@ MODEL_TARGET_CLASS = "Industrial"
 MODEL_TARGET_SIZE = (64, 64)
 SAVE_SIZE = (256, 256)
 
-thread_local = threading.local()
-
 
-class model:
+class model(fnlib.model.model):
     def __init__(self):
         # Load the model
-        self.interpreter = tflite.Interpreter(model_path="class.tflite", num_threads=1)
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+        super().__init__("class.tflite")
 
     # Function to predict the class of an image
     def predict_image(self, img, class_labels):
         print(img.shape, img.dtype)
-        img_array = np.expand_dims(img, axis=0)  # Create a batch of 1
-        # convert from uint8 to np.float32
-        img_array = img_array.astype(np.float32) / 255.0
-        # img_array /= 255.0  # Rescale as during training
+        return self.predict_batch([img], class_labels)[0]
 
-        self.interpreter.set_tensor(self.input_details[0]["index"], img_array)
-        self.interpreter.invoke()
-        predictions = self.interpreter.get_tensor(self.output_details[0]["index"])
-        predicted_class = class_labels[np.argmax(predictions)]
+    # Function to predict the classes of a list of images in one invocation
+    def predict_batch(self, imgs, class_labels):
+        predictions = self.infer(imgs)
 
-        return predicted_class
+        return [class_labels[i] for i in np.argmax(predictions, axis=-1)]
 
 
-def load_image(img_path, bands, target_size):
-    imgs = []
+# a model for every thread
+models = fnlib.model.local(model)
 
-    for b in bands:
-        path = os.path.join(img_path, f"{b}.tiff")
 
-        # load image and resize it to target size
-        img = Image.open(path)
-        # img = img.convert("RGB")
-        img = img.resize(target_size)
-        img_array = np.array(img)
-        # print(f"band {b}: {img_array.shape}, {img_array.dtype}")
+# called by the runtime in every worker before it reports healthy
+def init() -> None:
+    models.init()
 
-        imgs.append(img_array)
 
-    return np.dstack(imgs)
+def load_model_input(scene):
+    return scene.load(["B04", "B03", "B02"], MODEL_TARGET_SIZE)
 
 
 def fn(
@@ -80,25 +66,28 @@ def fn(
     in_path: str,
     out_writer: typing.BinaryIO,
 ) -> None:
+    # decode every band once, for both the model input and the result
+    scene = fnlib.bands.scene(in_path)
+
     # load the image in image_path
     try:
-        img = load_image(in_path, ["B04", "B03", "B02"], MODEL_TARGET_SIZE)
+        img = load_model_input(scene)
     except Exception as e:
         print(f"failed to load image: {e}")
         traceback.print_exc()
         raise e
 
-    # check that there is a model local to this thread
-    if not hasattr(thread_local, "model"):
-        thread_local.model = model()
-
     try:
-        predicted_class = thread_local.model.predict_image(img, class_labels)
+        predicted_class = models.get().predict_image(img, class_labels)
     except Exception as e:
         print(f"inference failed: {e}")
         traceback.print_exc()
         raise e
 
+    save_result(predicted_class, scene, out_writer)
+
+
+def save_result(predicted_class, scene, out_writer):
     print(f"predicted: {predicted_class}")
 
     if not predicted_class == MODEL_TARGET_CLASS:
@@ -108,5 +97,16 @@ def fn(
     print("saving image")
     # https://amt.copernicus.org/articles/14/2771/2021/
     # adding bands 11 and 12 to monitor methane output
-    img = load_image(in_path, ["B02", "B03", "B04", "B11", "B12"], SAVE_SIZE)
-    np.save(out_writer, img)
+    img = scene.load(["B02", "B03", "B04", "B11", "B12"], SAVE_SIZE)
+    fnlib.encode.save(out_writer, img)
+
+
+def fn_batch(
+    requests: typing.List[typing.Dict[str, typing.Any]],
+) -> typing.List[typing.Optional[Exception]]:
+    return fnlib.model.batch(
+        requests,
+        lambda scene, r: load_model_input(scene),
+        lambda imgs: models.get().predict_batch(imgs, class_labels),
+        save_result,
+    )
@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 
-import os
 import numpy as np
-import tflite_runtime.interpreter as tflite
-from PIL import Image
 import traceback
-import threading
 import typing
 
+import fnlib.bands
+import fnlib.encode
+import fnlib.inference
+import fnlib.manifest
+import fnlib.model
+
 classes = [
     "Complex cultivation patterns",
     "Burnt areas",
@@ -66,61 +68,73 @@ target_classes = [
     "Fruit trees and berry plantations",
 ]
 
-thread_local = threading.local()
+# labels are boolean masks over classes, so deciding what to keep is one
+# operation for a whole batch
+CLASSES = np.array(classes)
+TARGET_MASK = np.isin(CLASSES, target_classes)
+
+# a class is predicted if its probability is above its threshold:
+# "threshold" in the "labels" section of the manifest sets it for all
+# classes, "thresholds" for single classes by name
+_labels = fnlib.manifest.get("labels")
+THRESHOLDS = np.full(len(classes), _labels.get("threshold", 0.5), dtype=np.float32)
+for name, threshold in _labels.get("thresholds", {}).items():
+    THRESHOLDS[classes.index(name)] = threshold
+
+# bands and size of every model input, see fn()
+MODEL_INPUTS = [
+    (["B01", "B09"], (20, 20)),
+    (["B05", "B06", "B07", "B8A", "B11", "B12"], (60, 60)),
+    (["B02", "B03", "B04", "B08"], (120, 120)),
+]
 
 
-class model:
+class model(fnlib.model.model):
     def __init__(self):
         # Load the model
-        self.interpreter = tflite.Interpreter(
-            model_path="multiclass.tflite", num_threads=1
-        )
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+        super().__init__("multiclass.tflite")
 
     # Function to predict the class of an image
     def predict_image(self, img_array):
-        # print(img.shape, img.dtype)
-        # img_array = np.expand_dims(img, axis=0)  # Create a batch of 1
-        # convert from uint8 to np.float32
-        # img_array = img_array.astype(np.float32) / 255.0
-        # img_array /= 255.0  # Rescale as during training
+        return self.predict_batch([img_array])[0]
 
-        # print(self.input_details)
+    # write a list of images into the three inputs of the model
+    def set_inputs(self, imgs):
+        # every image is a list of the three inputs
+        img_array = [[img[i] for img in imgs] for i in range(3)]
 
-        self.interpreter.set_tensor(self.input_details[0]["index"], img_array[2])
-        self.interpreter.set_tensor(self.input_details[1]["index"], img_array[0])
-        self.interpreter.set_tensor(self.input_details[2]["index"], img_array[1])
+        fnlib.inference.set_input(self.interpreter, self.input_details[0], img_array[2])
+        fnlib.inference.set_input(self.interpreter, self.input_details[1], img_array[0])
+        fnlib.inference.set_input(self.interpreter, self.input_details[2], img_array[1])
 
-        self.interpreter.invoke()
-        predictions = self.interpreter.get_tensor(self.output_details[0]["index"])
+    # Function to predict the labels of a list of images in one invocation
+    def predict_batch(self, imgs):
+        return self.infer(imgs) > THRESHOLDS
 
-        predicted_labels = (predictions > 0.5).astype(int)
 
-        predicted_classes = [
-            classes[i] for i, val in enumerate(predicted_labels[0]) if val == 1
-        ]
+# whether to save the results with these labels: if the model predicts no
+# class at all, or any of the target classes
+def should_save(labels):
+    return ~labels.any(axis=-1) | (labels & TARGET_MASK).any(axis=-1)
 
-        return predicted_classes
 
+# labels as a hex string of one bit per class, in the order of classes
+def bitset(labels):
+    return np.packbits(labels).tobytes().hex()
 
-def load_image(img_path, bands, target_size):
-    imgs = []
 
-    for b in bands:
-        path = os.path.join(img_path, f"{b}.tiff")
+def load_image(scene, bands, target_size):
+    img = scene.load(bands, target_size)
+    return np.expand_dims(np.divide(img, np.float32(255.0), dtype=np.float32), axis=0)
 
-        # load image and resize it to target size
-        img = Image.open(path)
-        # img = img.convert("RGB")
-        img = img.resize(target_size)
-        img_array = np.array(img)
-        # print(f"band {b}: {img_array.shape}, {img_array.dtype}")
 
-        imgs.append(img_array.astype(np.float32) / 255.0)
+# a model for every thread
+models = fnlib.model.local(model)
 
-    return np.expand_dims(np.squeeze(np.stack(imgs, axis=-1)), axis=0)
+
+# called by the runtime in every worker before it reports healthy
+def init() -> None:
+    models.init()
 
 
 def fn(
@@ -145,61 +159,39 @@ def fn(
     #     - Input 1: shape=(20, 20, 2) - 2 channels for B01, B09
     #     - Input 2: shape=(60, 60, 6) - 6 channels for B05, B06, B07, B8A, B11, B12
     #     - Input 3: shape=(120, 120, 4) - 4 channels for B02, B03, B04, B08
-    try:
-        img = [
-            load_image(
-                in_path,
-                [
-                    "B01",
-                    "B09",
-                ],
-                (20, 20),
-            ),
-            load_image(
-                in_path,
-                [
-                    "B05",
-                    "B06",
-                    "B07",
-                    "B8A",
-                    "B11",
-                    "B12",
-                ],
-                (60, 60),
-            ),
-            load_image(
-                in_path,
-                [
-                    "B02",
-                    "B03",
-                    "B04",
-                    "B08",
-                ],
-                (120, 120),
-            ),
-        ]
 
+    # decode every band once, for both the model input and the result
+    scene = fnlib.bands.scene(in_path)
+
+    try:
+        img = load_model_input(scene)
     except Exception as e:
         print(f"failed to load image: {e}")
         traceback.print_exc()
         raise e
 
-    # check that there is a model local to this thread
-    if not hasattr(thread_local, "model"):
-        thread_local.model = model()
-
     try:
-        predicted_classes = thread_local.model.predict_image(img)
+        labels = models.get().predict_image(img)
     except Exception as e:
         print(f"inference failed: {e}")
         traceback.print_exc()
         raise e
 
+    save_result((labels, should_save(labels)), scene, out_writer)
+
+
+# model inputs stay uint8 until they are written into the input tensors. all
+# three come from one pyramid, so every band is decoded and downscaled once.
+def load_model_input(scene):
+    return scene.pyramid(MODEL_INPUTS)
+
+
+def save_result(result, scene, out_writer):
+    labels, save = result
+    predicted_classes = CLASSES[labels].tolist()
     print(f"predicted classes: {predicted_classes}")
 
-    if not len(predicted_classes) == 0 and not any(
-        c in predicted_classes for c in target_classes
-    ):
+    if not save:
         print(
             f"skipping: {predicted_classes} does not contain any target classes {target_classes}"
         )
@@ -209,7 +201,7 @@ def fn(
     # https://www.mdpi.com/2073-4395/13/3/656
     # apparently Red Edge 3 (B07), NIR (B08), and SWIR 1 (B11) are the most important bands for soil moisture
     img = load_image(
-        in_path,
+        scene,
         [
             "B02",
             "B03",
@@ -220,4 +212,21 @@ def fn(
         ],
         (256, 256),
     )
-    np.save(out_writer, img)
+    fnlib.encode.save(out_writer, img, meta={"labels": bitset(labels)})
+
+
+# labels of a batch, with whether to save each
+def predict_batch(imgs):
+    labels = models.get().predict_batch(imgs)
+    return list(zip(labels, should_save(labels)))
+
+
+def fn_batch(
+    requests: typing.List[typing.Dict[str, typing.Any]],
+) -> typing.List[typing.Optional[Exception]]:
+    return fnlib.model.batch(
+        requests,
+        lambda scene, r: load_model_input(scene),
+        predict_batch,
+        save_result,
+    )
@@ -1,75 +1,87 @@
 #!/usr/bin/env python3
 
-import os
 import numpy as np
-import tflite_runtime.interpreter as tflite
-from PIL import Image
 import traceback
-import threading
 import typing
 
+import fnlib.bands
+import fnlib.encode
+import fnlib.geofence
+import fnlib.inference
+import fnlib.mask
+import fnlib.model
+import fnlib.tiles
 
 class_names = ["Building", "Land", "Road", "Vegetation", "Water", "Unlabeled"]
 
 MODEL_TARGET_SIZE = (512, 512)
+# (height, width) of an input that is not tiled
+MODEL_INPUT_SHAPE = MODEL_TARGET_SIZE[::-1]
 MODEL_TARGET_PROB = 0.8
 SAVE_SIZE = (256, 256)
 
-CHINA_BBOX = {
-    "min_lon": 72.59,
-    "min_lat": 17.14,
-    "max_lon": 136.05,
-    "max_lat": 54.97,
-}
+# the region we segment, the runtime skips acquisitions outside of it before
+# they reach us, see the prefilter in manifest.json
+CHINA = fnlib.geofence.load(["china.geojson"])
 
-thread_local = threading.local()
 
-
-class model:
+class model(fnlib.model.model):
     def __init__(self):
         # Load the model
-        self.interpreter = tflite.Interpreter(
-            model_path="segment.tflite", num_threads=1
-        )
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+        super().__init__("segment.tflite")
 
     # Function to predict the class of an image
     def predict_image(self, img):
         print(img.shape, img.dtype)
-        img_array = np.expand_dims(img, axis=0)  # Create a batch of 1
-        # convert from uint8 to np.float32
-        img_array = img_array.astype(np.float32) / 255.0
-        # img_array /= 255.0  # Rescale as during training
+        return self.predict_batch([img])[0]
+
+    # Function to predict an image of any size in overlapping tiles of the
+    # model input size, see fnlib.tiles
+    def predict_tiles(self, img):
+        return fnlib.tiles.run(img, MODEL_TARGET_SIZE, len(class_names), self.infer)
+
+    # Function to predict a list of images in one invocation
+    def predict_batch(self, imgs):
+        self.run(imgs)
+
+        # Get the predicted class for each pixel, as uint8 straight from the
+        # output tensor
+        return fnlib.inference.get_output_argmax(
+            self.interpreter, self.output_details[0]
+        )
+
 
-        self.interpreter.set_tensor(self.input_details[0]["index"], img_array)
-        self.interpreter.invoke()
-        predictions = self.interpreter.get_tensor(self.output_details[0]["index"])
+def in_china(lat, lon):
+    return CHINA.contains(lon, lat)
 
-        predicted_mask = np.argmax(predictions, axis=-1)[
-            0
-        ]  # Get the predicted class for each pixel
 
-        return predicted_mask
+# a model for every thread
+models = fnlib.model.local(model)
 
 
-def load_image(img_path, bands, target_size):
-    imgs = []
+# called by the runtime in every worker before it reports healthy
+def init() -> None:
+    models.init()
 
-    for b in bands:
-        path = os.path.join(img_path, f"{b}.tiff")
 
-        # load image and resize it to target size
-        img = Image.open(path)
-        # img = img.convert("RGB")
-        img = img.resize(target_size)
-        img_array = np.array(img)
-        # print(f"band {b}: {img_array.shape}, {img_array.dtype}")
+def native_size(scene):
+    height, width = scene.band("B04").shape
+    return width, height
 
-        imgs.append(img_array)
 
-    return np.dstack(imgs)
+# scenes larger than the model input are segmented in tiles at their native
+# resolution instead of being resized. their results are saved at SAVE_SIZE
+# like all others.
+def tiled(scene):
+    width, height = native_size(scene)
+    return fnlib.tiles.enabled((height, width), MODEL_TARGET_SIZE)
+
+
+def load_model_input(scene):
+    if tiled(scene):
+        return scene.load(["B04", "B03", "B02"], native_size(scene))
+
+    return scene.load(["B04", "B03", "B02"], MODEL_TARGET_SIZE)
 
 
 def fn(
@@ -82,52 +94,90 @@ def fn(
     out_writer: typing.BinaryIO,
 ) -> None:
     # if not in China, return
-    if not (
-        CHINA_BBOX["min_lon"] <= lon <= CHINA_BBOX["max_lon"]
-        and CHINA_BBOX["min_lat"] <= lat <= CHINA_BBOX["max_lat"]
-    ):
+    if not in_china(lat, lon):
         print("not in China")
         return
 
+    # decode every band once, for both the model input and the result
+    scene = fnlib.bands.scene(in_path)
+
     # load the image in image_path
     try:
-        img = load_image(in_path, ["B04", "B03", "B02"], MODEL_TARGET_SIZE)
+        img = load_model_input(scene)
     except Exception as e:
         print(f"failed to load image: {e}")
         traceback.print_exc()
         raise e
 
-    # check that there is a model local to this thread
-    if not hasattr(thread_local, "model"):
-        thread_local.model = model()
-
     try:
-        predicted_mask = thread_local.model.predict_image(img)
+        if tiled(scene):
+            predicted_mask = models.get().predict_tiles(img)
+        else:
+            predicted_mask = models.get().predict_image(img)
     except Exception as e:
         print(f"inference failed: {e}")
         traceback.print_exc()
         raise e
 
-    unique, counts = np.unique(predicted_mask, return_counts=True)
-    proportions = dict(zip(unique, counts))
+    save_result(predicted_mask, scene, out_writer)
+
+
+def save_result(predicted_mask, scene, out_writer):
+    counts = fnlib.mask.counts(predicted_mask, len(class_names))
+    proportions = {c: int(n) for c, n in enumerate(counts) if n > 0}
 
     print(f"proportions: {proportions}")
 
     print("saving image")
     # save the RGB bands plus the predicted mask
+    img = np.empty((SAVE_SIZE[1], SAVE_SIZE[0], 4), dtype=np.uint8)
+
+    scene.load(["B04", "B03", "B02"], SAVE_SIZE, out=img[:, :, :3])
+
+    # add the predicted mask as the fourth channel, downsampled from 512x512
+    # to 256x256 to the most frequent class of every 2x2 block. masks of
+    # tiled scenes have their native size and take the nearest pixel unless
+    # that is a multiple of 256x256 as well.
+    fnlib.mask.resize(predicted_mask, SAVE_SIZE, img[:, :, 3])
+
+    fnlib.encode.save(out_writer, img)
+
+
+def load_batch_input(scene, r):
+    # if not in China, skip
+    if not in_china(r["lat"], r["lon"]):
+        print("not in China")
+        return None
+
+    return load_model_input(scene)
+
+
+# masks of a batch. inputs of tiled scenes have their native size and are
+# batches of tiles of their own, all others run in one invocation.
+def predict_batch(imgs):
+    m = models.get()
+    masks = [None] * len(imgs)
+
+    untiled = [n for n, img in enumerate(imgs) if img.shape[:2] == MODEL_INPUT_SHAPE]
+    if len(untiled) > 0:
+        for n, mask in zip(untiled, m.predict_batch([imgs[n] for n in untiled])):
+            masks[n] = mask
+
+    for n, img in enumerate(imgs):
+        if masks[n] is not None:
+            continue
 
-    img = load_image(in_path, ["B04", "B03", "B02"], SAVE_SIZE)
+        try:
+            masks[n] = m.predict_tiles(img)
+        except Exception as e:
+            print(f"inference failed: {e}")
+            traceback.print_exc()
+            masks[n] = e
 
-    # add the predicted mask as the fourth channel
-    # need to resize the mask to the same size as the RGB bands
-    # resize from 512x512 to 256x256
-    predicted_mask_resized = predicted_mask[
-        :: MODEL_TARGET_SIZE[0] // SAVE_SIZE[0], :: MODEL_TARGET_SIZE[1] // SAVE_SIZE[1]
-    ].astype(np.uint8)
-    # .reshape(
-    # (MODEL_TARGET_SIZE[0] // 2, 2, MODEL_TARGET_SIZE[1] // 2, 2)
-    # ).mean(axis=(1, 3))
+    return masks
 
-    img = np.dstack([img, predicted_mask_resized])
 
-    np.save(out_writer, img)
+def fn_batch(
+    requests: typing.List[typing.Dict[str, typing.Any]],
+) -> typing.List[typing.Optional[Exception]]:
+    return fnlib.model.batch(requests, load_batch_input, predict_batch, save_result)
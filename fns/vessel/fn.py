@@ -1,61 +1,51 @@
 #!/usr/bin/env python3
 
-import os
-import numpy as np
-import tflite_runtime.interpreter as tflite
-from PIL import Image
 import traceback
-import threading
 import typing
 
+import fnlib.bands
+import fnlib.cascade
+import fnlib.encode
+import fnlib.model
+
 MODEL_TARGET_SIZE = (512, 512)
 MODEL_TARGET_PROB = 0.8
 SAVE_SIZE = (256, 256)
 
-thread_local = threading.local()
+# optional first stage on a spectral index, see manifest.json
+cascade = fnlib.cascade.load()
 
 # This model detects boats.
 # If a boat is detected with a probability above 0.8, we save the image (RGB bands) as a PNG.
 
 
-class model:
+class model(fnlib.model.model):
     def __init__(self):
         # Load the model
-        self.interpreter = tflite.Interpreter(model_path="vessel.tflite", num_threads=1)
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+        super().__init__("vessel.tflite")
 
     # Function to predict the class of an image
     def predict_image(self, img):
         print(img.shape, img.dtype)
-        img_array = np.expand_dims(img, axis=0)  # Create a batch of 1
-        # convert from uint8 to np.float32
-        img_array = img_array.astype(np.float32) / 255.0
-        # img_array /= 255.0  # Rescale as during training
+        return self.predict_batch([img])[0]
 
-        self.interpreter.set_tensor(self.input_details[0]["index"], img_array)
-        self.interpreter.invoke()
-        predictions = self.interpreter.get_tensor(self.output_details[0]["index"])
-        return predictions[0][0]
+    # Function to predict a list of images in one invocation
+    def predict_batch(self, imgs):
+        predictions = self.infer(imgs)
+        return predictions[:, 0]
 
 
-def load_image(img_path, bands, target_size):
-    imgs = []
+# a model for every thread
+models = fnlib.model.local(model)
 
-    for b in bands:
-        path = os.path.join(img_path, f"{b}.tiff")
 
-        # load image and resize it to target size
-        img = Image.open(path)
-        # img = img.convert("RGB")
-        img = img.resize(target_size)
-        img_array = np.array(img)
-        # print(f"band {b}: {img_array.shape}, {img_array.dtype}")
+# called by the runtime in every worker before it reports healthy
+def init() -> None:
+    models.init()
 
-        imgs.append(img_array)
 
-    return np.dstack(imgs)
+def load_model_input(scene):
+    return scene.load(["B04", "B03", "B02"], MODEL_TARGET_SIZE)
 
 
 def fn(
@@ -72,25 +62,34 @@ def fn(
         print(f"skipping: {clouds} > 0.01")
         return
 
+    # decode every band once, for both the model input and the result
+    scene = fnlib.bands.scene(in_path)
+
+    # a cheap spectral index decides if the full model is worth running
+    if not cascade.screen(scene):
+        print("skipping: rejected by cascade")
+        return
+
     # load the image in image_path
     try:
-        img = load_image(in_path, ["B04", "B03", "B02"], MODEL_TARGET_SIZE)
+        img = load_model_input(scene)
     except Exception as e:
         print(f"failed to load image: {e}")
         traceback.print_exc()
         raise e
 
-    # check that there is a model local to this thread
-    if not hasattr(thread_local, "model"):
-        thread_local.model = model()
-
     try:
-        boat_prob = thread_local.model.predict_image(img)
+        with cascade.stage2():
+            boat_prob = models.get().predict_image(img)
     except Exception as e:
         print(f"inference failed: {e}")
         traceback.print_exc()
         raise e
 
+    save_result(boat_prob, scene, out_writer)
+
+
+def save_result(boat_prob, scene, out_writer):
     print(f"boat probability: {boat_prob}")
 
     if not boat_prob >= MODEL_TARGET_PROB:
@@ -98,6 +97,31 @@ def fn(
         return
 
     print("saving image")
-    img = load_image(in_path, ["B04", "B03", "B02"], SAVE_SIZE)
+    img = scene.load(["B04", "B03", "B02"], SAVE_SIZE)
     # Image.fromarray(img).save(out_writer, format="PNG")
-    np.save(out_writer, img)
+    fnlib.encode.save(out_writer, img)
+
+
+def load_batch_input(scene, r):
+    # vessel detection is easily confused by clouds
+    if r["clouds"] > 0.01:
+        print(f"skipping: {r['clouds']} > 0.01")
+        return None
+
+    # a cheap spectral index decides if the full model is worth running
+    if not cascade.screen(scene):
+        print("skipping: rejected by cascade")
+        return None
+
+    return load_model_input(scene)
+
+
+def predict_batch(imgs):
+    with cascade.stage2(len(imgs)):
+        return models.get().predict_batch(imgs)
+
+
+def fn_batch(
+    requests: typing.List[typing.Dict[str, typing.Any]],
+) -> typing.List[typing.Optional[Exception]]:
+    return fnlib.model.batch(requests, load_batch_input, predict_batch, save_result)
@@ -126,6 +126,10 @@ func (db *DockerLightBackend) Stop() error {
 func (db *DockerLightBackend) Resume() (map[string]manager.Handler, error) {
 	handlers := make(map[string]manager.Handler)
 
+	// docker restarts the containers on its own, we can only track how long
+	// it takes them to be healthy from here on
+	resumed := time.Now()
+
 	// check if the persistFuncDir exists
 	_, err := os.Stat(db.persistFuncDir)
 	if err != nil {
@@ -182,7 +186,7 @@ func (db *DockerLightBackend) Resume() (map[string]manager.Handler, error) {
 				}
 				resp.Body.Close()
 				if resp.StatusCode == http.StatusOK {
-					log.Println("container", ip, "is ready")
+					log.Println("container", ip, "is ready after", time.Since(resumed))
 					break
 				}
 				log.Println("container", ip, "is not ready yet, retrying in 1 second")
@@ -390,6 +394,10 @@ func (dh *dockerHandler) Start() error {
 	// start containers
 	// docker start <container>
 
+	// start-to-healthy time of the containers, the handlers report their own
+	// startup time in /metrics
+	started := time.Now()
+
 	wg := sync.WaitGroup{}
 	for _, container := range dh.Containers {
 		wg.Add(1)
@@ -495,7 +503,7 @@ func (dh *dockerHandler) Start() error {
 			}
 			resp.Body.Close()
 			if resp.StatusCode == http.StatusOK {
-				log.Println("container", ip, "is ready")
+				log.Println("container", ip, "is ready after", time.Since(started))
 				break
 			}
 			log.Println("container", ip, "is not ready yet, retrying in 1 second")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import contextlib
 import http.server
 import json
 import logging
@@ -7,12 +8,24 @@ import socketserver
 import typing
 import os
 import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# maximum number of acquisitions in a single /batch request
+MAX_BATCH = int(os.environ.get("TFAAS_MAX_BATCH", "16"))
+
+# phases we time per request, in the order they are reported
+PHASES = ["parse", "fn", "rename"]
 
 if __name__ == "__main__":
-    try:
-        import fn  # type: ignore
-    except ImportError:
-        raise ImportError("Failed to import fn.py")
+    import fnlib.metrics
+    import fnlib.startup
+
+    # fn and everything it imports is imported by init, so that we answer
+    # /health while that takes its time
+    fn: typing.Any = None
 
     # first argument: function name
     try:
@@ -23,26 +36,269 @@ if __name__ == "__main__":
     if function_name == "":
         raise ValueError("Empty function name")
 
+    # set once fn.init has warmed up the function
+    ready = threading.Event()
+
+    # seconds from process start until fn was warm
+    startup: typing.Optional[float] = None
+
+    def init() -> None:
+        global fn, startup
+
+        try:
+            import fn  # type: ignore
+        except Exception as e:
+            logging.error(f"Failed to import fn.py: {e}")
+            logging.error(traceback.format_exc())
+            # exit, so that docker restarts the container
+            os._exit(1)
+
+        if hasattr(fn, "init"):
+            try:
+                fn.init()
+            except Exception as e:
+                logging.error(f"failed to initialize fn: {e}")
+                logging.error(traceback.format_exc())
+
+        logging.info("fn ready")
+        startup = round(fnlib.startup.seconds(), 3)
+        print(f"healthy {startup:.3f}s after process start")
+        ready.set()
+
+    def tmp_path(i: typing.Dict[str, typing.Any]) -> str:
+        # a new file for every request, requests for the same input (e.g.,
+        # twice in one batch) must not write into the same file
+        fd, p = tempfile.mkstemp(
+            prefix=f"{function_name}-{os.path.basename(i['in_path'])}-",
+            suffix=".tmp",
+            dir="/tmp",
+        )
+        os.close(fd)
+        return p
+
+    def result_path(i: typing.Dict[str, typing.Any]) -> str:
+        return os.path.join(
+            i["out_path"],
+            f"{function_name}-{os.path.basename(i['in_path'])}",
+        )
+
+    def fn_args(
+        i: typing.Dict[str, typing.Any], out_writer: typing.BinaryIO
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            "lat": i["lat"],
+            "lon": i["lon"],
+            "alt": i["alt"],
+            "clouds": i["clouds"],
+            "sunlit": i["sunlit"],
+            "in_path": i["in_path"],
+            "out_writer": out_writer,
+        }
+
+    # request metrics for /metrics, in the Prometheus text format
+    metrics = fnlib.metrics.registry()
+
+    def written(path: str) -> None:
+        metrics.inc("tfaas_bytes_written_total", os.path.getsize(path))
+
+    def render_metrics() -> str:
+        # this runtime serves every request from a single process
+        return metrics.render(
+            fnlib.metrics.gauge("tfaas_startup_seconds", startup or 0)
+            + fnlib.metrics.processes({os.getpid(): "handler"})
+        )
+
+    @contextlib.contextmanager
+    def phase(timings: typing.Dict[str, float], name: str) -> typing.Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - t
+
+    def execute_batch(
+        items: typing.List[typing.Dict[str, typing.Any]],
+        timings: typing.Dict[str, float],
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        tmp_files = [tmp_path(i) for i in items]
+
+        try:
+            with contextlib.ExitStack() as stack, phase(timings, "fn"):
+                requests = [
+                    fn_args(i, stack.enter_context(open(t, "wb")))
+                    for i, t in zip(items, tmp_files)
+                ]
+
+                # functions can opt into processing the entire batch at once
+                if hasattr(fn, "fn_batch"):
+                    errors = fn.fn_batch(requests)
+                else:
+                    errors = []
+                    for r in requests:
+                        try:
+                            fn.fn(**r)
+                            errors.append(None)
+                        except Exception as e:
+                            logging.error(traceback.format_exc())
+                            errors.append(e)
+
+            results = []
+            for i, t, err in zip(items, tmp_files, errors):
+                if err is None:
+                    with phase(timings, "rename"):
+                        os.rename(t, result_path(i))
+                    written(result_path(i))
+                    results.append({"in_path": i["in_path"], "status": "ok"})
+                    continue
+
+                logging.error(f"Failed to execute fn for {i['in_path']}: {err}")
+                results.append(
+                    {"in_path": i["in_path"], "status": "error", "error": str(err)}
+                )
+
+            return results
+        finally:
+            for t in tmp_files:
+                if os.path.exists(t):
+                    os.remove(t)
+
     # create a webserver at port 8080 and execute fn.fn for every request
     class tfaasFNHandler(http.server.BaseHTTPRequestHandler):
+        # phase timings of the current request in seconds
+        timings: typing.Dict[str, float] = {}
+        started = 0.0
+        in_path: typing.Optional[str] = None
+
+        def phases(self) -> typing.Dict[str, float]:
+            timings = {k: self.timings[k] for k in PHASES if k in self.timings}
+            timings["total"] = time.perf_counter() - self.started
+            return timings
+
+        def end_headers(self) -> None:
+            if len(self.timings) > 0:
+                self.send_header(
+                    "Server-Timing",
+                    ", ".join(
+                        f"{k};dur={v * 1000:.2f}" for k, v in self.phases().items()
+                    ),
+                )
+            super().end_headers()
+
+        def log_request(self, code: typing.Any = "-", size: typing.Any = "-") -> None:
+            super().log_request(code, size)
+
+            if self.command != "POST":
+                return
+
+            phases = self.phases()
+            path = fnlib.metrics.route(self.path)
+            metrics.inc(
+                "tfaas_requests_total",
+                path=path,
+                outcome="ok" if int(code) < 400 else "error",
+            )
+            metrics.observe(
+                "tfaas_request_duration_seconds", phases["total"], path=path
+            )
+
+            # one JSON line per request, so time (and energy) can be
+            # attributed to phases without scraping the log
+            print(
+                json.dumps(
+                    {
+                        "ts": time.time(),
+                        "fn": function_name,
+                        "path": self.path,
+                        "status": int(code),
+                        "in_path": self.in_path,
+                        "timings_ms": {
+                            k: round(v * 1000, 3) for k, v in phases.items()
+                        },
+                    }
+                )
+            )
+
         def do_GET(self) -> None:
             print(f"GET {self.path}")
             if self.path == "/health":
+                if not ready.is_set():
+                    logging.info("reporting health: warming up")
+                    self.send_response(503)
+                    self.end_headers()
+                    self.wfile.write("Warming up".encode("utf-8"))
+                    return
+
                 logging.info("reporting health: OK")
                 self.send_response(200)
                 self.end_headers()
                 self.wfile.write("OK".encode("utf-8"))
                 return
 
+            if self.path == "/metrics":
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.end_headers()
+                self.wfile.write(render_metrics().encode("utf-8"))
+                return
+
             logging.error(f"Invalid path for GET: {self.path}")
             self.send_response(404)
             self.end_headers()
             return
 
+        def read_body(self) -> bytes:
+            if "chunked" not in self.headers.get("Transfer-Encoding", "").lower():
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            # chunked transfer encoding: hex size line, data, CRLF, until an
+            # empty chunk
+            body = bytearray()
+            while True:
+                line = self.rfile.readline()
+                try:
+                    size = int(line.split(b";")[0].strip(), 16)
+                except ValueError:
+                    raise ValueError(f"invalid chunk size line {line!r}")
+
+                if size < 0:
+                    raise ValueError(f"invalid chunk size {size}")
+
+                if size == 0:
+                    break
+
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+            # skip trailers
+            while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+
+            return bytes(body)
+
         def do_POST(self) -> None:
-            d: typing.Optional[str] = self.rfile.read(
-                int(self.headers["Content-Length"])
-            ).decode("utf-8")
+            self.started = time.perf_counter()
+            self.timings = {}
+            self.in_path = None
+
+            try:
+                d: typing.Optional[str] = self.read_body().decode("utf-8")
+            except ValueError as e:
+                logging.error(f"Failed to read body: {e}")
+                # we do not know where the body ends, so the connection is
+                # of no use anymore
+                self.close_connection = True
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+            if not ready.is_set():
+                self.send_response(503)
+                self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write("Warming up".encode("utf-8"))
+                return
+
             if d == "":
                 logging.error("Empty body")
                 self.send_response(400)
@@ -60,29 +316,24 @@ if __name__ == "__main__":
                 self.wfile.write(str(e).encode("utf-8"))
                 return
 
+            self.timings["parse"] = time.perf_counter() - self.started
+            if isinstance(i, dict):
+                self.in_path = i.get("in_path")
+
+            if self.path == "/batch":
+                self.do_batch(i)
+                return
+
+            tmp_file = ""
             try:
-                tmp_file = os.path.join(
-                    "/tmp",
-                    f"{function_name}-{os.path.basename(i['in_path'])}",
-                )
+                tmp_file = tmp_path(i)
 
-                with open(tmp_file, "wb") as f:
-                    fn.fn(
-                        lat=i["lat"],
-                        lon=i["lon"],
-                        alt=i["alt"],
-                        clouds=i["clouds"],
-                        sunlit=i["sunlit"],
-                        in_path=i["in_path"],
-                        out_writer=f,
-                    )
-
-                result_file = os.path.join(
-                    i["out_path"],
-                    f"{function_name}-{os.path.basename(i['in_path'])}",
-                )
+                with open(tmp_file, "wb") as f, phase(self.timings, "fn"):
+                    fn.fn(**fn_args(i, f))
 
-                os.rename(tmp_file, result_file)
+                with phase(self.timings, "rename"):
+                    os.rename(tmp_file, result_path(i))
+                written(result_path(i))
 
                 logging.info("fn executed successfully")
                 self.send_response(200)
@@ -95,6 +346,42 @@ if __name__ == "__main__":
                 self.end_headers()
                 self.wfile.write(str(e).encode("utf-8"))
                 return
+            finally:
+                if tmp_file != "" and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+        def do_batch(self, items: typing.Any) -> None:
+            if not isinstance(items, list) or len(items) == 0:
+                logging.error("Batch is not a non-empty list")
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write("Batch must be a non-empty list".encode("utf-8"))
+                return
+
+            if len(items) > MAX_BATCH:
+                logging.error(f"Batch too large: {len(items)} > {MAX_BATCH}")
+                self.send_response(413)
+                self.end_headers()
+                self.wfile.write(f"Batch larger than {MAX_BATCH}".encode("utf-8"))
+                return
+
+            try:
+                results = execute_batch(items, self.timings)
+            except Exception as e:
+                logging.error(f"Failed to execute batch: {e}")
+                self.send_response(500)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+            logging.info(f"batch of {len(items)} executed")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(results).encode("utf-8"))
+
+    # warm up in the background, so we can answer /health in the meantime
+    threading.Thread(target=init, daemon=True).start()
 
     with socketserver.ThreadingTCPServer(("", 8000), tfaasFNHandler) as httpd:
         httpd.serve_forever()
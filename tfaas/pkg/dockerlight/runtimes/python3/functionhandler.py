@@ -1,18 +1,46 @@
 #!/usr/bin/env python3
 
-import http.server
+import asyncio
+import concurrent.futures
+import contextlib
+import http
 import json
 import logging
-import socketserver
 import typing
 import os
 import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# maximum number of acquisitions in a single /batch request
+MAX_BATCH = int(os.environ.get("TFAAS_MAX_BATCH", "16"))
+# number of threads executing fn.fn
+WORKERS = int(os.environ.get("TFAAS_WORKERS", str(os.cpu_count() or 1)))
+# number of requests that may wait for a worker before we reject with 503
+QUEUE_SIZE = int(os.environ.get("TFAAS_QUEUE_SIZE", "4"))
+# seconds a request may take before we answer 504
+TIMEOUT = float(os.environ.get("TFAAS_TIMEOUT", "60"))
+# seconds an idle connection is kept open, longer than the idle timeout of
+# the Go http client in the rproxy (90s), so that the client closes first
+KEEPALIVE_TIMEOUT = float(os.environ.get("TFAAS_KEEPALIVE_TIMEOUT", "120"))
+# upper bound for request lines and headers
+MAX_LINE = 64 * 1024
+
+# phases we time per request, in the order they are reported
+PHASES = ["parse", "queue", "fn", "rename"]
+
+# fields every request carries
+FIELDS = ["lat", "lon", "alt", "clouds", "sunlit", "in_path", "out_path"]
 
 if __name__ == "__main__":
-    try:
-        import fn  # type: ignore
-    except ImportError:
-        raise ImportError("Failed to import fn.py")
+    import fnlib.metrics
+    import fnlib.startup
+
+    # fn and everything it imports is imported by init, so that we answer
+    # /health while that takes its time
+    fn: typing.Any = None
 
     # first argument: function name
     try:
@@ -23,78 +51,492 @@ if __name__ == "__main__":
     if function_name == "":
         raise ValueError("Empty function name")
 
-    # create a webserver at port 8080 and execute fn.fn for every request
-    class tfaasFNHandler(http.server.BaseHTTPRequestHandler):
-        def do_GET(self) -> None:
-            print(f"GET {self.path}")
-            if self.path == "/health":
-                logging.info("reporting health: OK")
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write("OK".encode("utf-8"))
-                return
-
-            logging.error(f"Invalid path for GET: {self.path}")
-            self.send_response(404)
-            self.end_headers()
-            return
-
-        def do_POST(self) -> None:
-            d: typing.Optional[str] = self.rfile.read(
-                int(self.headers["Content-Length"])
-            ).decode("utf-8")
-            if d == "":
+    # set once fn.init has warmed up the function
+    ready = threading.Event()
+
+    # seconds from process start until fn was warm
+    startup: typing.Optional[float] = None
+
+    def init() -> None:
+        global fn, startup
+
+        try:
+            import fn  # type: ignore
+        except Exception as e:
+            logging.error(f"Failed to import fn.py: {e}")
+            logging.error(traceback.format_exc())
+            # exit, so that docker restarts the container
+            os._exit(1)
+
+        if hasattr(fn, "init"):
+            try:
+                fn.init()
+            except Exception as e:
+                logging.error(f"failed to initialize fn: {e}")
+                logging.error(traceback.format_exc())
+
+        logging.info("fn ready")
+        startup = round(fnlib.startup.seconds(), 3)
+        print(f"healthy {startup:.3f}s after process start")
+        ready.set()
+
+    def tmp_path(i: typing.Dict[str, typing.Any]) -> str:
+        # a new file for every attempt, a retry must not write into the file
+        # of an attempt that timed out but is still running
+        fd, p = tempfile.mkstemp(
+            prefix=f"{function_name}-{os.path.basename(i['in_path'])}-",
+            suffix=".tmp",
+            dir="/tmp",
+        )
+        os.close(fd)
+        return p
+
+    def result_path(i: typing.Dict[str, typing.Any]) -> str:
+        return os.path.join(
+            i["out_path"],
+            f"{function_name}-{os.path.basename(i['in_path'])}",
+        )
+
+    def validate(i: typing.Any) -> None:
+        # raises ValueError if the request i is not an object with all
+        # FIELDS, so that we answer 400 before it reaches fn
+        if not isinstance(i, dict):
+            raise ValueError("request is not a JSON object")
+
+        missing = [f for f in FIELDS if f not in i]
+        if len(missing) > 0:
+            raise ValueError(f"request is missing {', '.join(missing)}")
+
+    def fn_args(
+        i: typing.Dict[str, typing.Any], out_writer: typing.BinaryIO
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            "lat": i["lat"],
+            "lon": i["lon"],
+            "alt": i["alt"],
+            "clouds": i["clouds"],
+            "sunlit": i["sunlit"],
+            "in_path": i["in_path"],
+            "out_writer": out_writer,
+        }
+
+    # request metrics for /metrics, in the Prometheus text format
+    metrics = fnlib.metrics.registry()
+
+    def written(path: str) -> None:
+        metrics.inc("tfaas_bytes_written_total", os.path.getsize(path))
+
+    def render_metrics() -> str:
+        # this runtime serves every request from a single process
+        return metrics.render(
+            fnlib.metrics.gauge("tfaas_startup_seconds", startup or 0)
+            + fnlib.metrics.processes({os.getpid(): "handler"})
+        )
+
+    @contextlib.contextmanager
+    def phase(timings: typing.Dict[str, float], name: str) -> typing.Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - t
+
+    def execute(
+        i: typing.Dict[str, typing.Any], timings: typing.Dict[str, float]
+    ) -> None:
+        tmp_file = tmp_path(i)
+
+        try:
+            with open(tmp_file, "wb") as f, phase(timings, "fn"):
+                fn.fn(**fn_args(i, f))
+
+            with phase(timings, "rename"):
+                os.rename(tmp_file, result_path(i))
+            written(result_path(i))
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    def execute_batch(
+        items: typing.List[typing.Dict[str, typing.Any]],
+        timings: typing.Dict[str, float],
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        tmp_files = [tmp_path(i) for i in items]
+
+        try:
+            with contextlib.ExitStack() as stack, phase(timings, "fn"):
+                requests = [
+                    fn_args(i, stack.enter_context(open(t, "wb")))
+                    for i, t in zip(items, tmp_files)
+                ]
+
+                # functions can opt into processing the entire batch at once
+                if hasattr(fn, "fn_batch"):
+                    errors = fn.fn_batch(requests)
+                else:
+                    errors = []
+                    for r in requests:
+                        try:
+                            fn.fn(**r)
+                            errors.append(None)
+                        except Exception as e:
+                            logging.error(traceback.format_exc())
+                            errors.append(e)
+
+            results = []
+            for i, t, err in zip(items, tmp_files, errors):
+                if err is None:
+                    with phase(timings, "rename"):
+                        os.rename(t, result_path(i))
+                    written(result_path(i))
+                    results.append({"in_path": i["in_path"], "status": "ok"})
+                    continue
+
+                logging.error(f"Failed to execute fn for {i['in_path']}: {err}")
+                results.append(
+                    {"in_path": i["in_path"], "status": "error", "error": str(err)}
+                )
+
+            return results
+        finally:
+            for t in tmp_files:
+                if os.path.exists(t):
+                    os.remove(t)
+
+    # An asyncio HTTP/1.1 server: connections are kept alive for the rproxy
+    # and handled on the event loop, while fn.fn runs on a bounded set of
+    # worker threads.
+    class tfaasServer:
+        def __init__(self, workers: int, queue_size: int, timeout: float) -> None:
+            self.workers = workers
+            self.queue_size = queue_size
+            self.timeout = timeout
+
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="fn"
+            )
+            self.in_flight = 0
+            self.connections = 0
+            self.requests = 0
+            self.timeouts = 0
+
+        def status(self) -> typing.Dict[str, typing.Any]:
+            return {
+                "ready": ready.is_set(),
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "in_flight": self.in_flight,
+                "queue_depth": max(0, self.in_flight - self.workers),
+                "busy": self.in_flight >= self.workers,
+                "connections": self.connections,
+                "requests": self.requests,
+                "timeouts": self.timeouts,
+                "startup_seconds": startup,
+            }
+
+        async def read_body(
+            self, reader: asyncio.StreamReader, headers: typing.Dict[str, str]
+        ) -> bytes:
+            if "chunked" not in headers.get("transfer-encoding", "").lower():
+                return await reader.readexactly(int(headers.get("content-length", 0)))
+
+            # chunked transfer encoding: hex size line, data, CRLF, until an
+            # empty chunk
+            body = bytearray()
+            while True:
+                line = await reader.readline()
+                try:
+                    size = int(line.split(b";")[0].strip(), 16)
+                except ValueError:
+                    raise ValueError(f"invalid chunk size line {line!r}")
+
+                if size < 0:
+                    raise ValueError(f"invalid chunk size {size}")
+
+                if size == 0:
+                    break
+
+                body += await reader.readexactly(size)
+                await reader.readline()
+
+            # skip trailers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            return bytes(body)
+
+        async def bad_request(self, writer: asyncio.StreamWriter, message: str) -> None:
+            # we do not know where the request ends, so answer and close the
+            # connection
+            response = message.encode("utf-8")
+            writer.write(
+                (
+                    "HTTP/1.1 400 Bad Request\r\n"
+                    f"Content-Length: {len(response)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+                + response
+            )
+            await writer.drain()
+
+        async def handle(
+            self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+        ) -> None:
+            self.connections += 1
+            try:
+                keep_alive = True
+                while keep_alive:
+                    try:
+                        line = await asyncio.wait_for(
+                            reader.readline(), KEEPALIVE_TIMEOUT
+                        )
+                    except asyncio.TimeoutError:
+                        break
+                    except ValueError:
+                        logging.error("Request line too long")
+                        await self.bad_request(writer, "Request line too long")
+                        break
+
+                    if line == b"":
+                        break
+
+                    try:
+                        method, path, version = line.decode("latin-1").split()
+                        if not version.startswith("HTTP/"):
+                            raise ValueError
+                    except ValueError:
+                        logging.error(f"Malformed request line {line!r}")
+                        await self.bad_request(writer, f"Bad request line {line!r}")
+                        break
+
+                    headers: typing.Dict[str, str] = {}
+                    while True:
+                        h = (await reader.readline()).decode("latin-1")
+                        if h in ("\r\n", "\n", ""):
+                            break
+                        k, _, v = h.partition(":")
+                        headers[k.strip().lower()] = v.strip()
+
+                    connection = headers.get("connection", "").lower()
+                    keep_alive = (
+                        connection != "close"
+                        if version == "HTTP/1.1"
+                        else connection == "keep-alive"
+                    )
+
+                    started = time.perf_counter()
+                    try:
+                        body = await self.read_body(reader, headers)
+                    except ValueError as e:
+                        logging.error(f"Failed to read body: {e}")
+                        await self.bad_request(writer, str(e))
+                        break
+
+                    self.requests += 1
+                    status, extra, response = await self.route(
+                        method, path, body, started
+                    )
+
+                    s = self.status()
+                    out = [
+                        f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}",
+                        f"Content-Length: {len(response)}",
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+                        f"X-TFaas-Queue-Depth: {s['queue_depth']}",
+                        f"X-TFaas-Busy: {1 if s['busy'] else 0}",
+                    ] + [f"{k}: {v}" for k, v in extra.items()]
+
+                    writer.write(("\r\n".join(out) + "\r\n\r\n").encode("latin-1"))
+                    writer.write(response)
+                    await writer.drain()
+            except (ValueError, asyncio.IncompleteReadError, ConnectionError) as e:
+                logging.error(f"Dropping connection: {e}")
+            finally:
+                self.connections -= 1
+                writer.close()
+
+        async def run(
+            self,
+            f: typing.Callable[[typing.Any, typing.Dict[str, float]], typing.Any],
+            arg: typing.Any,
+            timings: typing.Dict[str, float],
+        ) -> typing.Tuple[int, typing.Dict[str, str], typing.Any]:
+            # at most workers requests run, queue_size more may wait
+            if self.in_flight >= self.workers + self.queue_size:
+                logging.warning("queue full, rejecting request")
+                return 503, {"Retry-After": "1"}, b"Busy"
+
+            submitted = time.perf_counter()
+
+            def work() -> typing.Any:
+                timings["queue"] = time.perf_counter() - submitted
+                return f(arg, timings)
+
+            loop = asyncio.get_running_loop()
+            future = self.executor.submit(work)
+
+            # the slot is taken until the worker is done, even if we stop
+            # waiting for it earlier, so timeouts cannot pile up work
+            self.in_flight += 1
+            future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.done))
+
+            try:
+                result = await asyncio.wait_for(
+                    asyncio.wrap_future(future), self.timeout
+                )
+                return 200, {}, result
+            except asyncio.TimeoutError:
+                # the worker thread cannot be interrupted and finishes on its
+                # own, unless it had not started yet
+                self.timeouts += 1
+                logging.error(f"fn timed out after {self.timeout}s")
+                return 504, {}, b"Timeout"
+            except Exception as e:
+                logging.error(f"Failed to execute fn: {e}")
+                return 500, {}, str(e).encode("utf-8")
+
+        def done(self) -> None:
+            self.in_flight -= 1
+
+        async def route(
+            self, method: str, path: str, body: bytes, started: float
+        ) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+            if method == "GET":
+                print(f"GET {path}")
+                if path == "/health":
+                    if not ready.is_set():
+                        logging.info("reporting health: warming up")
+                        return 503, {}, b"Warming up"
+
+                    logging.info("reporting health: OK")
+                    return 200, {}, b"OK"
+
+                if path == "/status":
+                    return (
+                        200,
+                        {"Content-Type": "application/json"},
+                        json.dumps(self.status()).encode("utf-8"),
+                    )
+
+                if path == "/metrics":
+                    return (
+                        200,
+                        {"Content-Type": "text/plain; version=0.0.4"},
+                        render_metrics().encode("utf-8"),
+                    )
+
+                logging.error(f"Invalid path for GET: {path}")
+                return 404, {}, b""
+
+            if method != "POST":
+                return 405, {}, b""
+
+            if not ready.is_set():
+                return 503, {"Retry-After": "1"}, b"Warming up"
+
+            if len(body) == 0:
                 logging.error("Empty body")
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write("Empty body".encode("utf-8"))
-                return
+                return 400, {}, b"Empty body"
 
             # try parsing the input as json
             try:
-                i = json.loads(d)
+                i = json.loads(body.decode("utf-8"))
             except json.JSONDecodeError as e:
                 logging.error(f"Failed to parse json: {e}")
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write(str(e).encode("utf-8"))
-                return
+                return 400, {}, str(e).encode("utf-8")
 
-            try:
-                tmp_file = os.path.join(
-                    "/tmp",
-                    f"{function_name}-{os.path.basename(i['in_path'])}",
+            timings = {"parse": time.perf_counter() - started}
+            status, extra, response = await self.dispatch(path, i, timings)
+
+            # phases that ran, in order, and the time of the entire request
+            phases = {k: timings[k] for k in PHASES if k in timings}
+            phases["total"] = time.perf_counter() - started
+            route = fnlib.metrics.route(path)
+            metrics.inc(
+                "tfaas_requests_total",
+                path=route,
+                outcome="ok" if status < 400 else "error",
+            )
+            metrics.observe(
+                "tfaas_request_duration_seconds", phases["total"], path=route
+            )
+
+            extra["Server-Timing"] = ", ".join(
+                f"{k};dur={v * 1000:.2f}" for k, v in phases.items()
+            )
+
+            # one JSON line per request, so time (and energy) can be
+            # attributed to phases without scraping the log
+            print(
+                json.dumps(
+                    {
+                        "ts": time.time(),
+                        "fn": function_name,
+                        "path": path,
+                        "status": status,
+                        "in_path": i.get("in_path") if isinstance(i, dict) else None,
+                        "timings_ms": {
+                            k: round(v * 1000, 3) for k, v in phases.items()
+                        },
+                    }
                 )
+            )
 
-                with open(tmp_file, "wb") as f:
-                    fn.fn(
-                        lat=i["lat"],
-                        lon=i["lon"],
-                        alt=i["alt"],
-                        clouds=i["clouds"],
-                        sunlit=i["sunlit"],
-                        in_path=i["in_path"],
-                        out_writer=f,
-                    )
+            return status, extra, response
+
+        async def dispatch(
+            self, path: str, i: typing.Any, timings: typing.Dict[str, float]
+        ) -> typing.Tuple[int, typing.Dict[str, str], bytes]:
+            if path == "/batch":
+                if not isinstance(i, list) or len(i) == 0:
+                    logging.error("Batch is not a non-empty list")
+                    return 400, {}, b"Batch must be a non-empty list"
 
-                result_file = os.path.join(
-                    i["out_path"],
-                    f"{function_name}-{os.path.basename(i['in_path'])}",
+                if len(i) > MAX_BATCH:
+                    logging.error(f"Batch too large: {len(i)} > {MAX_BATCH}")
+                    return 413, {}, f"Batch larger than {MAX_BATCH}".encode("utf-8")
+
+                try:
+                    for item in i:
+                        validate(item)
+                except ValueError as e:
+                    logging.error(f"Invalid batch item: {e}")
+                    return 400, {}, str(e).encode("utf-8")
+
+                status, extra, results = await self.run(execute_batch, i, timings)
+                if status != 200:
+                    return status, extra, results
+
+                logging.info(f"batch of {len(i)} executed")
+                return (
+                    200,
+                    {"Content-Type": "application/json"},
+                    json.dumps(results).encode("utf-8"),
                 )
 
-                os.rename(tmp_file, result_file)
+            try:
+                validate(i)
+            except ValueError as e:
+                logging.error(f"Invalid request: {e}")
+                return 400, {}, str(e).encode("utf-8")
 
-                logging.info("fn executed successfully")
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write("OK".encode("utf-8"))
-                return
-            except Exception as e:
-                logging.error(f"Failed to execute fn: {e}")
-                self.send_response(500)
-                self.end_headers()
-                self.wfile.write(str(e).encode("utf-8"))
-                return
+            status, extra, result = await self.run(execute, i, timings)
+            if status != 200:
+                return status, extra, result
+
+            logging.info("fn executed successfully")
+            return 200, {}, b"OK"
+
+    async def serve() -> None:
+        server = tfaasServer(WORKERS, QUEUE_SIZE, TIMEOUT)
+
+        # warm up in the background, so we can answer /health in the meantime
+        asyncio.get_running_loop().run_in_executor(server.executor, init)
+
+        s = await asyncio.start_server(server.handle, port=8000, limit=MAX_LINE)
+        logging.info(f"serving with {WORKERS} workers (queue size {QUEUE_SIZE})")
+
+        async with s:
+            await s.serve_forever()
 
-    with socketserver.ThreadingTCPServer(("", 8000), tfaasFNHandler) as httpd:
-        httpd.serve_forever()
+    asyncio.run(serve())
@@ -0,0 +1,3 @@
+#!/usr/bin/env python3
+
+# helpers shared by all functions running in the tflite runtime
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import itertools
+import os
+import threading
+import typing
+
+import numpy as np
+from PIL import Image
+
+import fnlib.metrics
+import fnlib.store
+import fnlib.timing
+
+# Bands are decoded once per acquisition and kept in a memory-bounded LRU
+# cache, keyed by (in_path, band, size). Resized views of a band are cached
+# next to the native decode, so loading a band at the model size and again
+# at the save size only reads the TIFF once. If the acquisition store is
+# enabled, native bands are read-only views into the shared store instead.
+#
+# A function that needs bands at more than one size within a request should
+# use a scene: it keeps the native decode of every band it has used until the
+# request is done, so resizing never decodes a TIFF again, even if the cache
+# has evicted the band in the meantime.
+#
+# A scene loads the bands a model needs into one (height, width, bands)
+# array, which the caller may preallocate. Bands with the same native size
+# are resized together, four at a time as the channels of one PIL image,
+# which gives the same result as resizing every band on its own.
+#
+# A model with inputs at several resolutions can load all of them with
+# scene.pyramid. Bands that are downscaled by more than a factor of two are
+# halved with a 2x2 box filter until they are at most four times the size
+# they are resized to, all bands of the same native size in one numpy
+# operation per level, which is much cheaper than a bicubic filter over the
+# native band. This is what PIL does with reducing_gap=2, so the result is
+# close to, but not the same as, that of load.
+#
+# Acquisitions that arrive inline with a request (see fnlib.frame) are
+# registered under a generated in_path for the duration of the request, so
+# functions read them like any other acquisition.
+
+# upper bound for the decoded band cache in bytes
+CACHE_BYTES = int(os.environ.get("TFAAS_BAND_CACHE_BYTES", str(32 * 1024 * 1024)))
+
+Key = typing.Tuple[str, str, typing.Optional[typing.Tuple[int, int]]]
+
+_lock = threading.Lock()
+_cache: "collections.OrderedDict[Key, np.ndarray]" = collections.OrderedDict()
+_cache_bytes = 0
+
+_inline: typing.Dict[str, typing.Dict[str, np.ndarray]] = {}
+_inline_ids = itertools.count()
+
+
+def _get(key: Key) -> typing.Optional[np.ndarray]:
+    with _lock:
+        img = _cache.get(key)
+
+        if img is None:
+            fnlib.metrics.inc("tfaas_band_cache_misses_total")
+            return None
+
+        fnlib.metrics.inc("tfaas_band_cache_hits_total")
+        _cache.move_to_end(key)
+        return img
+
+
+def _put(key: Key, img: np.ndarray) -> None:
+    global _cache_bytes
+
+    # cached arrays are shared between callers
+    img.flags.writeable = False
+
+    with _lock:
+        if key in _cache:
+            return
+
+        _cache[key] = img
+        _cache_bytes += img.nbytes
+
+        # evict least recently used entries, but never the one we just added
+        while _cache_bytes > CACHE_BYTES and len(_cache) > 1:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= evicted.nbytes
+
+
+def band(
+    in_path: str, b: str, size: typing.Optional[typing.Tuple[int, int]] = None
+) -> np.ndarray:
+    """returns band b of the acquisition in in_path, resized to size (width,
+    height) if given. the returned array is read-only."""
+    inline = _inline.get(in_path)
+    if size is None and inline is not None:
+        try:
+            return inline[b]
+        except KeyError:
+            raise FileNotFoundError(f"band {b} is not in inline acquisition {in_path}")
+
+    if size is None and fnlib.store.enabled() and b in fnlib.store.BAND_INDEX:
+        try:
+            with fnlib.timing.phase("decode"):
+                return fnlib.store.band(in_path, b)
+        except Exception as e:
+            print(f"could not load {b} from acquisition store: {e}")
+
+    key = (in_path, b, size)
+
+    img = _get(key)
+    if img is not None:
+        return img
+
+    if size is None:
+        with fnlib.timing.phase("decode"):
+            img = np.array(Image.open(os.path.join(in_path, f"{b}.tiff")))
+    else:
+        native = band(in_path, b)
+
+        if (native.shape[1], native.shape[0]) == size:
+            return native
+
+        img = _resize(native, size)
+
+    _put(key, img)
+    return img
+
+
+def _resize(native: np.ndarray, size: typing.Tuple[int, int]) -> np.ndarray:
+    with fnlib.timing.phase("preprocess"):
+        # the array interface of an image is a copy already
+        return np.asarray(Image.fromarray(native).resize(size))
+
+
+# PIL mode that resizes four 8-bit bands as the channels of one image
+_MODE = "RGBX"
+
+
+def _groups(n: int) -> typing.Iterator[int]:
+    # sizes of the groups we resize n bands in
+    while n >= 4:
+        yield 4
+        n -= 4
+
+    # PIL resizes three bands as four channels as well, so we resize the
+    # rest one by one
+    yield from [1] * n
+
+
+def _resize_group(
+    natives: typing.List[np.ndarray], size: typing.Tuple[int, int]
+) -> np.ndarray:
+    # resizes bands of the same native size to an (height, width, bands)
+    # array in one pass
+    if len(natives) == 1:
+        return _resize(natives[0], size)[:, :, np.newaxis]
+
+    with fnlib.timing.phase("preprocess"):
+        height, width = natives[0].shape
+
+        stacked = np.empty((height, width, len(natives)), dtype=np.uint8)
+        for c, native in enumerate(natives):
+            stacked[:, :, c] = native
+
+        img = Image.frombuffer(_MODE, (width, height), stacked, "raw", _MODE, 0, 1)
+        return np.asarray(img.resize(size))
+
+
+def _halve(stack: np.ndarray) -> np.ndarray:
+    # 2x2 box filter of a (bands, height, width) stack, rounded like PIL's
+    # reduce. an odd last row or column is dropped.
+    _, height, width = stack.shape
+    stack = stack[:, : height // 2 * 2, : width // 2 * 2]
+
+    # strided adds are much faster than a sum over a reshaped stack
+    rows = stack[:, 0::2].astype(np.uint16)
+    rows += stack[:, 1::2]
+
+    total = rows[:, :, 0::2] + rows[:, :, 1::2]
+    total += 2
+    total >>= 2
+
+    return total.astype(np.uint8)
+
+
+def _levels(shape: typing.Tuple[int, ...], size: typing.Tuple[int, int]) -> int:
+    # how often to halve a band of shape before resizing it to size
+    height, width = shape
+    w, h = size
+
+    n = 0
+    while (height >> (n + 1)) >= 2 * h and (width >> (n + 1)) >= 2 * w:
+        n += 1
+
+    return n
+
+
+def load(
+    in_path: str, bands: typing.List[str], size: typing.Tuple[int, int]
+) -> np.ndarray:
+    """loads bands of the acquisition in in_path as an (height, width, bands)
+    array, resized to size (width, height)"""
+    return scene(in_path).load(bands, size)
+
+
+@contextlib.contextmanager
+def inline(bands: typing.Dict[str, np.ndarray]) -> typing.Iterator[str]:
+    """makes bands available under a generated in_path while the context is
+    active"""
+    in_path = f"inline:{os.getpid()}-{next(_inline_ids)}"
+
+    for img in bands.values():
+        img.flags.writeable = False
+
+    with _lock:
+        _inline[in_path] = bands
+
+    try:
+        yield in_path
+    finally:
+        _forget(in_path)
+
+
+def _forget(in_path: str) -> None:
+    # drop an inline acquisition and everything we have cached for it
+    global _cache_bytes
+
+    with _lock:
+        _inline.pop(in_path, None)
+
+        for key in [k for k in _cache if k[0] == in_path]:
+            _cache_bytes -= _cache.pop(key).nbytes
+
+
+class scene:
+    """the bands of one acquisition for the duration of a request"""
+
+    def __init__(self, in_path: str) -> None:
+        self.in_path = in_path
+        self.native: typing.Dict[str, np.ndarray] = {}
+
+    def _native(self, b: str) -> np.ndarray:
+        native = self.native.get(b)
+        if native is None:
+            native = band(self.in_path, b)
+            self.native[b] = native
+
+        return native
+
+    def _cached(
+        self, b: str, size: typing.Tuple[int, int]
+    ) -> typing.Optional[np.ndarray]:
+        # band b at size if we do not have to resize it
+        native = self._native(b)
+
+        if (native.shape[1], native.shape[0]) == size:
+            return native
+
+        return _get((self.in_path, b, size))
+
+    def band(
+        self, b: str, size: typing.Optional[typing.Tuple[int, int]] = None
+    ) -> np.ndarray:
+        """returns band b, resized to size (width, height) if given"""
+        if size is None:
+            return self._native(b)
+
+        img = self._cached(b, size)
+        if img is not None:
+            return img
+
+        img = _resize(self.native[b], size)
+        _put((self.in_path, b, size), img)
+        return img
+
+    def load(
+        self,
+        bands: typing.List[str],
+        size: typing.Tuple[int, int],
+        out: typing.Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """loads bands as an (height, width, bands) array, resized to size
+        (width, height), into out if given"""
+        if out is None:
+            out = np.empty((size[1], size[0], len(bands)), dtype=np.uint8)
+
+        # bands to resize, by their native size
+        missing: typing.Dict[typing.Tuple[int, ...], typing.List[int]] = {}
+
+        for c, b in enumerate(bands):
+            img = self._cached(b, size)
+            if img is None:
+                missing.setdefault(self.native[b].shape, []).append(c)
+            else:
+                out[:, :, c] = img
+
+        for channels in missing.values():
+            start = 0
+            for n in _groups(len(channels)):
+                group = channels[start : start + n]
+                start += n
+
+                resized = _resize_group([self.native[bands[c]] for c in group], size)
+
+                for i, c in enumerate(group):
+                    img = resized[:, :, i]
+                    _put((self.in_path, bands[c], size), img)
+                    out[:, :, c] = img
+
+        return out
+
+    def pyramid(
+        self,
+        inputs: typing.List[typing.Tuple[typing.List[str], typing.Tuple[int, int]]],
+    ) -> typing.List[np.ndarray]:
+        """loads the bands of every (bands, size) in inputs as an (height,
+        width, bands) array resized to size (width, height), from a pyramid
+        of box filtered bands"""
+        # how often every band is halved, for the smallest size it is used at
+        levels: typing.Dict[str, int] = {}
+        for bands, size in inputs:
+            for b in bands:
+                levels[b] = max(levels.get(b, 0), _levels(self._native(b).shape, size))
+
+        # every level of every band, starting with the native one
+        pyramid = {b: [self.native[b]] for b in levels}
+
+        with fnlib.timing.phase("preprocess"):
+            by_shape: typing.Dict[typing.Tuple[int, ...], typing.List[str]] = {}
+            for b, n in levels.items():
+                if n > 0:
+                    by_shape.setdefault(self.native[b].shape, []).append(b)
+
+            for bands in by_shape.values():
+                stack = np.stack([self.native[b] for b in bands])
+
+                level = 1
+                while len(bands) > 0:
+                    stack = _halve(stack)
+                    for i, b in enumerate(bands):
+                        pyramid[b].append(stack[i])
+
+                    # only keep halving the bands that need more levels
+                    keep = [i for i, b in enumerate(bands) if levels[b] > level]
+                    if len(keep) < len(bands):
+                        stack = stack[keep]
+                        bands = [bands[i] for i in keep]
+
+                    level += 1
+
+        loaded = []
+        for bands, size in inputs:
+            out = np.empty((size[1], size[0], len(bands)), dtype=np.uint8)
+            imgs = [pyramid[b][_levels(self.native[b].shape, size)] for b in bands]
+
+            # bands to resize, by the shape of the level we resize them from
+            todo: typing.Dict[typing.Tuple[int, ...], typing.List[int]] = {}
+
+            for c, img in enumerate(imgs):
+                if (img.shape[1], img.shape[0]) == size:
+                    out[:, :, c] = img
+                else:
+                    todo.setdefault(img.shape, []).append(c)
+
+            for channels in todo.values():
+                start = 0
+                for n in _groups(len(channels)):
+                    group = channels[start : start + n]
+                    start += n
+
+                    out[:, :, group] = _resize_group([imgs[c] for c in group], size)
+
+            loaded.append(out)
+
+        return loaded
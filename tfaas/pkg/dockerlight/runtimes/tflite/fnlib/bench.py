@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import importlib
+import os
+import sys
+import time
+import tracemalloc
+import typing
+
+import numpy as np
+
+import fnlib.bands
+import fnlib.inference
+
+# Benchmark of the preprocessing of a function: loading its model input from
+# decoded bands (load_model_input in fn.py) and writing a batch of it into
+# the input tensor of its model. Run
+#
+#   python3 -m fnlib.bench in_path [n] [batch]
+#
+# in the function directory. It compares the way we used to preprocess with
+# how we do it now, and prints the mean time and the peak memory allocated
+# through Python and numpy (tracemalloc) of an iteration. Decoding the bands
+# is not part of it.
+#
+#   load   every band resized as its own PIL image and stacked with np.dstack,
+#          against scene.load
+#   input  the batch stacked with np.stack, converted with astype(np.float32)
+#          / 255 and copied into the input tensor with set_tensor, against
+#          set_input writing the uint8 images into the tensor directly. Only
+#          float models had the old path.
+
+
+class _perband(fnlib.bands.scene):
+    # the scene as it was: every band resized on its own, then stacked
+    def load(
+        self,
+        bands: typing.List[str],
+        size: typing.Tuple[int, int],
+        out: typing.Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        return np.dstack([self.band(b, size) for b in bands])
+
+
+def _run(f: typing.Callable[[], typing.Any], n: int) -> typing.Tuple[float, int]:
+    # mean seconds and peak traced bytes of n calls of f
+    f()
+
+    peak = 0
+    t = time.perf_counter()
+
+    for _ in range(n):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        f()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+
+    return (time.perf_counter() - t) / n, peak
+
+
+def _report(
+    name: str, before: typing.Tuple[float, int], after: typing.Tuple[float, int]
+) -> None:
+    print(
+        f"{name:6} before {before[0] * 1000:8.2f}ms {before[1] / 1024:9.1f}KiB   "
+        f"after {after[0] * 1000:8.2f}ms {after[1] / 1024:9.1f}KiB"
+    )
+
+
+def bench(fn: typing.Any, in_path: str, n: int, batch: int) -> None:
+    # decode the bands the function needs once, every iteration resizes them
+    decoded = fnlib.bands.scene(in_path)
+    img = fn.load_model_input(decoded)
+
+    def load(cls: typing.Type[fnlib.bands.scene]) -> typing.Callable[[], typing.Any]:
+        def f() -> typing.Any:
+            fnlib.bands._forget(in_path)
+            s = cls(in_path)
+            s.native = dict(decoded.native)
+            return fn.load_model_input(s)
+
+        return f
+
+    tracemalloc.start()
+
+    _report("load", _run(load(_perband), n), _run(load(fnlib.bands.scene), n))
+
+    if not isinstance(img, np.ndarray) or not hasattr(fn, "model"):
+        print("input  skipped: the model input is not a single image")
+        return
+
+    m = fn.model()
+    m.resize(batch)
+    detail = m.input_details[0]
+
+    if detail["dtype"] != np.float32:
+        print("input  skipped: the model is quantized")
+        return
+
+    def before() -> None:
+        imgs = np.stack([img] * batch).astype(np.float32) / 255.0
+        m.interpreter.set_tensor(detail["index"], imgs)
+
+    def after() -> None:
+        fnlib.inference.set_input(m.interpreter, detail, [img] * batch)
+
+    _report("input", _run(before, n), _run(after, n))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 -m fnlib.bench in_path [n] [batch]")
+        sys.exit(1)
+
+    in_path = sys.argv[1]
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    batch = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+
+    sys.path.insert(0, os.getcwd())
+    fn = importlib.import_module("fn")
+
+    print(f"{n} iterations, batch of {batch}")
+    bench(fn, in_path, n, batch)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import contextlib
+import os
+import time
+import typing
+
+import numpy as np
+
+import fnlib.bands
+import fnlib.manifest
+import fnlib.metrics
+
+# A two-stage cascade: a cheap spectral index on a downsampled scene decides
+# if running the full model is worth it. Functions configure it in the
+# "cascade" section of their manifest:
+#
+#   enabled          run the first stage (default false, TFAAS_CASCADE=1
+#                    enables it as well)
+#   index            "nbr" (burn ratio from B8A and B12, candidates below the
+#                    threshold) or "ndwi" (water index from B03 and B08,
+#                    candidates above the threshold)
+#   size             [width, height] the bands are downsampled to (default
+#                    [64, 64])
+#   pixel_threshold  index value that makes a pixel a candidate (default 0)
+#   min_fraction     share of candidate pixels a scene needs to pass
+#                    (default 0.001)
+#
+# Both stages record into fnlib.metrics, so /metrics of the runtime has them
+# across all workers: how many scenes the first stage passed and rejected,
+# and histograms of the time of each stage.
+
+# the two bands of a normalized difference index, and whether candidates
+# lie above or below the threshold
+INDICES = {
+    "nbr": ("B8A", "B12", False),
+    "ndwi": ("B03", "B08", True),
+}
+
+
+class cascade:
+    def __init__(self, config: typing.Dict[str, typing.Any]) -> None:
+        enabled = os.environ.get("TFAAS_CASCADE", str(config.get("enabled", False)))
+        self.enabled = enabled.lower() in ("1", "true", "yes", "on")
+
+        self.index = str(config.get("index", "nbr"))
+        if self.index not in INDICES:
+            raise ValueError(f"Invalid cascade index: {self.index}")
+
+        self.size = tuple(config.get("size", [64, 64]))
+        self.pixel_threshold = float(config.get("pixel_threshold", 0.0))
+        self.min_fraction = float(config.get("min_fraction", 0.001))
+
+    def candidates(self, s: fnlib.bands.scene) -> float:
+        """returns the share of candidate pixels in the scene s"""
+        a_band, b_band, above = INDICES[self.index]
+        a = s.band(a_band, self.size).astype(np.float32)
+        b = s.band(b_band, self.size).astype(np.float32)
+
+        index = (a - b) / np.maximum(a + b, 1.0)
+
+        if above:
+            return float(np.mean(index > self.pixel_threshold))
+
+        return float(np.mean(index < self.pixel_threshold))
+
+    def screen(self, s: fnlib.bands.scene) -> bool:
+        """first stage: returns True if the full model should run"""
+        if not self.enabled:
+            return True
+
+        t = time.perf_counter()
+        fraction = self.candidates(s)
+        ok = fraction >= self.min_fraction
+        t = time.perf_counter() - t
+
+        outcome = "pass" if ok else "reject"
+        fnlib.metrics.inc("tfaas_cascade_screened_total", outcome=outcome)
+        fnlib.metrics.observe("tfaas_cascade_stage_duration_seconds", t, stage="1")
+
+        print(
+            f"cascade {self.index}: {fraction:.4f} candidates, "
+            f"{outcome} in {t * 1000:.1f}ms"
+        )
+
+        return ok
+
+    @contextlib.contextmanager
+    def stage2(self, n: int = 1) -> typing.Iterator[None]:
+        """times the full model on n images"""
+        if not self.enabled:
+            yield
+            return
+
+        t = time.perf_counter()
+        yield
+        t = time.perf_counter() - t
+
+        fnlib.metrics.observe("tfaas_cascade_stage_duration_seconds", t, stage="2")
+        fnlib.metrics.inc("tfaas_cascade_full_model_images_total", n)
+
+        print(f"cascade full model: {t * 1000:.1f}ms for {n} images")
+
+
+def load() -> cascade:
+    """returns the cascade declared in the manifest of this function"""
+    return cascade(fnlib.manifest.get("cascade"))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+import sys
+import typing
+
+import numpy as np
+
+import fnlib.bands
+import fnlib.inference
+
+# Compares the quantized variant of a function's model against its float
+# model on the same acquisitions. Run it in the directory of the function:
+#
+#   cd fns/<fn> && python3 -m fnlib.drift ../../containers/example
+#
+# fn.py must have a model class with an infer(imgs) method that returns the
+# raw model output and a load_model_input(scene) function.
+
+VARIANT = os.environ.get("TFAAS_DRIFT_VARIANT", "int8")
+# largest allowed mean absolute difference between the outputs
+MAX_MEAN_DRIFT = float(os.environ.get("TFAAS_DRIFT_MAX_MEAN", "0.02"))
+# smallest allowed share of equal argmax predictions (for multi-class outputs)
+MIN_AGREEMENT = float(os.environ.get("TFAAS_DRIFT_MIN_AGREEMENT", "0.95"))
+
+
+def outputs(fn: typing.Any, variant: str, imgs: typing.List[typing.Any]) -> np.ndarray:
+    fnlib.inference.MODEL_VARIANT = variant
+    m = fn.model()
+    return np.array(m.infer(imgs), dtype=np.float32)
+
+
+def compare(reference: np.ndarray, quantized: np.ndarray) -> typing.Dict[str, float]:
+    diff = np.abs(reference - quantized)
+
+    d = {
+        "max_drift": float(diff.max()),
+        "mean_drift": float(diff.mean()),
+    }
+
+    if reference.shape[-1] > 1:
+        d["agreement"] = float(
+            np.mean(np.argmax(reference, axis=-1) == np.argmax(quantized, axis=-1))
+        )
+
+    return d
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        raise ValueError("usage: python3 -m fnlib.drift <in_path>...")
+
+    if len(glob.glob(f"*.{VARIANT}.tflite")) == 0:
+        raise FileNotFoundError(f"no {VARIANT} model variant in {os.getcwd()}")
+
+    sys.path.insert(0, os.getcwd())
+    import fn  # type: ignore
+
+    ok = True
+
+    for in_path in sys.argv[1:]:
+        imgs = [fn.load_model_input(fnlib.bands.scene(in_path))]
+
+        reference = outputs(fn, "float", imgs)
+        quantized = outputs(fn, VARIANT, imgs)
+
+        d = compare(reference, quantized)
+        print(f"{in_path}: {d}")
+
+        if d["mean_drift"] > MAX_MEAN_DRIFT:
+            print(f"{in_path}: mean drift above {MAX_MEAN_DRIFT}")
+            ok = False
+
+        if d.get("agreement", 1.0) < MIN_AGREEMENT:
+            print(f"{in_path}: agreement below {MIN_AGREEMENT}")
+            ok = False
+
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import os
+import time
+import typing
+
+import numpy as np
+from PIL import Image
+
+import fnlib.manifest
+import fnlib.metrics
+import fnlib.timing
+
+# Encoders for function results. The format is set in the "output" section of
+# the function manifest or with TFAAS_OUTPUT_FORMAT:
+#
+#   npy     uncompressed .npy (default)
+#   npz     deflate-compressed .npz with the result in "img"
+#   zstd    .npy in a zstd frame (needs zstandard)
+#   lz4     .npy in an lz4 frame (needs lz4)
+#   png     uint8 bands stacked vertically into one grayscale PNG, with the
+#           original shape in the "shape" text chunk
+#   tiff    uint8 bands as pages of a deflate-compressed TIFF, with the
+#           original shape in the image description
+#   packed  every channel bit-packed to the bits its largest value needs
+#           (e.g., 3 bits for a class mask), in a deflate-compressed .npz
+#
+# TFAAS_OUTPUT_LEVEL (or "level") sets the compression level where a format
+# has one. Every encoded result is logged with its size and encode time, and
+# load decodes all formats again on the ground.
+#
+# A result can carry metadata, a dict of strings that load_meta returns on
+# the ground. It is stored as JSON in the "meta" text chunk of a PNG, in a
+# private tag of a TIFF, as a "meta" array in .npz archives, and as a second
+# array after the image in .npy streams, which np.load of the file ignores.
+# Results without metadata are encoded exactly as before.
+
+FORMATS = ["npy", "npz", "zstd", "lz4", "png", "tiff", "packed"]
+
+_output = fnlib.manifest.get("output")
+FORMAT = os.environ.get("TFAAS_OUTPUT_FORMAT", str(_output.get("format", "npy")))
+LEVEL = int(os.environ.get("TFAAS_OUTPUT_LEVEL", str(_output.get("level", 6))))
+
+if FORMAT not in FORMATS:
+    raise ValueError(f"Invalid output format: {FORMAT}")
+
+
+# private TIFF tag for the metadata of a result
+_TIFF_META_TAG = 65000
+
+Meta = typing.Dict[str, str]
+
+
+def _meta(meta: Meta) -> np.ndarray:
+    # metadata as a unicode array, which np.load reads without pickle
+    return np.array(json.dumps(meta, sort_keys=True))
+
+
+def _npy(img: np.ndarray, meta: Meta) -> bytes:
+    buf = io.BytesIO()
+    _encode_npy(img, buf, meta)
+    return buf.getvalue()
+
+
+def _bands(img: np.ndarray) -> np.ndarray:
+    # (height, width, bands) view of a uint8 image
+    if img.dtype != np.uint8:
+        raise ValueError(f"cannot encode {img.dtype} as an image, only uint8")
+
+    if img.ndim == 2:
+        return img[:, :, np.newaxis]
+
+    if img.ndim != 3:
+        raise ValueError(f"cannot encode {img.ndim} dimensions as an image")
+
+    return img
+
+
+def _encode_npy(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    np.save(f, img)
+    if meta:
+        np.save(f, _meta(meta))
+
+
+def _encode_npz(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    extra = {"meta": _meta(meta)} if meta else {}
+    np.savez_compressed(f, img=img, **extra)
+
+
+def _encode_zstd(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    import zstandard
+
+    f.write(zstandard.ZstdCompressor(level=LEVEL).compress(_npy(img, meta)))
+
+
+def _encode_lz4(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    import lz4.frame
+
+    f.write(lz4.frame.compress(_npy(img, meta), compression_level=LEVEL))
+
+
+def _encode_png(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    bands = _bands(img)
+
+    from PIL import PngImagePlugin
+
+    info = PngImagePlugin.PngInfo()
+    info.add_text("shape", json.dumps(list(img.shape)))
+    if meta:
+        info.add_text("meta", json.dumps(meta, sort_keys=True))
+
+    # band-major, so every band is a contiguous block of rows
+    stacked = np.ascontiguousarray(bands.transpose(2, 0, 1)).reshape(-1, bands.shape[1])
+    Image.fromarray(stacked).save(f, format="PNG", compress_level=LEVEL, pnginfo=info)
+
+
+def _encode_tiff(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    bands = _bands(img)
+    pages = [
+        Image.fromarray(np.ascontiguousarray(bands[:, :, b]))
+        for b in range(bands.shape[2])
+    ]
+
+    extra = {}
+    if meta:
+        from PIL import TiffImagePlugin
+
+        info = TiffImagePlugin.ImageFileDirectory_v2()
+        info[_TIFF_META_TAG] = json.dumps(meta, sort_keys=True)
+        extra["tiffinfo"] = info
+
+    pages[0].save(
+        f,
+        format="TIFF",
+        compression="tiff_adobe_deflate",
+        description=json.dumps(list(img.shape)),
+        save_all=True,
+        append_images=pages[1:],
+        **extra,
+    )
+
+
+def _encode_packed(img: np.ndarray, f: typing.BinaryIO, meta: Meta) -> None:
+    bands = _bands(img)
+
+    channels = {}
+    bits = []
+    for b in range(bands.shape[2]):
+        c = bands[:, :, b]
+        n = max(int(c.max()).bit_length(), 1)
+        bits.append(n)
+
+        # the lowest n bits of every value, most significant bit first
+        unpacked = np.unpackbits(c.reshape(-1, 1), axis=1)[:, 8 - n :]
+        channels[f"c{b}"] = np.packbits(unpacked)
+
+    if meta:
+        channels["meta"] = _meta(meta)
+
+    np.savez_compressed(
+        f, shape=np.array(img.shape), bits=np.array(bits, dtype=np.uint8), **channels
+    )
+
+
+_ENCODERS: typing.Dict[
+    str, typing.Callable[[np.ndarray, typing.BinaryIO, Meta], None]
+] = {
+    "npy": _encode_npy,
+    "npz": _encode_npz,
+    "zstd": _encode_zstd,
+    "lz4": _encode_lz4,
+    "png": _encode_png,
+    "tiff": _encode_tiff,
+    "packed": _encode_packed,
+}
+
+
+def save(
+    out_writer: typing.BinaryIO,
+    img: np.ndarray,
+    fmt: str = "",
+    meta: typing.Optional[Meta] = None,
+) -> None:
+    """encodes img and its metadata, if any, in the configured format (or
+    fmt) and writes it to out_writer"""
+    fmt = fmt or FORMAT
+
+    t = time.perf_counter()
+    buf = io.BytesIO()
+    _ENCODERS[fmt](img, buf, meta or {})
+    data = buf.getvalue()
+    t = time.perf_counter() - t
+    fnlib.timing.add("encode", t)
+    fnlib.metrics.inc("tfaas_bytes_written_total", len(data), format=fmt)
+
+    with fnlib.timing.phase("write"):
+        out_writer.write(data)
+
+    print(
+        f"encoded {img.shape} {img.dtype} as {fmt}: {img.nbytes} -> {len(data)} "
+        f"bytes ({len(data) / max(img.nbytes, 1):.2f}) in {t * 1000:.1f}ms"
+    )
+
+
+def _decode_packed(z: typing.Any) -> np.ndarray:
+    shape = tuple(z["shape"])
+    bits = z["bits"]
+    pixels = int(np.prod(shape[:2]))
+
+    bands = np.empty((*shape[:2], len(bits)), dtype=np.uint8)
+    for b, n in enumerate(bits):
+        unpacked = np.unpackbits(z[f"c{b}"])[: pixels * n].reshape(-1, n)
+        padded = np.zeros((pixels, 8), dtype=np.uint8)
+        padded[:, 8 - n :] = unpacked
+        bands[:, :, b] = np.packbits(padded, axis=1).reshape(shape[:2])
+
+    return bands.reshape(shape)
+
+
+def load(f: typing.BinaryIO, fmt: str) -> np.ndarray:
+    """decodes a result in format fmt"""
+    if fmt == "npy":
+        return np.load(f)
+
+    if fmt == "npz":
+        return np.load(f)["img"]
+
+    if fmt == "zstd":
+        import zstandard
+
+        return np.load(
+            io.BytesIO(
+                zstandard.ZstdDecompressor().decompressobj().decompress(f.read())
+            )
+        )
+
+    if fmt == "lz4":
+        import lz4.frame
+
+        return np.load(io.BytesIO(lz4.frame.decompress(f.read())))
+
+    if fmt == "png":
+        png = Image.open(f)
+        shape = json.loads(png.text["shape"])
+        bands = np.array(png).reshape(-1, *shape[:2]).transpose(1, 2, 0)
+        return bands.reshape(shape)
+
+    if fmt == "tiff":
+        tiff = Image.open(f)
+        shape = json.loads(tiff.tag_v2[270])
+        pages = []
+        for p in range(tiff.n_frames):
+            tiff.seek(p)
+            pages.append(np.array(tiff))
+        return np.dstack(pages).reshape(shape)
+
+    if fmt == "packed":
+        return _decode_packed(np.load(f))
+
+    raise ValueError(f"Invalid output format: {fmt}")
+
+
+def _npy_meta(f: typing.BinaryIO) -> Meta:
+    # the array after the image, if there is one
+    np.load(f)
+    try:
+        return json.loads(str(np.load(f)))
+    except (EOFError, ValueError):
+        return {}
+
+
+def load_meta(f: typing.BinaryIO, fmt: str) -> Meta:
+    """decodes the metadata of a result in format fmt, {} if it has none"""
+    if fmt == "npy":
+        return _npy_meta(f)
+
+    if fmt in ("npz", "packed"):
+        z = np.load(f)
+        return json.loads(str(z["meta"])) if "meta" in z else {}
+
+    if fmt == "zstd":
+        import zstandard
+
+        return _npy_meta(
+            io.BytesIO(
+                zstandard.ZstdDecompressor().decompressobj().decompress(f.read())
+            )
+        )
+
+    if fmt == "lz4":
+        import lz4.frame
+
+        return _npy_meta(io.BytesIO(lz4.frame.decompress(f.read())))
+
+    if fmt == "png":
+        return json.loads(Image.open(f).text.get("meta", "{}"))
+
+    if fmt == "tiff":
+        return json.loads(Image.open(f).tag_v2.get(_TIFF_META_TAG, "{}"))
+
+    raise ValueError(f"Invalid output format: {fmt}")
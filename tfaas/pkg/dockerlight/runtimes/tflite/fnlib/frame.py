@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import sys
+import typing
+
+import numpy as np
+from PIL import Image
+
+# A binary request frame that carries an acquisition inline instead of a path
+# on the /input mount. All numbers are little endian:
+#
+#   header  magic "TFF1", lat, lon, alt, clouds (float64), sunlit (uint8),
+#           number of bands (uint16)
+#   band    name (4 bytes, ASCII, padded with NUL), height, width (uint32),
+#           followed by height * width bytes of uint8 band data
+#
+# A frame can be read from a stream without buffering the entire request.
+
+MAGIC = b"TFF1"
+CONTENT_TYPE = "application/x-tfaas-frame"
+
+HEADER = struct.Struct("<4sddddBH")
+BAND = struct.Struct("<4sII")
+
+
+def encode(
+    i: typing.Dict[str, typing.Any], bands: typing.Dict[str, np.ndarray]
+) -> bytes:
+    """encodes the request metadata i and the uint8 bands into a frame"""
+    parts = [
+        HEADER.pack(
+            MAGIC,
+            i["lat"],
+            i["lon"],
+            i["alt"],
+            i["clouds"],
+            1 if i["sunlit"] else 0,
+            len(bands),
+        )
+    ]
+
+    for name, b in bands.items():
+        if b.dtype != np.uint8 or b.ndim != 2:
+            raise ValueError(f"band {name} is not a 2D uint8 array")
+
+        parts.append(BAND.pack(name.encode("ascii"), b.shape[0], b.shape[1]))
+        parts.append(np.ascontiguousarray(b).tobytes())
+
+    return b"".join(parts)
+
+
+class reader:
+    """reads from f, but never more than limit bytes in total"""
+
+    def __init__(self, f: typing.BinaryIO, limit: int) -> None:
+        self.f = f
+        self.limit = limit
+        self.n = 0
+
+    def read(self, n: int) -> bytes:
+        if self.n + n > self.limit:
+            raise ValueError(
+                f"truncated frame: expected {n} bytes, {self.limit - self.n} left"
+            )
+
+        data = self.f.read(n)
+        self.n += len(data)
+
+        if len(data) != n:
+            raise ValueError(f"truncated frame: expected {n} bytes, got {len(data)}")
+
+        return data
+
+
+def read(
+    r: reader,
+) -> typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, np.ndarray]]:
+    """reads a frame, returns the request metadata and the bands"""
+    magic, lat, lon, alt, clouds, sunlit, n = HEADER.unpack(r.read(HEADER.size))
+
+    if magic != MAGIC:
+        raise ValueError(f"invalid frame magic {magic!r}")
+
+    i = {"lat": lat, "lon": lon, "alt": alt, "clouds": clouds, "sunlit": sunlit == 1}
+
+    bands = {}
+    for _ in range(n):
+        name, height, width = BAND.unpack(r.read(BAND.size))
+        data = r.read(height * width)
+        bands[name.rstrip(b"\0").decode("ascii")] = np.frombuffer(
+            data, dtype=np.uint8
+        ).reshape(height, width)
+
+    if r.n != r.limit:
+        raise ValueError(f"frame of {r.n} bytes in {r.limit} byte body")
+
+    return i, bands
+
+
+if __name__ == "__main__":
+    # frame an acquisition directory for testing:
+    # python3 -m fnlib.frame <in_path> <lat> <lon> <alt> <clouds> <sunlit> > frame
+    in_path = sys.argv[1]
+    i = {
+        "lat": float(sys.argv[2]),
+        "lon": float(sys.argv[3]),
+        "alt": float(sys.argv[4]),
+        "clouds": float(sys.argv[5]),
+        "sunlit": sys.argv[6].lower() in ("1", "true"),
+    }
+
+    bands = {
+        os.path.splitext(b)[0]: np.array(Image.open(os.path.join(in_path, b)))
+        for b in sorted(os.listdir(in_path))
+        if b.endswith(".tiff")
+    }
+
+    sys.stdout.buffer.write(encode(i, bands))
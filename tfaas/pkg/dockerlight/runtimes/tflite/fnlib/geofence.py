@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+
+import json
+import math
+import os
+import sys
+import time
+import typing
+
+import numpy as np
+
+import fnlib.manifest
+
+# Point-in-polygon index for regions of interest, so the runtime can tell
+# whether an acquisition is in a region of a function before it touches any
+# image data. Regions are polygons, given as lists of [lon, lat] points or
+# read from GeoJSON files (Polygon and MultiPolygon geometries, also in
+# Features, FeatureCollections and GeometryCollections, holes included).
+#
+# A geofence is compiled once into a grid of cells over the bounding box of
+# all polygons. Every cell is either completely inside a polygon, completely
+# outside all of them, or crossed by an edge of some polygons. For a point in
+# the last kind of cell we only look at the edges that cross its cell: the
+# point is in a polygon if the center of the cell is and the way from the
+# point to the center crosses an even number of them. Points on an edge, up
+# to EPSILON degrees away, are in its polygon. Every polygon is only
+# rasterized within its own bounding box, so compiling many small polygons
+# takes time and memory for their cells, not for the whole grid each. The
+# size of a cell in degrees comes from the "geofence" section of the function
+# manifest:
+#
+#   cell  TFAAS_GEOFENCE_CELL  size of a grid cell in degrees (default 0.1)
+#
+# To compare lookups in the grid with ray casting against every polygon, run
+#
+#   python3 -m fnlib.geofence path.geojson [n]
+#
+# which prints the time to compile the geofence and the mean time of a
+# lookup of n random points in the bounding box of its polygons.
+
+# a polygon is its outer ring followed by its holes, every ring a list of
+# (lon, lat) points
+Ring = typing.List[typing.Tuple[float, float]]
+Polygon = typing.List[Ring]
+
+OUTSIDE = 0
+INSIDE = 1
+EDGE = 2
+
+# how far in degrees a point on the boundary of a polygon may be from its
+# edge and still be in it (about 0.1mm)
+EPSILON = 1e-9
+
+
+def _setting(key: str, env: str, default: typing.Any) -> typing.Any:
+    if env in os.environ:
+        return os.environ[env]
+
+    return fnlib.manifest.get("geofence").get(key, default)
+
+
+CELL = float(_setting("cell", "TFAAS_GEOFENCE_CELL", 0.1))
+
+if CELL <= 0:
+    raise ValueError(f"Invalid geofence cell size: {CELL}")
+
+
+def _ring(points: typing.List[typing.List[float]]) -> Ring:
+    r = [(float(p[0]), float(p[1])) for p in points]
+
+    if len(r) < 3:
+        raise ValueError(f"invalid geofence ring with {len(r)} points")
+
+    return r
+
+
+def _geometries(g: typing.Dict[str, typing.Any]) -> typing.Iterator[Polygon]:
+    t = g.get("type")
+
+    if t == "FeatureCollection":
+        for f in g["features"]:
+            yield from _geometries(f)
+    elif t == "Feature":
+        if g.get("geometry") is not None:
+            yield from _geometries(g["geometry"])
+    elif t == "GeometryCollection":
+        for c in g["geometries"]:
+            yield from _geometries(c)
+    elif t == "Polygon":
+        yield [_ring(r) for r in g["coordinates"]]
+    elif t == "MultiPolygon":
+        for p in g["coordinates"]:
+            yield [_ring(r) for r in p]
+    else:
+        raise ValueError(f"unsupported GeoJSON type {t}")
+
+
+def read(path: str) -> typing.List[Polygon]:
+    """returns the polygons in the GeoJSON file at path"""
+    with open(path, "r") as f:
+        return list(_geometries(json.load(f)))
+
+
+def in_polygon(lon: float, lat: float, polygon: Polygon) -> bool:
+    """returns whether the point is inside polygon, but not in one of its
+    holes"""
+    # ray casting: count the edges of all rings that a ray going east from
+    # the point crosses
+    inside = False
+
+    for ring in polygon:
+        j = len(ring) - 1
+        for i in range(len(ring)):
+            lon_i, lat_i = ring[i]
+            lon_j, lat_j = ring[j]
+
+            if _on_edge(lon, lat, (lon_i, lat_i, lon_j, lat_j)):
+                return True
+
+            if (lat_i > lat) != (lat_j > lat):
+                cross = lon_i + (lat - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+                if lon < cross:
+                    inside = not inside
+
+            j = i
+
+    return inside
+
+
+def _on_edge(
+    lon: float, lat: float, edge: typing.Tuple[float, float, float, float]
+) -> bool:
+    # whether the point is at most EPSILON away from edge
+    lon_a, lat_a, lon_b, lat_b = edge
+    e_lon, e_lat = lon_b - lon_a, lat_b - lat_a
+
+    length = e_lon * e_lon + e_lat * e_lat
+    t = 0.0
+    if length > 0:
+        t = ((lon - lon_a) * e_lon + (lat - lat_a) * e_lat) / length
+        t = min(max(t, 0.0), 1.0)
+
+    d_lon = lon_a + t * e_lon - lon
+    d_lat = lat_a + t * e_lat - lat
+
+    return d_lon * d_lon + d_lat * d_lat <= EPSILON * EPSILON
+
+
+def _crosses(
+    lon: float,
+    lat: float,
+    to_lon: float,
+    to_lat: float,
+    edge: typing.Tuple[float, float, float, float],
+) -> bool:
+    # whether the segment from the point to (to_lon, to_lat) crosses edge,
+    # with both ends of edge on opposite sides of it and the other way round
+    lon_a, lat_a, lon_b, lat_b = edge
+    d_lon, d_lat = to_lon - lon, to_lat - lat
+
+    side_a = d_lon * (lat_a - lat) - d_lat * (lon_a - lon) > 0
+    side_b = d_lon * (lat_b - lat) - d_lat * (lon_b - lon) > 0
+    if side_a == side_b:
+        return False
+
+    e_lon, e_lat = lon_b - lon_a, lat_b - lat_a
+    side_p = e_lon * (lat - lat_a) - e_lat * (lon - lon_a) > 0
+    side_c = e_lon * (to_lat - lat_a) - e_lat * (to_lon - lon_a) > 0
+
+    return side_p != side_c
+
+
+class geofence:
+    def __init__(self, polygons: typing.List[Polygon], cell: float = 0.0) -> None:
+        self.polygons = polygons
+        self.cell = cell or CELL
+
+        if len(polygons) == 0:
+            raise ValueError("cannot make a geofence without polygons")
+
+        points = np.array([p for poly in polygons for r in poly for p in r])
+        self.min_lon, self.min_lat = points.min(axis=0).tolist()
+        self.max_lon, self.max_lat = points.max(axis=0).tolist()
+
+        self.cols = max(math.ceil((self.max_lon - self.min_lon) / self.cell), 1)
+        self.rows = max(math.ceil((self.max_lat - self.min_lat) / self.cell), 1)
+
+        inside = np.zeros((self.rows, self.cols), dtype=bool)
+        edges = np.zeros((self.rows, self.cols), dtype=bool)
+
+        # every edge of every polygon as (lon_a, lat_a, lon_b, lat_b), the
+        # cells each of them may cross, and whether the center of each of
+        # those cells is in the polygon of the edge
+        segments: typing.List[np.ndarray] = []
+        crossed: typing.List[np.ndarray] = []
+        centers: typing.List[np.ndarray] = []
+
+        for poly in polygons:
+            s = np.concatenate(
+                [np.hstack([r, np.roll(r, -1, axis=0)]) for r in map(np.array, poly)]
+            )
+            c = [self._crossed(e) for e in s]
+            cells = np.concatenate(c)
+            row, col = cells // self.cols, cells % self.cols
+
+            # the cells the edges cross include the cells of all vertices, so
+            # they span every cell whose center can be in the polygon
+            rows = slice(int(row.min()), int(row.max()) + 1)
+            cols = slice(int(col.min()), int(col.max()) + 1)
+            row, col = row - rows.start, col - cols.start
+
+            center = self._inside(s, rows, cols)
+
+            e = np.zeros_like(center)
+            e[row, col] = True
+
+            inside[rows, cols] |= center & ~e
+            edges[rows, cols] |= e
+            segments.append(s)
+            crossed.extend(c)
+            centers.append(center[row, col])
+
+        # a cell that is inside one polygon is inside the geofence, even if
+        # the edge of another polygon crosses it
+        edges &= ~inside
+
+        self.grid = np.full((self.rows, self.cols), OUTSIDE, dtype=np.uint8)
+        self.grid[inside] = INSIDE
+        self.grid[edges] = EDGE
+
+        # for every edge cell, keep the polygons that cross it, whether its
+        # center is in each of them, and their edges that cross the cell, in
+        # flat lists
+        edge_cells = np.flatnonzero(edges)
+        self.index = np.full(self.rows * self.cols, -1, dtype=np.int32)
+        self.index[edge_cells] = np.arange(len(edge_cells), dtype=np.int32)
+
+        poly = np.repeat(np.arange(len(polygons)), [len(s) for s in segments]).repeat(
+            [len(c) for c in crossed]
+        )
+        seg = np.arange(sum(len(s) for s in segments)).repeat([len(c) for c in crossed])
+        cells = np.concatenate(crossed)
+        center = np.concatenate(centers)
+
+        keep = edges.reshape(-1)[cells]
+        poly, seg, cells, center = poly[keep], seg[keep], cells[keep], center[keep]
+
+        # one entry per edge and cell it crosses, by cell and polygon
+        order = np.lexsort((seg, poly, cells))
+        poly, seg, cells, center = poly[order], seg[order], cells[order], center[order]
+
+        # pairs of an edge cell and a polygon that crosses it
+        first = np.flatnonzero(
+            np.r_[True, (cells[1:] != cells[:-1]) | (poly[1:] != poly[:-1])]
+        )
+        self.pairs = np.searchsorted(
+            self.index[cells[first]], np.arange(len(edge_cells) + 1)
+        ).tolist()
+        self.centers = center[first].tolist()
+        self.crossing = np.r_[first, len(seg)].tolist()
+        self.segments = [tuple(s) for s in np.concatenate(segments)[seg].tolist()]
+
+    def _crossed(self, edge: np.ndarray) -> np.ndarray:
+        # the flat index of every cell the edge may cross: it is split into
+        # pieces no longer than a cell, so every piece is within the 2x2
+        # cells around its ends
+        lon_a, lat_a, lon_b, lat_b = edge
+        n = math.ceil(max(abs(lon_b - lon_a), abs(lat_b - lat_a)) / self.cell)
+        t = np.linspace(0.0, 1.0, n + 1)
+
+        col = np.floor((lon_a + t * (lon_b - lon_a) - self.min_lon) / self.cell)
+        row = np.floor((lat_a + t * (lat_b - lat_a) - self.min_lat) / self.cell)
+        col = np.clip(col.astype(np.intp), 0, self.cols - 1)
+        row = np.clip(row.astype(np.intp), 0, self.rows - 1)
+
+        cells = [row * self.cols + col]
+        if n > 0:
+            cells.append(row[:-1] * self.cols + col[1:])
+            cells.append(row[1:] * self.cols + col[:-1])
+
+        return np.unique(np.concatenate(cells))
+
+    def _inside(self, segments: np.ndarray, rows: slice, cols: slice) -> np.ndarray:
+        # whether the center of every cell in rows and cols is in the polygon
+        # with these edges: ray casting for a whole row of cells at once,
+        # from where the edges cross the row
+        lon = self.min_lon + (np.arange(cols.start, cols.stop) + 0.5) * self.cell
+        lat = self.min_lat + (np.arange(rows.start, rows.stop) + 0.5) * self.cell
+
+        lon_a, lat_a, lon_b, lat_b = segments.T
+
+        inside = np.zeros((len(lat), len(lon)), dtype=bool)
+        for y, l in enumerate(lat):
+            e = (lat_a > l) != (lat_b > l)
+            if not e.any():
+                continue
+
+            cross = np.sort(
+                lon_a[e]
+                + (l - lat_a[e]) * (lon_b[e] - lon_a[e]) / (lat_b[e] - lat_a[e])
+            )
+
+            # the number of crossings east of a point is odd if it is inside
+            east = len(cross) - np.searchsorted(cross, lon, side="right")
+            inside[y] = east % 2 == 1
+
+        return inside
+
+    def contains(self, lon: float, lat: float) -> bool:
+        """returns whether the point is in one of the polygons"""
+        if not (
+            self.min_lon <= lon <= self.max_lon and self.min_lat <= lat <= self.max_lat
+        ):
+            return False
+
+        col = min(int((lon - self.min_lon) / self.cell), self.cols - 1)
+        row = min(int((lat - self.min_lat) / self.cell), self.rows - 1)
+
+        state = self.grid[row, col]
+        if state != EDGE:
+            return bool(state == INSIDE)
+
+        center_lon = self.min_lon + (col + 0.5) * self.cell
+        center_lat = self.min_lat + (row + 0.5) * self.cell
+
+        k = self.index[row * self.cols + col]
+        for p in range(self.pairs[k], self.pairs[k + 1]):
+            inside = self.centers[p]
+
+            for e in range(self.crossing[p], self.crossing[p + 1]):
+                if _on_edge(lon, lat, self.segments[e]):
+                    return True
+
+                if _crosses(lon, lat, center_lon, center_lat, self.segments[e]):
+                    inside = not inside
+
+            if inside:
+                return True
+
+        return False
+
+
+def load(paths: typing.List[str], cell: float = 0.0) -> geofence:
+    """returns the geofence of the polygons in the GeoJSON files at paths"""
+    return geofence([p for path in paths for p in read(path)], cell)
+
+
+def _bench(path: str, n: int) -> None:
+    t = time.perf_counter()
+    g = load([path])
+    print(
+        f"compiled {len(g.polygons)} polygons into {g.cols}x{g.rows} cells "
+        f"in {(time.perf_counter() - t) * 1000:.2f}ms, "
+        f"{np.count_nonzero(g.grid == EDGE)} edge cells"
+    )
+
+    rng = np.random.default_rng(0)
+    points = list(
+        zip(
+            rng.uniform(g.min_lon, g.max_lon, n).tolist(),
+            rng.uniform(g.min_lat, g.max_lat, n).tolist(),
+        )
+    )
+
+    def scan(lon: float, lat: float) -> bool:
+        return any(in_polygon(lon, lat, p) for p in g.polygons)
+
+    results = {}
+    for name, f in [("scan", scan), ("grid", g.contains)]:
+        t = time.perf_counter()
+        results[name] = [f(lon, lat) for lon, lat in points]
+        print(f"{name:4} {(time.perf_counter() - t) / n * 1e6:8.2f}us per point")
+
+    differ = sum(a != b for a, b in zip(results["scan"], results["grid"]))
+    print(f"{differ} of {n} points differ")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 -m fnlib.geofence path.geojson [n]")
+        sys.exit(1)
+
+    _bench(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
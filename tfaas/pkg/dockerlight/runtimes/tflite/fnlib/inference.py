@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+import time
+import typing
+
+import numpy as np
+import tflite_runtime.interpreter as tflite
+
+import fnlib.manifest
+import fnlib.mask
+import fnlib.metrics
+import fnlib.timing
+
+# Inference settings for the TFLite interpreters of a function. Every setting
+# comes from the "inference" section of the function manifest and can be
+# overridden with an environment variable:
+#
+#   num_threads  TFAAS_NUM_THREADS    threads per interpreter (default 1)
+#   xnnpack      TFAAS_XNNPACK        use the XNNPACK delegate (default true)
+#   variant      TFAAS_MODEL_VARIANT  load <model>.<variant>.tflite instead
+#                                     of <model>.tflite. "auto" (default)
+#                                     loads <model>.int8.tflite if it exists,
+#                                     "float" always loads <model>.tflite
+#
+# Models take uint8 band data scaled to [0, 1]. set_input writes band data
+# into an input tensor directly, either as float32 or quantized with the
+# parameters of a quantized model, and get_output dequantizes outputs, so
+# functions work the same with float and quantized models.
+#
+# Every invocation is logged with its latency and these settings, so we can
+# compare latency against the power draw reported by measure.go.
+
+
+def _setting(key: str, env: str, default: typing.Any) -> typing.Any:
+    if env in os.environ:
+        return os.environ[env]
+
+    return fnlib.manifest.get("inference").get(key, default)
+
+
+def _bool(v: typing.Any) -> bool:
+    if isinstance(v, str):
+        return v.lower() not in ("0", "false", "no", "off", "")
+
+    return bool(v)
+
+
+NUM_THREADS = int(_setting("num_threads", "TFAAS_NUM_THREADS", 1))
+XNNPACK = _bool(_setting("xnnpack", "TFAAS_XNNPACK", True))
+MODEL_VARIANT = str(_setting("variant", "TFAAS_MODEL_VARIANT", "auto"))
+
+if NUM_THREADS < 1:
+    raise ValueError(f"Invalid number of inference threads: {NUM_THREADS}")
+
+SETTINGS = f"num_threads={NUM_THREADS} xnnpack={XNNPACK} variant={MODEL_VARIANT or '-'}"
+
+
+def model_path(path: str) -> str:
+    """returns the path of the configured variant of the model in path"""
+    if MODEL_VARIANT in ("", "float"):
+        return path
+
+    base, ext = os.path.splitext(path)
+
+    if MODEL_VARIANT == "auto":
+        variant = f"{base}.int8{ext}"
+        return variant if os.path.exists(variant) else path
+
+    variant = f"{base}.{MODEL_VARIANT}{ext}"
+
+    if not os.path.exists(variant):
+        print(f"model variant {variant} not found, using {path}")
+        return path
+
+    return variant
+
+
+# model files read by preload, by path
+_preloaded: typing.Dict[str, bytes] = {}
+# interpreters built by preload, by path. every forked worker takes its copy
+# of them on its first call to interpreter.
+_prebuilt: typing.Dict[str, tflite.Interpreter] = {}
+
+
+def preload() -> None:
+    """reads the configured variant of every model in the working directory
+    and builds an interpreter for it. a process that forks workers calls this
+    first, so that all workers share the model and the weights that XNNPACK
+    packs when the interpreter allocates its tensors copy-on-write.
+
+    with more than one inference thread, the thread pool of an interpreter
+    does not survive a fork, so every worker builds its own interpreter and
+    only the model file is shared."""
+    for f in sorted(glob.glob("*.tflite")):
+        # variants are loaded through their model
+        base = f"{f.split('.')[0]}.tflite"
+        if f != base and os.path.exists(base):
+            continue
+
+        path = model_path(f)
+        with open(path, "rb") as m:
+            _preloaded[path] = m.read()
+
+        print(f"preloaded {path} ({len(_preloaded[path])} bytes)")
+
+        if NUM_THREADS == 1:
+            # allocating the tensors applies the delegates. the tensor arena
+            # is not touched until the first invocation, so the workers do
+            # not share it.
+            i = interpreter(path)
+            i.allocate_tensors()
+            _prebuilt[path] = i
+
+
+def interpreter(path: str) -> tflite.Interpreter:
+    """creates an interpreter for the model in path with the configured
+    settings"""
+    path = model_path(path)
+
+    prebuilt = _prebuilt.pop(path, None)
+    if prebuilt is not None:
+        print(f"using preloaded {path} with {SETTINGS}")
+        return prebuilt
+
+    print(f"loading {path} with {SETTINGS}")
+
+    # the default delegates of the builtin op resolver include XNNPACK
+    resolver = (
+        tflite.OpResolverType.AUTO
+        if XNNPACK
+        else tflite.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+    )
+
+    # the interpreter uses preloaded models in place, without a copy
+    content = _preloaded.get(path)
+    if content is not None:
+        return tflite.Interpreter(
+            model_content=content,
+            num_threads=NUM_THREADS,
+            experimental_op_resolver_type=resolver,
+        )
+
+    return tflite.Interpreter(
+        model_path=path,
+        num_threads=NUM_THREADS,
+        experimental_op_resolver_type=resolver,
+    )
+
+
+def invoke(interpreter: tflite.Interpreter, batch_size: int = 1) -> None:
+    """invokes interpreter and logs the latency of the invocation"""
+    t = time.perf_counter()
+    interpreter.invoke()
+    latency = time.perf_counter() - t
+    fnlib.timing.add("invoke", latency)
+    fnlib.metrics.observe("tfaas_invoke_duration_seconds", latency)
+
+    print(f"inference: {latency * 1000:.1f}ms batch={batch_size} {SETTINGS}")
+
+
+def set_input(
+    interpreter: tflite.Interpreter,
+    detail: typing.Dict[str, typing.Any],
+    img: typing.Union[np.ndarray, typing.Sequence[np.ndarray]],
+) -> None:
+    """writes uint8 band data into the input tensor of detail, scaled to
+    [0, 1] for float models or quantized for quantized models. img is either
+    the whole batch or a list of its images."""
+    with fnlib.timing.phase("preprocess"):
+        # write into the tensor buffer instead of allocating a converted
+        # copy. we must not hold on to the buffer when the interpreter is
+        # invoked.
+        buf = interpreter.tensor(detail["index"])()
+
+        if isinstance(img, np.ndarray):
+            _set_input(buf, detail, img)
+            return
+
+        # a list of images is written image by image, so the batch is
+        # never stacked into a copy of its own
+        if len(img) != buf.shape[0]:
+            raise ValueError(
+                f"input {detail['name']} takes {buf.shape[0]} images, got {len(img)}"
+            )
+
+        for i, im in enumerate(img):
+            _set_input(buf[i], detail, im)
+
+
+def _set_input(
+    buf: np.ndarray,
+    detail: typing.Dict[str, typing.Any],
+    img: np.ndarray,
+) -> None:
+    if np.issubdtype(buf.dtype, np.floating):
+        np.divide(img, np.float32(255.0), out=buf)
+        return
+
+    scale, zero_point = detail["quantization"]
+
+    if scale == 0:
+        raise ValueError(f"input {detail['name']} is not quantized")
+
+    # inputs quantized with a scale of 1/255 take band data as is
+    if abs(scale * 255.0 - 1.0) < 1e-6:
+        if buf.dtype == np.uint8 and zero_point == 0:
+            buf[...] = img
+            return
+
+        if buf.dtype == np.int8 and zero_point == -128:
+            np.subtract(img, 128, out=buf, casting="unsafe")
+            return
+
+    q = np.round(img / np.float32(255.0 * scale)) + zero_point
+    info = np.iinfo(buf.dtype)
+    np.clip(q, info.min, info.max, out=q)
+    buf[...] = q
+
+
+def get_output_argmax(
+    interpreter: tflite.Interpreter,
+    detail: typing.Dict[str, typing.Any],
+    out: typing.Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """returns the index of the largest value along the last axis of the
+    output tensor of detail as a uint8 mask, into out if given. quantization
+    keeps the order of values, so quantized outputs are used as they are."""
+    # the tensor buffer is only read until we return
+    return fnlib.mask.argmax(interpreter.tensor(detail["index"])(), out)
+
+
+def get_output(
+    interpreter: tflite.Interpreter, detail: typing.Dict[str, typing.Any]
+) -> np.ndarray:
+    """returns the output tensor of detail, dequantized to float32 for
+    quantized models"""
+    out = interpreter.get_tensor(detail["index"])
+
+    if np.issubdtype(out.dtype, np.floating):
+        return out
+
+    scale, zero_point = detail["quantization"]
+    return (out.astype(np.float32) - zero_point) * np.float32(scale)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+import typing
+
+# Functions can ship a manifest.json next to their fn.py to configure how the
+# runtime treats them. Every top-level key belongs to one part of fnlib or
+# the runtime, e.g., "inference" for fnlib.inference. A function without a
+# manifest gets the defaults.
+
+MANIFEST_PATH = os.environ.get("TFAAS_MANIFEST", "manifest.json")
+
+_lock = threading.Lock()
+_manifest: typing.Optional[typing.Dict[str, typing.Any]] = None
+
+
+def load() -> typing.Dict[str, typing.Any]:
+    """returns the manifest of this function, or {} if it has none"""
+    global _manifest
+
+    with _lock:
+        if _manifest is not None:
+            return _manifest
+
+        try:
+            with open(MANIFEST_PATH, "r") as f:
+                m = json.load(f)
+        except FileNotFoundError:
+            m = {}
+
+        if not isinstance(m, dict):
+            raise ValueError(f"invalid manifest {MANIFEST_PATH}: not an object")
+
+        _manifest = m
+        return _manifest
+
+
+def get(key: str) -> typing.Dict[str, typing.Any]:
+    """returns the section key of the manifest, or {} if it is not set"""
+    section = load().get(key, {})
+
+    if not isinstance(section, dict):
+        raise ValueError(f"invalid manifest {MANIFEST_PATH}: {key} is not an object")
+
+    return section
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import importlib
+import os
+import sys
+import time
+import typing
+
+import numpy as np
+from PIL import Image
+
+# Class masks from per-pixel class scores, such as the output of a
+# segmentation model. Masks are uint8 from the start: argmax writes into a
+# preallocated mask in chunks of rows, so the only int64 array numpy makes is
+# one chunk. counts compares the mask with every class (or uses bincount)
+# instead of sorting it like np.unique, and downsample keeps the most
+# frequent class of every block of pixels instead of its top-left pixel.
+#
+# To compare this with the argmax, np.unique and strided downsampling we
+# used to do, run
+#
+#   python3 -m fnlib.mask in_path [n]
+#
+# in the directory of a function with a segmentation model. It takes the
+# model output for the acquisition in in_path and prints the median time of
+# both over n runs.
+
+# pixels per argmax chunk
+_CHUNK = 64 * 1024
+
+# up to how many classes counts compares the mask with every class
+_FEW_CLASSES = 16
+
+
+def argmax(scores: np.ndarray, out: typing.Optional[np.ndarray] = None) -> np.ndarray:
+    """returns the index of the largest score along the last axis as uint8,
+    into out if given. ties go to the lower index, as with np.argmax."""
+    n = scores.shape[-1]
+    if n > 256:
+        raise ValueError(f"cannot fit {n} classes into a uint8 mask")
+
+    if out is None:
+        out = np.empty(scores.shape[:-1], dtype=np.uint8)
+    elif not out.flags.c_contiguous:
+        raise ValueError("cannot argmax into a mask that is not contiguous")
+
+    flat = scores.reshape(-1, n)
+    mask = out.reshape(-1)
+
+    for start in range(0, flat.shape[0], _CHUNK):
+        mask[start : start + _CHUNK] = np.argmax(flat[start : start + _CHUNK], axis=-1)
+
+    return out
+
+
+def counts(mask: np.ndarray, n: int) -> np.ndarray:
+    """returns the number of pixels of each of n classes in mask"""
+    # np.bincount converts the mask to intp first, one comparison per class
+    # is several times faster as long as there are only a few classes
+    if n <= _FEW_CLASSES:
+        return np.array([np.count_nonzero(mask == c) for c in range(n)])
+
+    return np.bincount(mask.reshape(-1), minlength=n)
+
+
+def downsample(
+    mask: np.ndarray,
+    size: typing.Tuple[int, int],
+    out: typing.Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """downsamples an (height, width) mask to size (width, height) by an
+    integer factor, into out if given. every pixel is the most frequent class
+    of its block, ties go to the class that comes first in the block, row by
+    row."""
+    height, width = mask.shape
+    w, h = size
+
+    if height % h != 0 or width % w != 0:
+        raise ValueError(f"cannot downsample {width}x{height} to {w}x{h}")
+
+    fy, fx = height // h, width // w
+    if fy * fx > 255:
+        raise ValueError(f"blocks of {fx}x{fy} pixels are too large to count")
+
+    # every pixel of a block, as one (h, w) view per position in the block
+    blocks = [mask[y::fy, x::fx] for y in range(fy) for x in range(fx)]
+
+    # how many pixels of its block have the class of each pixel. comparing
+    # the pixels of a block with each other does not depend on the number of
+    # classes, and every pair is compared once.
+    same = [np.ones((h, w), dtype=np.uint8) for _ in blocks]
+    for i in range(len(blocks)):
+        for j in range(i + 1, len(blocks)):
+            equal = blocks[i] == blocks[j]
+            same[i] += equal
+            same[j] += equal
+
+    if out is None:
+        out = np.empty((h, w), dtype=np.uint8)
+
+    out[...] = blocks[0]
+    best = same[0]
+    for b, n in zip(blocks[1:], same[1:]):
+        np.copyto(out, b, where=n > best)
+        np.maximum(best, n, out=best)
+
+    return out
+
+
+def resize(
+    mask: np.ndarray,
+    size: typing.Tuple[int, int],
+    out: typing.Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """resizes an (height, width) mask to size (width, height), into out if
+    given. masks that are a multiple of size are downsampled, all others take
+    the nearest pixel, as classes cannot be interpolated."""
+    height, width = mask.shape
+    w, h = size
+
+    if out is None:
+        out = np.empty((h, w), dtype=np.uint8)
+
+    if (height, width) == (h, w):
+        out[...] = mask
+    elif height % h == 0 and width % w == 0 and (height // h) * (width // w) <= 255:
+        downsample(mask, size, out)
+    else:
+        out[...] = np.asarray(Image.fromarray(mask).resize(size, Image.NEAREST))
+
+    return out
+
+
+def _bench(fn: typing.Any, in_path: str, n: int) -> None:
+    import fnlib.bands
+    import fnlib.inference
+
+    m = fn.model()
+    m.resize(1)
+    scene = fnlib.bands.scene(in_path)
+
+    fnlib.inference.set_input(
+        m.interpreter, m.input_details[0], [fn.load_model_input(scene)]
+    )
+    m.interpreter.invoke()
+
+    detail = m.output_details[0]
+    _, height, width, classes = detail["shape"]
+    size = fn.SAVE_SIZE
+
+    def before() -> typing.Any:
+        scores = fnlib.inference.get_output(m.interpreter, detail)
+        mask = np.argmax(scores, axis=-1)[0]
+        found = np.unique(mask, return_counts=True)
+        small = mask[:: height // size[1], :: width // size[0]].astype(np.uint8)
+        return found, small
+
+    full = np.empty((height, width), dtype=np.uint8)
+    small = np.empty((size[1], size[0]), dtype=np.uint8)
+
+    def after() -> typing.Any:
+        fnlib.inference.get_output_argmax(m.interpreter, detail, full[np.newaxis])
+        return counts(full, classes), downsample(full, size, small)
+
+    # alternate between both, so neither gets a quieter machine
+    times: typing.Dict[str, typing.List[float]] = {"before": [], "after": []}
+    for _ in range(n):
+        for name, f in [("before", before), ("after", after)]:
+            t = time.perf_counter()
+            f()
+            times[name].append(time.perf_counter() - t)
+
+    for name, t in times.items():
+        print(f"{name:6} {np.median(t) * 1000:8.2f}ms")
+
+    # downsampling by mode is not the same as taking every other pixel
+    changed = np.count_nonzero(before()[1] != after()[1])
+    print(f"{changed} of {small.size} downsampled pixels differ")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 -m fnlib.mask in_path [n]")
+        sys.exit(1)
+
+    sys.path.insert(0, os.getcwd())
+    _bench(
+        importlib.import_module("fn"),
+        sys.argv[1],
+        int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+    )
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import os
+import threading
+import time
+import tracemalloc
+import typing
+
+# Memory accounting and a memory budget for the function container. Workers
+# measure every request: RSS before and after, the peak RSS while it ran
+# (from VmHWM, which we reset before each request), and, with
+# TFAAS_TRACEMALLOC=1, the peak of memory allocated through Python and numpy.
+# In thread mode, the peak RSS is that of the process, so concurrent requests
+# are measured together.
+#
+# With TFAAS_MEMORY_BUDGET set (in bytes, or with a K, M or G suffix), a
+# request is only admitted if the memory of the handler and all workers plus
+# what a request has recently needed on top fits into the budget. Otherwise
+# it is rejected with 503 (TFAAS_MEMORY_POLICY=reject) or waits for up to
+# TFAAS_MEMORY_WAIT seconds for memory to become free (queue).
+#
+# Forked workers share the pages of the model and libraries with the handler
+# copy-on-write. The budget counts the proportional set size (PSS) of every
+# process, which splits a shared page between the processes that map it, so
+# those pages count once in total instead of once per process as with RSS.
+
+POLICIES = ["reject", "queue"]
+
+
+def _bytes(s: str) -> int:
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    s = s.strip().upper().rstrip("B")
+
+    if s[-1:] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+
+    return int(s)
+
+
+BUDGET = _bytes(os.environ.get("TFAAS_MEMORY_BUDGET", "0"))
+POLICY = os.environ.get("TFAAS_MEMORY_POLICY", "reject")
+WAIT = float(os.environ.get("TFAAS_MEMORY_WAIT", "30"))
+TRACEMALLOC = os.environ.get("TFAAS_TRACEMALLOC", "0") == "1"
+
+if POLICY not in POLICIES:
+    raise ValueError(f"Invalid memory policy: {POLICY}")
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# number of recent requests whose memory growth we expect from the next one
+_HISTORY = 16
+
+
+def rss(pid: typing.Optional[int] = None) -> int:
+    """resident memory of process pid (default: this process) in bytes, 0 if
+    it has exited"""
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (FileNotFoundError, ProcessLookupError):
+        return 0
+
+
+_has_rollup = os.path.exists("/proc/self/smaps_rollup")
+
+
+def pss(pid: typing.Optional[int] = None) -> int:
+    """proportional set size of process pid (default: this process) in bytes,
+    0 if it has exited. this is the RSS on kernels without smaps_rollup."""
+    if not _has_rollup:
+        return rss(pid)
+
+    try:
+        with open(f"/proc/{pid or 'self'}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+
+    return 0
+
+
+def _hwm() -> int:
+    # peak RSS of this process since the last reset
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+_can_reset = True
+
+
+def _reset_hwm() -> None:
+    global _can_reset
+
+    if not _can_reset:
+        return
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError as e:
+        # without a reset, VmHWM is the peak of the process lifetime
+        print(f"cannot reset peak RSS, reporting RSS after requests: {e}")
+        _can_reset = False
+
+
+@contextlib.contextmanager
+def measure() -> typing.Iterator[typing.Dict[str, int]]:
+    """measures the memory of the context, the returned dict is filled in
+    when the context exits"""
+    report: typing.Dict[str, int] = {}
+
+    if TRACEMALLOC:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+    _reset_hwm()
+    before = rss()
+
+    try:
+        yield report
+    finally:
+        after = rss()
+
+        report["rss_before"] = before
+        report["rss_after"] = after
+        report["peak_rss"] = max(_hwm(), after) if _can_reset else after
+        if TRACEMALLOC:
+            report["peak_traced"] = tracemalloc.get_traced_memory()[1]
+
+
+class budget:
+    """admits requests while the expected memory fits into limit bytes"""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+
+        self.lock = threading.Lock()
+        self.growth: typing.Deque[int] = collections.deque(maxlen=_HISTORY)
+        self.rejected = 0
+
+    def observe(self, report: typing.Dict[str, int]) -> None:
+        """remembers how much memory a request needed on top of what was
+        resident before"""
+        with self.lock:
+            self.growth.append(max(0, report["peak_rss"] - report["rss_before"]))
+
+    def expected(self, pids: typing.List[int]) -> int:
+        """returns the memory of the processes pids and the next request"""
+        with self.lock:
+            growth = max(self.growth, default=0)
+
+        return sum(pss(pid) for pid in pids) + growth
+
+    def admit(self, pids: typing.Callable[[], typing.List[int]]) -> bool:
+        """returns whether a request fits into the budget, waiting for memory
+        to become free if the policy is to queue"""
+        if self.limit <= 0:
+            return True
+
+        deadline = time.monotonic() + (WAIT if POLICY == "queue" else 0)
+
+        while True:
+            expected = self.expected(pids())
+            if expected <= self.limit:
+                return True
+
+            if time.monotonic() >= deadline:
+                with self.lock:
+                    self.rejected += 1
+
+                print(
+                    f"memory budget exceeded: expected {expected} of {self.limit} "
+                    f"bytes, rejecting request"
+                )
+                return False
+
+            time.sleep(0.05)
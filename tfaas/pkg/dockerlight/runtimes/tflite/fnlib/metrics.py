@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import typing
+
+# Metrics in the Prometheus text format for the /metrics endpoint of a
+# function. fnlib records what happens inside a worker (band cache lookups,
+# model invocations, encoded bytes) into a pending registry. The worker pool
+# takes the pending metrics with every result and merges them into the
+# registry of the handler, which works the same for thread and forked
+# process workers, as the handler is the only one that ever renders them.
+#
+# This module only uses the standard library. The python3 and ml runtimes
+# ship it as fnlib/metrics.py as well, so all runtimes render the same
+# metrics the same way.
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# paths that requests are labeled with, every other path is "other", so
+# clients cannot make up new label values
+ROUTES = ["/", "/fn", "/batch", "/inline", "/health", "/status", "/metrics"]
+
+HELP = {
+    "tfaas_requests_total": "requests handled, by path and outcome",
+    "tfaas_request_duration_seconds": "time from reading a request to the response",
+    "tfaas_invoke_duration_seconds": "time of a single model invocation",
+    "tfaas_bytes_written_total": "bytes of encoded function results",
+    "tfaas_band_cache_hits_total": "band lookups answered from the band cache",
+    "tfaas_band_cache_misses_total": "band lookups that had to decode or resize",
+    "tfaas_cascade_screened_total": "scenes the cascade passed or rejected",
+    "tfaas_cascade_stage_duration_seconds": "time of a stage of the cascade",
+    "tfaas_cascade_full_model_images_total": "images the cascade ran the model on",
+    "tfaas_startup_seconds": "time from process start until fn was warm",
+    "tfaas_queue_depth": "requests waiting for a worker",
+    "tfaas_pending": "requests queued or running",
+    "tfaas_memory_rejections_total": "requests rejected for the memory budget",
+    "tfaas_process_resident_memory_bytes": "resident memory of a process",
+    "tfaas_process_cpu_seconds_total": "user and system CPU time of a process",
+}
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+Key = typing.Tuple[str, Labels]
+
+
+def _key(name: str, labels: typing.Dict[str, str]) -> Key:
+    return name, tuple(sorted(labels.items()))
+
+
+class registry:
+    """counters and histograms, safe to use from multiple threads"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters: typing.Dict[Key, float] = {}
+        # per histogram: the count of every bucket and +Inf, and the sum
+        self.histograms: typing.Dict[Key, typing.Tuple[typing.List[int], float]] = {}
+
+    def inc(self, name: str, v: float = 1.0, **labels: str) -> None:
+        k = _key(name, labels)
+        with self.lock:
+            self.counters[k] = self.counters.get(k, 0.0) + v
+
+    def observe(self, name: str, v: float, **labels: str) -> None:
+        k = _key(name, labels)
+        with self.lock:
+            counts, total = self.histograms.get(k, ([0] * (len(BUCKETS) + 1), 0.0))
+
+            # counts are not cumulative until we render them
+            b = 0
+            while b < len(BUCKETS) and v > BUCKETS[b]:
+                b += 1
+            counts[b] += 1
+
+            self.histograms[k] = counts, total + v
+
+    def take(
+        self,
+    ) -> typing.Tuple[
+        typing.Dict[Key, float], typing.Dict[Key, typing.Tuple[typing.List[int], float]]
+    ]:
+        """returns everything recorded since the last take and resets"""
+        with self.lock:
+            taken = self.counters, self.histograms
+            self.counters = {}
+            self.histograms = {}
+
+        return taken
+
+    def merge(
+        self,
+        taken: typing.Tuple[
+            typing.Dict[Key, float],
+            typing.Dict[Key, typing.Tuple[typing.List[int], float]],
+        ],
+    ) -> None:
+        counters, histograms = taken
+
+        with self.lock:
+            for k, v in counters.items():
+                self.counters[k] = self.counters.get(k, 0.0) + v
+
+            for k, (counts, total) in histograms.items():
+                mine, my_total = self.histograms.get(k, ([0] * (len(BUCKETS) + 1), 0.0))
+                self.histograms[k] = (
+                    [a + b for a, b in zip(mine, counts)],
+                    my_total + total,
+                )
+
+    def render(self, gauges: typing.Optional[typing.List[str]] = None) -> str:
+        """renders all metrics in the Prometheus text format, followed by
+        already rendered gauges"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: (list(c), t) for k, (c, t) in self.histograms.items()}
+
+        lines: typing.List[str] = []
+        described: typing.Set[str] = set()
+
+        def describe(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                lines.extend(_describe(name, kind))
+
+        for (name, labels), v in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {_value(v)}")
+
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            describe(name, "histogram")
+
+            cumulative = 0
+            for le, c in zip([f"{b:g}" for b in BUCKETS] + ["+Inf"], counts):
+                cumulative += c
+                lines.append(
+                    f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}"
+                )
+
+            lines.append(f"{name}_sum{_labels(labels)} {_value(total)}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        return "\n".join(lines + (gauges or [])) + "\n"
+
+
+def _describe(name: str, kind: str) -> typing.List[str]:
+    return [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} {kind}"]
+
+
+def _value(v: float) -> str:
+    return str(int(v)) if v == int(v) else repr(v)
+
+
+def _escape(v: str) -> str:
+    # the text format only escapes these three in label values
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+def route(path: str) -> str:
+    """returns the label of a request path: the path without its query if
+    it is one of ROUTES, "other" otherwise"""
+    path = path.split("?", 1)[0]
+    return path if path in ROUTES else "other"
+
+
+def gauge(name: str, v: float, kind: str = "gauge") -> typing.List[str]:
+    """renders a single value without labels, for registry.render"""
+    return _describe(name, kind) + [f"{name} {_value(v)}"]
+
+
+# what fnlib records in this process until the worker pool takes it
+pending = registry()
+
+
+def inc(name: str, v: float = 1.0, **labels: str) -> None:
+    pending.inc(name, v, **labels)
+
+
+def observe(name: str, v: float, **labels: str) -> None:
+    pending.observe(name, v, **labels)
+
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK")
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def processes(pids: typing.Dict[int, str]) -> typing.List[str]:
+    """renders RSS and CPU time gauges of the processes in pids (pid to
+    role), processes that have exited are left out"""
+    rss = _describe("tfaas_process_resident_memory_bytes", "gauge")
+    cpu = _describe("tfaas_process_cpu_seconds_total", "counter")
+
+    for pid, role in sorted(pids.items()):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                pages = int(f.read().split()[1])
+
+            # the command may contain spaces, the fields after it do not
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+
+        # utime and stime are fields 14 and 15, we split after field 2
+        ticks = int(fields[11]) + int(fields[12])
+        labels = _labels((("pid", str(pid)), ("role", role)))
+
+        rss.append(f"tfaas_process_resident_memory_bytes{labels} {pages * _PAGE_SIZE}")
+        cpu.append(
+            f"tfaas_process_cpu_seconds_total{labels} {_value(ticks / _CLK_TCK)}"
+        )
+
+    return rss + cpu
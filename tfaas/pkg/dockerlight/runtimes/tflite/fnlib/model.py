@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import threading
+import traceback
+import typing
+
+import numpy as np
+
+import fnlib.bands
+import fnlib.inference
+
+# What every function with a TFLite model has in common:
+#
+#   model  an interpreter for the model that runs lists of uint8 images in
+#          one invocation, resized to the number of images, with a warmup on
+#          zeros. Functions subclass it with their own predictions, and
+#          override set_inputs for models with more than one input.
+#   local  one model per thread, made on first use. Its init is what the
+#          runtime calls in every worker before it reports healthy.
+#   batch  what fn_batch does: load the input of every request, run the
+#          model once for all of them, and save every result. A request
+#          whose input or result fails only fails itself, a failed inference
+#          fails the entire batch.
+
+# the result of predict for an input that failed on its own
+Result = typing.Union[typing.Any, Exception]
+
+
+class model:
+    def __init__(self, path: str) -> None:
+        self.interpreter = fnlib.inference.interpreter(path)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self.batch_size = 1
+
+    def resize(self, n: int) -> None:
+        """resizes the interpreter inputs to a batch of n images"""
+        if n == self.batch_size:
+            return
+
+        for d in self.input_details:
+            self.interpreter.resize_tensor_input(d["index"], [n, *d["shape"][1:]])
+        self.interpreter.allocate_tensors()
+        self.batch_size = n
+
+    def warmup(self) -> None:
+        """runs an inference on zeros, so the first request does not pay for
+        allocating and initializing the model"""
+        for d in self.interpreter.get_input_details():
+            self.interpreter.set_tensor(
+                d["index"], np.zeros(d["shape"], dtype=d["dtype"])
+            )
+        self.interpreter.invoke()
+
+    def set_inputs(self, imgs: typing.List[typing.Any]) -> None:
+        """writes a list of uint8 images into the input of the model"""
+        fnlib.inference.set_input(self.interpreter, self.input_details[0], imgs)
+
+    def run(self, imgs: typing.List[typing.Any]) -> None:
+        """runs the model on a list of uint8 images"""
+        self.resize(len(imgs))
+        self.set_inputs(imgs)
+        fnlib.inference.invoke(self.interpreter, self.batch_size)
+
+    def infer(self, imgs: typing.List[typing.Any]) -> np.ndarray:
+        """runs the model on a list of uint8 images and returns its raw
+        output"""
+        self.run(imgs)
+        return fnlib.inference.get_output(self.interpreter, self.output_details[0])
+
+
+M = typing.TypeVar("M", bound=model)
+
+
+class local(typing.Generic[M]):
+    def __init__(self, factory: typing.Callable[[], M]) -> None:
+        self.factory = factory
+        self.thread_local = threading.local()
+
+    def get(self) -> M:
+        """returns the model of this thread"""
+        if not hasattr(self.thread_local, "model"):
+            self.thread_local.model = self.factory()
+
+        return self.thread_local.model
+
+    def init(self) -> None:
+        """loads and warms up the model of this thread"""
+        self.get().warmup()
+
+
+def batch(
+    requests: typing.List[typing.Dict[str, typing.Any]],
+    load: typing.Callable[
+        [fnlib.bands.scene, typing.Dict[str, typing.Any]], typing.Optional[typing.Any]
+    ],
+    predict: typing.Callable[[typing.List[typing.Any]], typing.Sequence[Result]],
+    save: typing.Callable[[typing.Any, fnlib.bands.scene, typing.BinaryIO], None],
+) -> typing.List[typing.Optional[Exception]]:
+    """runs a batch of requests and returns the error of every request, if
+    any. load returns the model input of a request, or None to skip it,
+    predict returns a result for every input, and save writes a result."""
+    errors: typing.List[typing.Optional[Exception]] = [None] * len(requests)
+    scenes = [fnlib.bands.scene(r["in_path"]) for r in requests]
+
+    imgs = []
+    loaded = []
+    for n, r in enumerate(requests):
+        try:
+            img = load(scenes[n], r)
+        except Exception as e:
+            print(f"failed to load image: {e}")
+            traceback.print_exc()
+            errors[n] = e
+            continue
+
+        if img is not None:
+            imgs.append(img)
+            loaded.append(n)
+
+    if len(imgs) == 0:
+        return errors
+
+    # a failed inference fails the entire batch
+    results = predict(imgs)
+
+    for n, result in zip(loaded, results):
+        if isinstance(result, Exception):
+            errors[n] = result
+            continue
+
+        try:
+            save(result, scenes[n], requests[n]["out_writer"])
+        except Exception as e:
+            print(f"failed to save result: {e}")
+            traceback.print_exc()
+            errors[n] = e
+
+    return errors
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import typing
+
+import fnlib.geofence
+import fnlib.manifest
+
+# Declarative prefilters on the metadata of a request, evaluated by the
+# runtime before a function touches any image data. A function declares its
+# predicates in the "prefilter" section of its manifest:
+#
+#   sunlit      true to skip acquisitions that are not sunlit
+#   max_clouds  skip acquisitions with more cloud cover than this
+#   min_alt     skip acquisitions taken below this altitude
+#   max_alt     skip acquisitions taken above this altitude
+#   regions     list of polygons of [lon, lat] points, skip acquisitions
+#               outside all of them
+#   geojson     list of GeoJSON files, relative to the function directory,
+#               with more such polygons
+#
+# Regions are compiled into one fnlib.geofence when the prefilter is loaded.
+#
+# check returns a reason code for the first predicate that fails, or None if
+# the request should run. It raises ValueError for requests that are not an
+# object with numeric FIELDS, which the runtime answers with 400.
+
+NOT_SUNLIT = "not_sunlit"
+CLOUDS = "clouds"
+ALTITUDE = "altitude"
+OUTSIDE_REGIONS = "outside_regions"
+
+# metadata of an acquisition that every request carries
+FIELDS = ["lat", "lon", "alt", "clouds", "sunlit"]
+
+
+def validate(i: typing.Any, fields: typing.List[str] = FIELDS) -> None:
+    """raises ValueError if the request i is not an object with all fields,
+    or if its metadata is not numeric"""
+    if not isinstance(i, dict):
+        raise ValueError("request is not a JSON object")
+
+    missing = [f for f in fields if f not in i]
+    if len(missing) > 0:
+        raise ValueError(f"request is missing {', '.join(missing)}")
+
+    for f in ["lat", "lon", "alt", "clouds"]:
+        if f in fields and (
+            not isinstance(i[f], (int, float)) or isinstance(i[f], bool)
+        ):
+            raise ValueError(f"request field {f} is not a number")
+
+
+class prefilter:
+    def __init__(self, config: typing.Dict[str, typing.Any]) -> None:
+        self.sunlit = bool(config.get("sunlit", False))
+        self.max_clouds: typing.Optional[float] = config.get("max_clouds")
+        self.min_alt: typing.Optional[float] = config.get("min_alt")
+        self.max_alt: typing.Optional[float] = config.get("max_alt")
+
+        regions: typing.List[fnlib.geofence.Polygon] = []
+        for r in config.get("regions", []):
+            if len(r) < 3:
+                raise ValueError(f"invalid prefilter region with {len(r)} points")
+
+            regions.append([[(float(p[0]), float(p[1])) for p in r]])
+
+        for path in config.get("geojson", []):
+            regions.extend(fnlib.geofence.read(path))
+
+        self.regions: typing.Optional[fnlib.geofence.geofence] = None
+        if len(regions) > 0:
+            self.regions = fnlib.geofence.geofence(regions)
+
+    def check(self, i: typing.Dict[str, typing.Any]) -> typing.Optional[str]:
+        """returns why the request i should be skipped, or None"""
+        validate(i)
+
+        if self.sunlit and not i["sunlit"]:
+            return NOT_SUNLIT
+
+        if self.max_clouds is not None and i["clouds"] > self.max_clouds:
+            return CLOUDS
+
+        if self.min_alt is not None and i["alt"] < self.min_alt:
+            return ALTITUDE
+
+        if self.max_alt is not None and i["alt"] > self.max_alt:
+            return ALTITUDE
+
+        if self.regions is not None and not self.regions.contains(i["lon"], i["lat"]):
+            return OUTSIDE_REGIONS
+
+        return None
+
+
+def load() -> prefilter:
+    """returns the prefilter declared in the manifest of this function"""
+    return prefilter(fnlib.manifest.get("prefilter"))
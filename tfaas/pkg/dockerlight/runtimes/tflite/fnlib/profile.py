@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import itertools
+import os
+import sys
+import threading
+import time
+import typing
+
+# Opt-in profiling of single requests. With TFAAS_PROFILE set to "cprofile"
+# or "sample", every TFAAS_PROFILE_EVERY-th request is profiled, and a
+# request can ask for a profile with an X-TFaas-Profile header of the same
+# values. Profiles go to TFAAS_PROFILE_DIR:
+#
+#   cprofile  deterministic profile of the worker thread as .pstats, for
+#             python3 -m pstats or snakeviz
+#   sample    the stack of the worker thread every TFAAS_PROFILE_INTERVAL
+#             seconds, as .collapsed stacks for flamegraph.pl or speedscope
+#
+# Requests that are not profiled only pay for one comparison.
+
+MODES = ["cprofile", "sample"]
+
+MODE = os.environ.get("TFAAS_PROFILE", "")
+EVERY = int(os.environ.get("TFAAS_PROFILE_EVERY", "1"))
+DIR = os.environ.get("TFAAS_PROFILE_DIR", "/tmp/tfaas-profile")
+INTERVAL = float(os.environ.get("TFAAS_PROFILE_INTERVAL", "0.005"))
+
+if MODE not in MODES + [""]:
+    raise ValueError(f"Invalid profile mode: {MODE}")
+
+if EVERY < 1:
+    raise ValueError(f"Invalid profile interval: every {EVERY} requests")
+
+_requests = itertools.count(1)
+
+
+def choose(header: typing.Optional[str]) -> typing.Optional[str]:
+    """returns how to profile the next request, if at all, given the value of
+    its X-TFaas-Profile header"""
+    if header in MODES:
+        return header
+
+    if header:
+        print(f"ignoring invalid profile mode {header}")
+
+    if MODE == "":
+        return None
+
+    return MODE if next(_requests) % EVERY == 0 else None
+
+
+def _path(name: str, ext: str) -> str:
+    os.makedirs(DIR, exist_ok=True)
+    return os.path.join(DIR, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}.{ext}")
+
+
+@contextlib.contextmanager
+def _cprofile(name: str) -> typing.Iterator[None]:
+    import cProfile
+
+    p = cProfile.Profile()
+
+    try:
+        p.enable()
+    except ValueError as e:
+        # another thread is profiling already (Python 3.12 and later)
+        print(f"not profiling {name}: {e}")
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        p.disable()
+
+        path = _path(name, "pstats")
+        p.dump_stats(path)
+        print(f"profile of {name} written to {path}")
+
+
+def _stack(frame: typing.Any) -> str:
+    # root first, like the collapsed stacks of flamegraph.pl
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+@contextlib.contextmanager
+def _sample(name: str) -> typing.Iterator[None]:
+    target = threading.get_ident()
+    stacks: typing.Counter[str] = collections.Counter()
+    done = threading.Event()
+
+    def sample() -> None:
+        while not done.wait(INTERVAL):
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                stacks[_stack(frame)] += 1
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    try:
+        yield
+    finally:
+        done.set()
+        sampler.join()
+
+        path = _path(name, "collapsed")
+        with open(path, "w") as f:
+            for stack, n in stacks.most_common():
+                f.write(f"{stack} {n}\n")
+        print(f"{sum(stacks.values())} samples of {name} written to {path}")
+
+
+def run(mode: typing.Optional[str], name: str) -> typing.ContextManager[None]:
+    """profiles the context in mode, if any, and writes the profile to a file
+    named after name"""
+    if mode == "cprofile":
+        return _cprofile(name)
+
+    if mode == "sample":
+        return _sample(name)
+
+    return contextlib.nullcontext()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import os
+import subprocess
+import sys
+import typing
+
+# Startup time of a function. seconds() is the time since this process was
+# started by the kernel, which includes starting the interpreter and every
+# import before any of our code runs. The handler reports it once all
+# workers are warm, so a restart after a reset can be compared with the
+# startup time of earlier runs.
+#
+# To see which imports a function spends its startup time on, run
+#
+#   python3 -m fnlib.startup [module] [top]
+#
+# in the function directory. It imports module (default: fn) in a fresh
+# interpreter with -X importtime and lists the top imports by their own and
+# by their cumulative import time.
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK")
+
+
+def seconds() -> float:
+    """seconds since this process was started"""
+    with open("/proc/uptime") as f:
+        uptime = float(f.read().split()[0])
+
+    # the command may contain spaces, the fields after it do not
+    with open("/proc/self/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+
+    # starttime is field 22, we split after field 2
+    return uptime - int(fields[19]) / _CLK_TCK
+
+
+def importtime(module: str = "fn") -> typing.List[typing.Tuple[str, int, int]]:
+    """imports module in a new interpreter and returns (name, self,
+    cumulative) import times of every module in microseconds"""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    imports = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        own, cumulative, name = line[len("import time:") :].split("|")
+        imports.append((name.strip(), int(own), int(cumulative)))
+
+    return imports
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "fn"
+    top = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+    sys.path.insert(0, os.getcwd())
+    imports = importtime(module)
+
+    total = next(c for n, _, c in reversed(imports) if n == module)
+    print(f"import {module}: {total / 1000:.1f}ms, {len(imports)} modules")
+
+    print(f"\ntop {top} by own time:")
+    for name, own, _ in sorted(imports, key=lambda i: -i[1])[:top]:
+        print(f"{own / 1000:9.1f}ms  {name}")
+
+    print(f"\ntop {top} by cumulative time:")
+    for name, _, cumulative in sorted(imports, key=lambda i: -i[2])[:top]:
+        print(f"{cumulative / 1000:9.1f}ms  {name}")
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import collections
+import glob
+import os
+import sys
+import threading
+import time
+import typing
+
+import numpy as np
+from PIL import Image
+
+# A store of decoded acquisitions shared between functions. The first
+# function that needs an acquisition decodes all of its bands once into a
+# (bands, height, width) uint8 .npy file in the store directory; everyone
+# else memory-maps that file and gets read-only views of single bands without
+# decoding any TIFF or copying any data.
+#
+# The store is disabled unless TFAAS_STORE_DIR is set. To share decoded
+# acquisitions between tenants, mount the same tmpfs directory (e.g., in
+# /dev/shm) into every function container and point TFAAS_STORE_DIR at it.
+
+STORE_DIR = os.environ.get("TFAAS_STORE_DIR", "")
+# acquisitions older than this are removed from the store
+STORE_TTL = float(os.environ.get("TFAAS_STORE_TTL", "600"))
+
+BANDS = [
+    "B01",
+    "B02",
+    "B03",
+    "B04",
+    "B05",
+    "B06",
+    "B07",
+    "B08",
+    "B8A",
+    "B09",
+    "B11",
+    "B12",
+    "CLD",
+]
+BAND_INDEX = {b: i for i, b in enumerate(BANDS)}
+
+# number of memory-mapped acquisitions we keep open in this process
+_ATTACHED_MAX = 4
+
+_lock = threading.Lock()
+_attached: "collections.OrderedDict[str, np.ndarray]" = collections.OrderedDict()
+# acquisitions we could not publish, so we do not retry for every band
+_failed: "collections.OrderedDict[str, None]" = collections.OrderedDict()
+
+
+def enabled() -> bool:
+    return STORE_DIR != ""
+
+
+def _path(name: str) -> str:
+    return os.path.join(STORE_DIR, f"{name}.npy")
+
+
+def name(in_path: str) -> str:
+    """the store name of the acquisition in in_path"""
+    return os.path.basename(os.path.normpath(in_path))
+
+
+def attach(name: str) -> typing.Optional[np.ndarray]:
+    """returns a read-only (bands, height, width) view of a stored acquisition,
+    or None if it has not been published"""
+    with _lock:
+        img = _attached.get(name)
+        if img is not None:
+            _attached.move_to_end(name)
+            return img
+
+    try:
+        img = np.load(_path(name), mmap_mode="r")
+    except FileNotFoundError:
+        return None
+
+    with _lock:
+        _attached[name] = img
+        while len(_attached) > _ATTACHED_MAX:
+            _attached.popitem(last=False)
+
+    return img
+
+
+def publish(in_path: str) -> np.ndarray:
+    """decodes all bands of the acquisition in in_path into the store and
+    returns a read-only view of it"""
+    os.makedirs(STORE_DIR, exist_ok=True)
+    _collect()
+
+    n = name(in_path)
+    first = np.array(Image.open(os.path.join(in_path, f"{BANDS[0]}.tiff")))
+
+    # write to a private file first and rename, so readers never see a
+    # partially written acquisition
+    tmp_file = os.path.join(STORE_DIR, f".{n}-{os.getpid()}-{threading.get_ident()}")
+
+    try:
+        img = np.lib.format.open_memmap(
+            tmp_file, mode="w+", dtype=np.uint8, shape=(len(BANDS), *first.shape)
+        )
+        img[0] = first
+
+        for i, b in enumerate(BANDS[1:], start=1):
+            img[i] = np.array(Image.open(os.path.join(in_path, f"{b}.tiff")))
+
+        img.flush()
+        del img
+
+        os.rename(tmp_file, _path(n))
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    img = attach(n)
+    if img is None:
+        raise FileNotFoundError(f"acquisition {n} vanished from the store")
+
+    return img
+
+
+def get(in_path: str) -> np.ndarray:
+    """returns the stored acquisition in in_path, publishing it if necessary"""
+    n = name(in_path)
+
+    img = attach(n)
+    if img is not None:
+        return img
+
+    with _lock:
+        if n in _failed:
+            raise ValueError(f"acquisition {n} could not be published")
+
+    try:
+        return publish(in_path)
+    except Exception:
+        with _lock:
+            _failed[n] = None
+            while len(_failed) > _ATTACHED_MAX:
+                _failed.popitem(last=False)
+        raise
+
+
+def band(in_path: str, b: str) -> np.ndarray:
+    """returns a read-only view of band b of the acquisition in in_path"""
+    return get(in_path)[BAND_INDEX[b]]
+
+
+def _collect() -> None:
+    # remove acquisitions (and abandoned temporary files) that have expired
+    deadline = time.time() - STORE_TTL
+
+    for f in glob.glob(os.path.join(STORE_DIR, "*.npy")) + glob.glob(
+        os.path.join(STORE_DIR, ".*")
+    ):
+        try:
+            if os.stat(f).st_mtime < deadline:
+                os.remove(f)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == "__main__":
+    # publish acquisitions ahead of the functions that need them:
+    # TFAAS_STORE_DIR=/dev/shm/tfaas-store python3 -m fnlib.store <in_path>...
+    if not enabled():
+        raise ValueError("TFAAS_STORE_DIR is not set")
+
+    for p in sys.argv[1:]:
+        t = time.perf_counter()
+        img = publish(p)
+        print(f"published {name(p)} {img.shape} in {time.perf_counter() - t:.3f}s")
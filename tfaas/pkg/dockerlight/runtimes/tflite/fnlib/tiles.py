@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import math
+import os
+import typing
+
+import numpy as np
+
+import fnlib.manifest
+import fnlib.mask
+
+# Tiled inference for segmentation models. Instead of resizing a scene to the
+# input size of the model, run splits it into tiles of that size at native
+# resolution, which overlap by some pixels, and runs them through the model a
+# few at a time. Scores of overlapping tiles are blended with weights that
+# fall off linearly towards the edges of a tile, so tile borders do not show
+# in the mask.
+#
+# Every invocation takes the same number of tiles, so the interpreter is not
+# resized and its delegates are not applied again for the last few tiles of
+# a row: rows are split into batches of equal size, at most batch tiles
+# each, and the last batch is padded with copies of its last tile, whose
+# scores are dropped.
+#
+# Scenes are processed one row of tiles at a time. Rows of the scene that no
+# later tile covers are turned into the uint8 mask right away, so the only
+# float32 scores we keep are one row of tiles across the width of the scene
+# and one batch of model outputs, no matter how large the scene is.
+#
+# Settings come from the "tiles" section of the function manifest and can be
+# overridden with an environment variable:
+#
+#   mode     TFAAS_TILE_MODE     "auto" (default) tiles scenes that are
+#                                larger than the model input, "tile" tiles
+#                                every scene that is at least as large,
+#                                "resize" never tiles
+#   overlap  TFAAS_TILE_OVERLAP  pixels that neighboring tiles overlap by
+#                                (default 64)
+#   batch    TFAAS_TILE_BATCH    most tiles per invocation (default 4)
+
+MODES = ["auto", "tile", "resize"]
+
+
+def _setting(key: str, env: str, default: typing.Any) -> typing.Any:
+    if env in os.environ:
+        return os.environ[env]
+
+    return fnlib.manifest.get("tiles").get(key, default)
+
+
+MODE = str(_setting("mode", "TFAAS_TILE_MODE", "auto"))
+OVERLAP = int(_setting("overlap", "TFAAS_TILE_OVERLAP", 64))
+BATCH = int(_setting("batch", "TFAAS_TILE_BATCH", 4))
+
+if MODE not in MODES:
+    raise ValueError(f"Invalid tile mode: {MODE}")
+
+if OVERLAP < 0:
+    raise ValueError(f"Invalid tile overlap: {OVERLAP}")
+
+if BATCH < 1:
+    raise ValueError(f"Invalid tile batch: {BATCH}")
+
+
+def enabled(shape: typing.Tuple[int, ...], size: typing.Tuple[int, int]) -> bool:
+    """returns whether to tile a scene of shape (height, width, ...) for a
+    model that takes size (width, height)"""
+    height, width = shape[:2]
+    w, h = size
+
+    if MODE == "resize" or height < h or width < w:
+        return False
+
+    if MODE == "tile":
+        return True
+
+    return height > h or width > w
+
+
+def starts(length: int, tile: int, overlap: int) -> typing.List[int]:
+    """returns where tiles of length tile start along an axis of length, so
+    that neighbors overlap by at least overlap pixels and the last tile ends
+    at the end of the axis"""
+    if tile >= length:
+        return [0]
+
+    step = max(tile - overlap, 1)
+    s = list(range(0, length - tile, step))
+    s.append(length - tile)
+
+    return s
+
+
+def ramp(tile: int, overlap: int) -> np.ndarray:
+    """returns the blending weight of every pixel along an axis of a tile: 1
+    in the middle, falling off linearly over overlap pixels at both ends"""
+    i = np.arange(tile, dtype=np.float32)
+    edge = np.minimum(i + 1, tile - i) / np.float32(overlap + 1)
+
+    return np.minimum(edge, np.float32(1.0))
+
+
+def run(
+    img: np.ndarray,
+    size: typing.Tuple[int, int],
+    classes: int,
+    infer: typing.Callable[[typing.List[np.ndarray]], np.ndarray],
+    overlap: int = -1,
+    batch: int = 0,
+    out: typing.Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """segments an (height, width, bands) image with tiles of size (width,
+    height) and returns the (height, width) uint8 mask of the class with the
+    highest blended score, into out if given. infer takes a list of tiles
+    and returns their (tiles, height, width, classes) scores."""
+    overlap = OVERLAP if overlap < 0 else overlap
+    batch = batch or BATCH
+
+    height, width = img.shape[:2]
+    w, h = size
+
+    if height < h or width < w:
+        raise ValueError(f"cannot tile {width}x{height} with tiles of {w}x{h}")
+
+    if overlap >= min(w, h):
+        raise ValueError(f"tiles of {w}x{h} cannot overlap by {overlap}")
+
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+
+    ys = starts(height, h, overlap)
+    xs = starts(width, w, overlap)
+
+    # the fewest batches per row, and the fewest tiles per batch for those
+    batch = math.ceil(len(xs) / math.ceil(len(xs) / batch))
+
+    weight = (
+        ramp(h, overlap)[:, np.newaxis, np.newaxis]
+        * ramp(w, overlap)[np.newaxis, :, np.newaxis]
+    )
+    weighted = np.empty((h, w, classes), dtype=np.float32)
+
+    # weighted scores of the rows from y0 on, which later rows of tiles may
+    # still add to. dividing by the sum of weights would not change which
+    # class is highest, so we never do.
+    scores = np.zeros((h, width, classes), dtype=np.float32)
+
+    for r, y0 in enumerate(ys):
+        for b in range(0, len(xs), batch):
+            row = xs[b : b + batch]
+            padded = row + row[-1:] * (batch - len(row))
+            tiles = infer([img[y0 : y0 + h, x0 : x0 + w] for x0 in padded])
+
+            for t, x0 in zip(tiles, row):
+                np.multiply(t, weight, out=weighted)
+                scores[:, x0 : x0 + w] += weighted
+
+        # rows above the next row of tiles are done
+        y1 = ys[r + 1] if r + 1 < len(ys) else height
+        done = y1 - y0
+
+        fnlib.mask.argmax(scores[:done], out[y0:y1])
+
+        # move the rows the next row of tiles overlaps to the top
+        keep = h - done
+        scores[:keep] = scores[done:]
+        scores[keep:] = 0
+
+    return out
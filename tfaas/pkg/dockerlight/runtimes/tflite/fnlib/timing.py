@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import contextlib
+import threading
+import time
+import typing
+
+# Per-request phase timings. The runtime starts a recording in the thread that
+# executes a request, fnlib records the phases it runs on behalf of the
+# function (decode, preprocess, invoke, encode, write), and the runtime adds
+# its own (parse, queue, rename) before it logs them and returns them in a
+# Server-Timing header. Phases that are not recorded cost next to nothing.
+
+PHASES = [
+    "parse",
+    "queue",
+    "decode",
+    "preprocess",
+    "invoke",
+    "postprocess",
+    "encode",
+    "write",
+    "rename",
+]
+
+_local = threading.local()
+
+
+def start() -> None:
+    """starts recording phases in this thread"""
+    _local.timings = {}
+
+
+def stop() -> typing.Dict[str, float]:
+    """stops recording in this thread and returns the phases in seconds"""
+    timings = getattr(_local, "timings", None)
+    _local.timings = None
+    return timings or {}
+
+
+def add(name: str, seconds: float) -> None:
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        return
+
+    timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def phase(name: str) -> typing.Iterator[None]:
+    """records the time spent in the context as phase name"""
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - t)
+
+
+def server_timing(timings: typing.Dict[str, float]) -> str:
+    """formats timings as a Server-Timing header value in milliseconds"""
+    return ", ".join(f"{k};dur={v * 1000:.2f}" for k, v in timings.items())
+
+
+def ms(timings: typing.Dict[str, float]) -> typing.Dict[str, float]:
+    return {k: round(v * 1000, 3) for k, v in timings.items()}
@@ -1,22 +1,66 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import contextlib
 import http.server
+import io
 import json
 import logging
+import multiprocessing
+import queue
 import typing
 import os
 import sys
 import random
+import socket
 import string
+import threading
+import time
 import traceback
 import socketserver
 
+# number of persistent workers executing fn.fn
+WORKERS = int(os.environ.get("TFAAS_WORKERS", "1"))
+# "thread" or "process" (forked) workers
+WORKER_MODE = os.environ.get("TFAAS_WORKER_MODE", "thread")
+# number of requests that may wait for a worker before we reject with 503
+QUEUE_SIZE = int(os.environ.get("TFAAS_QUEUE_SIZE", "4"))
+# maximum number of acquisitions in a single /batch request
+MAX_BATCH = int(os.environ.get("TFAAS_MAX_BATCH", "16"))
+# seconds between checks whether forked workers and the handler are alive
+SUPERVISE_INTERVAL = 1.0
+# seconds before we restart a worker that died soon after the last restart,
+# doubled for every further such death, up to RESTART_MAX_DELAY
+RESTART_DELAY = 1.0
+RESTART_MAX_DELAY = 60.0
+# seconds a worker must live for its death to not count as such
+RESTART_STABLE = 60.0
+# size of the chunks we stream /inline results in
+CHUNK_SIZE = 64 * 1024
+# reasons we reject a request with 503
+QUEUE_FULL = "queue full"
+MEMORY_BUDGET = "memory budget exceeded"
+
 if __name__ == "__main__":
+    # fn and the numpy, tflite_runtime and fnlib modules it imports are loaded
+    # up front on purpose, not on the first request: forked workers share
+    # them copy-on-write, and workers warm up before we report healthy, so
+    # deferring them would only move their cost onto the first request.
     try:
         import fn  # type: ignore
     except ImportError:
         raise ImportError("Failed to import fn.py")
 
+    import fnlib.bands
+    import fnlib.frame
+    import fnlib.inference
+    import fnlib.memory
+    import fnlib.metrics
+    import fnlib.prefilter
+    import fnlib.profile
+    import fnlib.startup
+    import fnlib.timing
+
     # first argument: function name
     try:
         function_name = sys.argv[1]
@@ -26,26 +70,628 @@ if __name__ == "__main__":
     if function_name == "":
         raise ValueError("Empty function name")
 
+    if WORKERS < 1:
+        raise ValueError(f"Invalid number of workers: {WORKERS}")
+
+    def tmp_path(i: typing.Dict[str, typing.Any]) -> str:
+        return os.path.join(
+            i["out_path"],
+            "".join(random.choices(string.ascii_letters, k=7)) + ".tmp",
+        )
+
+    def result_path(i: typing.Dict[str, typing.Any]) -> str:
+        return os.path.join(
+            i["out_path"],
+            f"{function_name}-{os.path.basename(i['in_path'])}",
+        )
+
+    def fn_args(
+        i: typing.Dict[str, typing.Any], out_writer: typing.BinaryIO
+    ) -> typing.Dict[str, typing.Any]:
+        return {
+            "lat": i["lat"],
+            "lon": i["lon"],
+            "alt": i["alt"],
+            "clouds": i["clouds"],
+            "sunlit": i["sunlit"],
+            "in_path": i["in_path"],
+            "out_writer": out_writer,
+        }
+
+    prefilter = fnlib.prefilter.load()
+    # fields of a request to /fn and of every item of a /batch
+    request_fields = fnlib.prefilter.FIELDS + ["in_path", "out_path"]
+
+    def skip(i: typing.Dict[str, typing.Any], reason: str) -> None:
+        # an empty result tells the caller that we are done with this input
+        logging.info(f"skipping {i['in_path']}: {reason}")
+        tmp_file = tmp_path(i)
+        open(tmp_file, "xb").close()
+        os.rename(tmp_file, result_path(i))
+
+    def execute(i: typing.Dict[str, typing.Any]) -> None:
+        tmp_file = tmp_path(i)
+
+        with open(tmp_file, "xb") as f:
+            fn.fn(**fn_args(i, f))
+
+        with fnlib.timing.phase("rename"):
+            os.rename(tmp_file, result_path(i))
+
+    def execute_batch(
+        items: typing.List[typing.Dict[str, typing.Any]],
+    ) -> typing.List[typing.Dict[str, typing.Any]]:
+        tmp_files = [tmp_path(i) for i in items]
+
+        try:
+            with contextlib.ExitStack() as stack:
+                requests = [
+                    fn_args(i, stack.enter_context(open(t, "xb")))
+                    for i, t in zip(items, tmp_files)
+                ]
+
+                # functions can opt into processing the entire batch at once
+                if hasattr(fn, "fn_batch"):
+                    errors = fn.fn_batch(requests)
+                else:
+                    errors = []
+                    for r in requests:
+                        try:
+                            fn.fn(**r)
+                            errors.append(None)
+                        except Exception as e:
+                            logging.error(traceback.format_exc())
+                            errors.append(e)
+
+            results = []
+            for i, t, err in zip(items, tmp_files, errors):
+                if err is None:
+                    with fnlib.timing.phase("rename"):
+                        os.rename(t, result_path(i))
+                    results.append({"in_path": i["in_path"], "status": "ok"})
+                    continue
+
+                logging.error(f"Failed to execute fn for {i['in_path']}: {err}")
+                results.append(
+                    {"in_path": i["in_path"], "status": "error", "error": str(err)}
+                )
+
+            return results
+        finally:
+            for t in tmp_files:
+                if os.path.exists(t):
+                    os.remove(t)
+
+    def execute_inline(
+        arg: typing.Tuple[typing.Dict[str, typing.Any], typing.Dict[str, typing.Any]],
+    ) -> bytes:
+        # the acquisition came with the request, and the result goes back
+        # with the response instead of to the output directory
+        i, bands = arg
+        out = io.BytesIO()
+
+        with fnlib.bands.inline(bands) as in_path:
+            fn.fn(**fn_args({**i, "in_path": in_path}, out))
+
+        return out.getvalue()
+
+    # a fixed set of workers that execute fn.fn for requests from a bounded
+    # queue. every worker is long-lived, so the model that fn keeps in its
+    # thread_local stays warm across requests.
+    #
+    # in process mode, the workers are forked from this process after it has
+    # imported fn and built the interpreters of its models (prefork), and
+    # share those pages, including the weights XNNPACK packs, copy-on-write.
+    # every worker gets its own pipe and a thread here that hands it jobs one
+    # at a time, so a worker that dies only takes the job it was running with
+    # it, and the thread forks a replacement. a worker that keeps dying soon
+    # after it was forked, e.g., because its model fails to load, is
+    # restarted with exponential backoff, and the pool is not ready while it
+    # is down.
+    class tfaasWorkerPool:
+        def __init__(self, workers: int, mode: str, queue_size: int) -> None:
+            self.workers = workers
+            self.mode = mode
+            self.queue_size = queue_size
+
+            self.lock = threading.Lock()
+            self.pending = 0
+            self.next_id = 0
+            self.ready: typing.Set[int] = set()
+            # seconds from process start until every worker was warm
+            self.startup: typing.Optional[float] = None
+            self.futures: typing.Dict[int, concurrent.futures.Future] = {}
+            self.jobs: queue.Queue = queue.Queue()
+            # pids of forked workers, for their metrics
+            self.pids: typing.Dict[int, int] = {}
+            self.procs: typing.Dict[int, typing.Any] = {}
+            self.forked: typing.Dict[int, float] = {}
+            # only one fork at a time, so no worker inherits the pipe of another
+            self.fork_lock = threading.Lock()
+            self.parent = os.getpid()
+            # the socket of the http server, which restarted workers inherit
+            self.listener: typing.Optional[socket.socket] = None
+            self.targets: typing.Dict[
+                str, typing.Callable[[typing.Any], typing.Any]
+            ] = {
+                "fn": execute,
+                "batch": execute_batch,
+                "inline": execute_inline,
+            }
+
+            if mode == "thread":
+                for w in range(workers):
+                    threading.Thread(target=self.work, args=(w,), daemon=True).start()
+
+            elif mode == "process":
+                # build the interpreters once, so that every worker uses
+                # the same copy-on-write pages
+                fnlib.inference.preload()
+
+                self.ctx = multiprocessing.get_context("fork")
+
+                # fork before we start any threads in this process
+                conns = [self.fork(w) for w in range(workers)]
+
+                for w, conn in enumerate(conns):
+                    threading.Thread(
+                        target=self.supervise, args=(w, conn), daemon=True
+                    ).start()
+
+            else:
+                raise ValueError(f"Invalid worker mode: {mode}")
+
+            logging.info(f"started {workers} {mode} workers (queue size {queue_size})")
+
+        def fork(self, w: int) -> typing.Any:
+            with self.fork_lock:
+                conn, child = self.ctx.Pipe()
+                self.forked[w] = time.monotonic()
+
+                p = self.ctx.Process(
+                    target=self.work_process, args=(w, child, conn), daemon=True
+                )
+                p.start()
+                child.close()
+
+                self.procs[w] = p
+                self.pids[w] = typing.cast(int, p.pid)
+
+            return conn
+
+        def supervise(self, w: int, conn: typing.Any) -> None:
+            # deaths of this worker in a row that came soon after its fork
+            failures = 0
+
+            while True:
+                try:
+                    self.dispatch(w, conn)
+                except (EOFError, OSError):
+                    pass
+
+                # the worker died, e.g., because the OOM killer picked it
+                p = self.procs[w]
+                p.join()
+
+                with self.lock:
+                    self.ready.discard(w)
+
+                conn.close()
+
+                if time.monotonic() - self.forked[w] < RESTART_STABLE:
+                    failures += 1
+                else:
+                    failures = 0
+
+                # restart a worker that was killed once right away
+                delay = 0.0
+                if failures > 1:
+                    delay = min(RESTART_DELAY * 2 ** (failures - 2), RESTART_MAX_DELAY)
+
+                logging.error(
+                    f"worker {w} (pid {p.pid}) died with exit code {p.exitcode}, "
+                    f"restarting in {delay:.0f}s"
+                )
+                time.sleep(delay)
+
+                # forking from a process with threads is safe here, as the new
+                # worker only touches its own state and its pipe
+                conn = self.fork(w)
+
+        def dispatch(self, w: int, conn: typing.Any) -> None:
+            # wait until the worker has warmed up
+            conn.recv()
+            self.started(w)
+
+            while True:
+                try:
+                    job = self.jobs.get(timeout=SUPERVISE_INTERVAL)
+                except queue.Empty:
+                    if not self.procs[w].is_alive():
+                        return
+                    continue
+
+                # a worker that died while idle must not lose the job
+                if not self.procs[w].is_alive():
+                    self.jobs.put(job)
+                    return
+
+                try:
+                    conn.send(job)
+                    job_id, result, err = conn.recv()
+                except (EOFError, OSError):
+                    self.fail(job[0], "worker died")
+                    raise
+
+                self.finish(job_id, result, err)
+
+        def work_process(self, w: int, conn: typing.Any, parent: typing.Any) -> None:
+            # the other end of the pipe and the server socket belong to the
+            # handler
+            parent.close()
+            if self.listener is not None:
+                self.listener.close()
+
+            self.warm_up(w)
+            conn.send(w)
+
+            while True:
+                if not conn.poll(SUPERVISE_INTERVAL):
+                    # do not outlive the handler
+                    if os.getppid() != self.parent:
+                        return
+                    continue
+
+                job_id, target, arg, profile = conn.recv()
+                result, err = self.run(w, job_id, target, arg, profile)
+                conn.send((job_id, result, err))
+
+        def work(self, w: int) -> None:
+            self.warm_up(w)
+            self.started(w)
+
+            while True:
+                job_id, target, arg, profile = self.jobs.get()
+                result, err = self.run(w, job_id, target, arg, profile)
+                self.finish(job_id, result, err)
+
+        def warm_up(self, w: int) -> None:
+            # warm up the model of this worker before it takes any requests.
+            # if that fails, fn still loads its model on the first request.
+            if hasattr(fn, "init"):
+                try:
+                    fn.init()
+                except Exception as e:
+                    logging.error(f"worker {w} failed to initialize fn: {e}")
+                    logging.error(traceback.format_exc())
+
+        def run(
+            self,
+            w: int,
+            job_id: int,
+            target: str,
+            arg: typing.Any,
+            profile: typing.Optional[str],
+        ) -> typing.Tuple[typing.Any, typing.Optional[str]]:
+            result: typing.Any = None
+            err: typing.Optional[str] = None
+
+            with fnlib.memory.measure() as memory:
+                fnlib.timing.start()
+                t = time.perf_counter()
+                try:
+                    with fnlib.profile.run(
+                        profile, f"{function_name}-{target}-{job_id}"
+                    ):
+                        result = self.targets[target](arg)
+                except Exception as e:
+                    logging.error(f"worker {w} failed to execute fn: {e}")
+                    logging.error(traceback.format_exc())
+                    err = str(e)
+                run = time.perf_counter() - t
+
+            # whatever fnlib did not record is the function's own work
+            timings = fnlib.timing.stop()
+            timings["postprocess"] = max(0.0, run - sum(timings.values()))
+            timings["run"] = run
+
+            return (result, timings, fnlib.metrics.pending.take(), memory), err
+
+        def started(self, w: int) -> None:
+            with self.lock:
+                self.ready.add(w)
+
+                healthy = len(self.ready) >= self.workers and self.startup is None
+                if healthy:
+                    self.startup = round(fnlib.startup.seconds(), 3)
+
+            if healthy:
+                print(f"healthy {self.startup:.3f}s after process start")
+
+            if w in self.forked:
+                t = time.monotonic() - self.forked[w]
+                logging.info(f"worker {w} ready {t:.3f}s after fork")
+            else:
+                logging.info(f"worker {w} ready")
+
+        def finish(
+            self, job_id: int, result: typing.Any, err: typing.Optional[str]
+        ) -> None:
+            with self.lock:
+                future = self.futures.pop(job_id, None)
+                if future is None:
+                    # the job failed with its worker already
+                    return
+                self.pending -= 1
+
+            # what fnlib recorded while the worker ran the job
+            result, timings, recorded, memory = result
+            metrics.merge(recorded)
+            budget.observe(memory)
+
+            if err is None:
+                future.set_result((result, timings, memory))
+            else:
+                future.set_exception(Exception(err))
+
+        def fail(self, job_id: int, err: str) -> None:
+            with self.lock:
+                future = self.futures.pop(job_id, None)
+                if future is None:
+                    return
+                self.pending -= 1
+
+            future.set_exception(Exception(err))
+
+        def submit(
+            self, target: str, arg: typing.Any, profile: typing.Optional[str] = None
+        ) -> typing.Union[concurrent.futures.Future, str]:
+            """queue a request, returns its future, or the reason it was
+            rejected if the queue is full or the request does not fit into the
+            memory budget"""
+            if not budget.admit(self.all_pids):
+                return MEMORY_BUDGET
+
+            with self.lock:
+                if self.pending >= self.workers + self.queue_size:
+                    return QUEUE_FULL
+
+                self.pending += 1
+                job_id = self.next_id
+                self.next_id += 1
+
+                future: concurrent.futures.Future = concurrent.futures.Future()
+                self.futures[job_id] = future
+
+            self.jobs.put((job_id, target, arg, profile))
+            return future
+
+        def all_pids(self) -> typing.List[int]:
+            """the handler and the worker processes"""
+            return [os.getpid()] + list(self.pids.values())
+
+        def status(self) -> typing.Dict[str, typing.Any]:
+            with self.lock:
+                pending = self.pending
+                ready = len(self.ready)
+
+            return {
+                "mode": self.mode,
+                "workers": self.workers,
+                "ready": ready >= self.workers,
+                "queue_size": self.queue_size,
+                "pending": pending,
+                "queue_depth": max(0, pending - self.workers),
+                "busy": pending >= self.workers,
+                "startup_seconds": self.startup,
+            }
+
+    metrics = fnlib.metrics.registry()
+    budget = fnlib.memory.budget(fnlib.memory.BUDGET)
+    pool = tfaasWorkerPool(WORKERS, WORKER_MODE, QUEUE_SIZE)
+
+    def render_metrics() -> str:
+        s = pool.status()
+        gauges = (
+            fnlib.metrics.gauge("tfaas_queue_depth", s["queue_depth"])
+            + fnlib.metrics.gauge("tfaas_pending", s["pending"])
+            + fnlib.metrics.gauge("tfaas_startup_seconds", s["startup_seconds"] or 0)
+            + fnlib.metrics.gauge(
+                "tfaas_memory_rejections_total", budget.rejected, "counter"
+            )
+        )
+
+        pids = {os.getpid(): "handler"}
+        pids.update({pid: "worker" for pid in pool.pids.values()})
+
+        return metrics.render(gauges + fnlib.metrics.processes(pids))
+
     # create a webserver at port 8080 and execute fn.fn for every request
     class tfaasFNHandler(http.server.BaseHTTPRequestHandler):
+        # phase timings of the current request in seconds
+        timings: typing.Dict[str, float] = {}
+        started = 0.0
+        in_path: typing.Optional[str] = None
+        skipped = False
+        # memory report of the current request in bytes
+        memory: typing.Dict[str, int] = {}
+
+        def send_pool_headers(self) -> None:
+            # lets the rproxy see how loaded this handler is
+            s = pool.status()
+            self.send_header("X-TFaas-Queue-Depth", str(s["queue_depth"]))
+            self.send_header("X-TFaas-Busy", "1" if s["busy"] else "0")
+            if len(self.timings) > 0:
+                self.send_header(
+                    "Server-Timing", fnlib.timing.server_timing(self.phases())
+                )
+            if "peak_rss" in self.memory:
+                self.send_header("X-TFaas-Memory-Peak", str(self.memory["peak_rss"]))
+            self.end_headers()
+
+        def send_busy(self, reason: str, what: str) -> None:
+            logging.warning(f"{reason}, rejecting {what}")
+            self.send_response(503)
+            self.send_header("Retry-After", "1")
+            self.send_header("X-TFaas-Busy-Reason", reason)
+            self.send_pool_headers()
+            self.wfile.write(f"Busy: {reason}".encode("utf-8"))
+
+        def profile(self) -> typing.Optional[str]:
+            return fnlib.profile.choose(self.headers.get("X-TFaas-Profile"))
+
+        def phases(self) -> typing.Dict[str, float]:
+            timings = {
+                k: self.timings[k] for k in fnlib.timing.PHASES if k in self.timings
+            }
+            timings["total"] = time.perf_counter() - self.started
+            return timings
+
+        def wait(
+            self, future: concurrent.futures.Future, submitted: float
+        ) -> typing.Any:
+            result, timings, self.memory = future.result()
+
+            # the time between submitting the job and a worker taking it
+            run = timings.pop("run")
+            timings["queue"] = max(0.0, time.perf_counter() - submitted - run)
+
+            self.timings.update(timings)
+            return result
+
+        def log_request(self, code: typing.Any = "-", size: typing.Any = "-") -> None:
+            super().log_request(code, size)
+
+            if self.command != "POST":
+                return
+
+            if self.skipped:
+                outcome = "skipped"
+            else:
+                outcome = "ok" if int(code) < 400 else "error"
+
+            phases = self.phases()
+            path = fnlib.metrics.route(self.path)
+            metrics.inc("tfaas_requests_total", path=path, outcome=outcome)
+            metrics.observe(
+                "tfaas_request_duration_seconds", phases["total"], path=path
+            )
+
+            # one JSON line per request, so time (and energy) can be
+            # attributed to phases without scraping the log
+            print(
+                json.dumps(
+                    {
+                        "ts": time.time(),
+                        "fn": function_name,
+                        "path": self.path,
+                        "status": int(code),
+                        "in_path": self.in_path,
+                        "timings_ms": fnlib.timing.ms(phases),
+                        "memory": self.memory,
+                    }
+                )
+            )
+
         def do_GET(self) -> None:
             print(f"GET {self.path}")
             if self.path == "/health":
+                # not healthy until every worker has warmed up its model
+                if not pool.status()["ready"]:
+                    logging.info("reporting health: warming up")
+                    self.send_response(503)
+                    self.send_pool_headers()
+                    self.wfile.write("Warming up".encode("utf-8"))
+                    return
+
                 logging.info("reporting health: OK")
                 self.send_response(200)
-                self.end_headers()
+                self.send_pool_headers()
                 self.wfile.write("OK".encode("utf-8"))
                 return
 
+            if self.path == "/status":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_pool_headers()
+                self.wfile.write(json.dumps(pool.status()).encode("utf-8"))
+                return
+
+            if self.path == "/metrics":
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_pool_headers()
+                self.wfile.write(render_metrics().encode("utf-8"))
+                return
+
             logging.error(f"Invalid path for GET: {self.path}")
             self.send_response(404)
             self.end_headers()
             return
 
+        def chunked(self) -> bool:
+            return "chunked" in self.headers.get("Transfer-Encoding", "").lower()
+
+        def read_body(self) -> bytes:
+            if not self.chunked():
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            # chunked transfer encoding: hex size line, data, CRLF, until an
+            # empty chunk
+            body = bytearray()
+            while True:
+                line = self.rfile.readline()
+                try:
+                    size = int(line.split(b";")[0].strip(), 16)
+                except ValueError:
+                    raise ValueError(f"invalid chunk size line {line!r}")
+
+                if size < 0:
+                    raise ValueError(f"invalid chunk size {size}")
+
+                if size == 0:
+                    break
+
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+            # skip trailers
+            while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+
+            return bytes(body)
+
+        def write_chunked(self, data: bytes) -> None:
+            for c in range(0, len(data), CHUNK_SIZE):
+                chunk = data[c : c + CHUNK_SIZE]
+                self.wfile.write(f"{len(chunk):x}\r\n".encode("utf-8"))
+                self.wfile.write(chunk)
+                self.wfile.write(b"\r\n")
+
+            self.wfile.write(b"0\r\n\r\n")
+
         def do_POST(self) -> None:
-            d: typing.Optional[str] = self.rfile.read(
-                int(self.headers["Content-Length"])
-            ).decode("utf-8")
+            self.started = time.perf_counter()
+            self.timings = {}
+            self.in_path = None
+            self.skipped = False
+            self.memory = {}
+
+            if self.path == "/inline":
+                self.do_inline()
+                return
+
+            try:
+                d: typing.Optional[str] = self.read_body().decode("utf-8")
+            except ValueError as e:
+                logging.error(f"Failed to read body: {e}")
+                # we do not know where the body ends, so the connection is
+                # of no use anymore
+                self.close_connection = True
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
             if d == "":
                 logging.error("Empty body")
                 self.send_response(400)
@@ -63,43 +709,227 @@ if __name__ == "__main__":
                 self.wfile.write(str(e).encode("utf-8"))
                 return
 
+            self.timings["parse"] = time.perf_counter() - self.started
+            if isinstance(i, dict):
+                self.in_path = i.get("in_path")
+
+            if self.path == "/batch":
+                self.do_batch(i)
+                return
+
             try:
-                tmp_file = os.path.join(
-                    i["out_path"],
-                    "".join(random.choices(string.ascii_letters, k=7)) + ".tmp",
-                )
+                fnlib.prefilter.validate(i, request_fields)
+            except ValueError as e:
+                logging.error(f"Invalid request: {e}")
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
 
-                with open(tmp_file, "xb") as f:
-                    fn.fn(
-                        lat=i["lat"],
-                        lon=i["lon"],
-                        alt=i["alt"],
-                        clouds=i["clouds"],
-                        sunlit=i["sunlit"],
-                        in_path=i["in_path"],
-                        out_writer=f,
-                    )
+            # skip requests that the function does not want before we queue
+            # them or touch any image data
+            reason = prefilter.check(i)
+            if reason is not None:
+                try:
+                    skip(i, reason)
+                except Exception as e:
+                    logging.error(f"Failed to skip fn: {e}")
+                    self.send_response(500)
+                    self.send_pool_headers()
+                    self.wfile.write(str(e).encode("utf-8"))
+                    return
 
-                result_file = os.path.join(
-                    i["out_path"],
-                    f"{function_name}-{os.path.basename(i['in_path'])}",
-                )
+                self.skipped = True
+                self.send_response(200)
+                self.send_header("X-TFaas-Status", "skipped")
+                self.send_header("X-TFaas-Skip-Reason", reason)
+                self.send_pool_headers()
+                self.wfile.write(f"Skipped: {reason}".encode("utf-8"))
+                return
 
-                os.rename(tmp_file, result_file)
+            submitted = time.perf_counter()
+            future = pool.submit("fn", i, self.profile())
+
+            if isinstance(future, str):
+                self.send_busy(future, "request")
+                return
+
+            try:
+                self.wait(future, submitted)
 
                 logging.info("fn executed successfully")
                 self.send_response(200)
-                self.end_headers()
+                self.send_pool_headers()
                 self.wfile.write("OK".encode("utf-8"))
                 return
             except Exception as e:
                 logging.error(f"Failed to execute fn: {e}")
-                logging.error(traceback.format_exc())
                 self.send_response(500)
+                self.send_pool_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+        def do_inline(self) -> None:
+            # read the frame straight from the connection unless we have to
+            # undo the chunked transfer encoding first
+            if self.chunked():
+                try:
+                    body = self.read_body()
+                except ValueError as e:
+                    logging.error(f"Failed to read body: {e}")
+                    self.close_connection = True
+                    self.send_response(400)
+                    self.end_headers()
+                    self.wfile.write(str(e).encode("utf-8"))
+                    return
+
+                r = fnlib.frame.reader(io.BytesIO(body), len(body))
+            else:
+                r = fnlib.frame.reader(
+                    self.rfile, int(self.headers.get("Content-Length", 0))
+                )
+
+            try:
+                i, bands = fnlib.frame.read(r)
+                self.timings["parse"] = time.perf_counter() - self.started
+            except Exception as e:
+                logging.error(f"Failed to read frame: {e}")
+                # drain the rest of the body, so the client sees our response
+                while r.n < r.limit:
+                    d = r.f.read(min(r.limit - r.n, CHUNK_SIZE))
+                    if len(d) == 0:
+                        break
+                    r.n += len(d)
+                self.close_connection = True
+                self.send_response(400)
                 self.end_headers()
                 self.wfile.write(str(e).encode("utf-8"))
                 return
 
-    # with socketserver.ThreadingTCPServer(("", 8000), tfaasFNHandler) as httpd:
-    with socketserver.TCPServer(("", 8000), tfaasFNHandler) as httpd:
+            try:
+                reason = prefilter.check(i)
+            except ValueError as e:
+                logging.error(f"Invalid frame metadata: {e}")
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+            if reason is not None:
+                self.send_result(b"", reason)
+                return
+
+            submitted = time.perf_counter()
+            future = pool.submit("inline", (i, bands), self.profile())
+
+            if isinstance(future, str):
+                self.send_busy(future, "inline request")
+                return
+
+            try:
+                result = self.wait(future, submitted)
+            except Exception as e:
+                logging.error(f"Failed to execute fn: {e}")
+                self.send_response(500)
+                self.send_pool_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+            logging.info(f"inline fn executed, {len(result)} result bytes")
+            self.send_result(result, None)
+
+        def send_result(self, result: bytes, skipped: typing.Optional[str]) -> None:
+            # chunked responses need HTTP/1.1, we still close the connection
+            # afterwards like every other response
+            self.protocol_version = "HTTP/1.1"
+            self.close_connection = True
+            self.skipped = skipped is not None
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Connection", "close")
+            if skipped is not None:
+                self.send_header("X-TFaas-Status", "skipped")
+                self.send_header("X-TFaas-Skip-Reason", skipped)
+            else:
+                self.send_header("X-TFaas-Status", "ok")
+            self.send_pool_headers()
+            self.write_chunked(result)
+
+        def do_batch(self, items: typing.Any) -> None:
+            if not isinstance(items, list) or len(items) == 0:
+                logging.error("Batch is not a non-empty list")
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write("Batch must be a non-empty list".encode("utf-8"))
+                return
+
+            if len(items) > MAX_BATCH:
+                logging.error(f"Batch too large: {len(items)} > {MAX_BATCH}")
+                self.send_response(413)
+                self.end_headers()
+                self.wfile.write(f"Batch larger than {MAX_BATCH}".encode("utf-8"))
+                return
+
+            try:
+                for i in items:
+                    fnlib.prefilter.validate(i, request_fields)
+            except ValueError as e:
+                logging.error(f"Invalid batch item: {e}")
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+            results: typing.List[typing.Optional[typing.Dict[str, typing.Any]]] = []
+            run = []
+            try:
+                for i in items:
+                    reason = prefilter.check(i)
+                    if reason is None:
+                        results.append(None)
+                        run.append(i)
+                        continue
+
+                    skip(i, reason)
+                    results.append(
+                        {"in_path": i["in_path"], "status": "skipped", "reason": reason}
+                    )
+            except Exception as e:
+                logging.error(f"Failed to filter batch: {e}")
+                self.send_response(500)
+                self.send_pool_headers()
+                self.wfile.write(str(e).encode("utf-8"))
+                return
+
+            if len(run) > 0:
+                submitted = time.perf_counter()
+                future = pool.submit("batch", run, self.profile())
+
+                if isinstance(future, str):
+                    self.send_busy(future, "batch")
+                    return
+
+                try:
+                    executed = iter(self.wait(future, submitted))
+                except Exception as e:
+                    logging.error(f"Failed to execute batch: {e}")
+                    self.send_response(500)
+                    self.send_pool_headers()
+                    self.wfile.write(str(e).encode("utf-8"))
+                    return
+
+                results = [r if r is not None else next(executed) for r in results]
+
+            logging.info(f"batch of {len(items)} executed")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_pool_headers()
+            self.wfile.write(json.dumps(results).encode("utf-8"))
+
+    # requests only wait on the worker pool, so handling connections in
+    # threads does not run fn concurrently beyond the configured workers
+    with socketserver.ThreadingTCPServer(("", 8000), tfaasFNHandler) as httpd:
+        pool.listener = httpd.socket
         httpd.serve_forever()
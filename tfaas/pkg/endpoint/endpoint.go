@@ -51,6 +51,8 @@ func Start(r *rproxy.RProxy, listenAddr string, kill <-chan struct{}) {
 			w.WriteHeader(http.StatusNotFound)
 		case rproxy.StatusError:
 			w.WriteHeader(http.StatusInternalServerError)
+		case rproxy.StatusBusy:
+			w.WriteHeader(http.StatusServiceUnavailable)
 		}
 	})
 
@@ -21,6 +21,7 @@ const (
 	StatusAccepted
 	StatusNotFound
 	StatusError
+	StatusBusy
 )
 
 type StateServer interface {
@@ -272,6 +273,13 @@ func (r *RProxy) execute(name string, id string, payload []byte) (Status, []byte
 
 	log.Printf("end sync request %s %s", name, id)
 
+	if resp.StatusCode == http.StatusServiceUnavailable {
+		// the handler queue is full, keep the persisted request for a retry
+		log.Printf("handler %s busy (queue depth %s)", h, resp.Header.Get("X-TFaas-Queue-Depth"))
+		resp.Body.Close()
+		return StatusBusy, nil
+	}
+
 	// remove persisted request
 	if id != "" {
 		p := path.Join(f.persistDir, id)
@@ -377,6 +385,12 @@ func (r *RProxy) executor() {
 				log.Printf("function for call %s not found", call.Name)
 			case StatusError:
 				log.Printf("call %s error", call.Name)
+			case StatusBusy:
+				log.Printf("call %s busy, requeueing", call.Name)
+				time.Sleep(r.backoffPeriod)
+				r.fql.Lock()
+				r.fq.PushFront(call)
+				r.fql.Unlock()
 			}
 		}(q)
 
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import contextlib
+import importlib.util
+import io
+import os
+import os.path as path
+import sys
+import typing
+
+import numpy as np
+
+# Unit tests of fnlib, the library of the tflite runtime. They import fnlib
+# from the runtime directly, so they only need the Python packages of the
+# runtime, not tfaas or Docker.
+
+src_path = path.dirname(path.dirname(path.abspath(__file__)))
+fns_path = path.join(path.dirname(src_path), "fns")
+sys.path.insert(0, path.join(src_path, "pkg", "dockerlight", "runtimes", "tflite"))
+
+import fnlib.bands  # noqa: E402
+import fnlib.cascade  # noqa: E402
+import fnlib.encode  # noqa: E402
+import fnlib.geofence  # noqa: E402
+import fnlib.mask  # noqa: E402
+import fnlib.memory  # noqa: E402
+import fnlib.metrics  # noqa: E402
+import fnlib.model  # noqa: E402
+import fnlib.prefilter  # noqa: E402
+import fnlib.tiles  # noqa: E402
+
+
+class TestCascade(unittest.TestCase):
+    def setUp(self) -> None:
+        fnlib.metrics.pending.take()
+
+        # inline acquisitions live until the test ends
+        self.inline = contextlib.ExitStack()
+        self.addCleanup(self.inline.close)
+
+    def scene(self, a: int, b: int) -> fnlib.bands.scene:
+        bands = {
+            "B8A": np.full((64, 128), a, dtype=np.uint8),
+            "B12": np.full((64, 128), b, dtype=np.uint8),
+        }
+        return fnlib.bands.scene(self.inline.enter_context(fnlib.bands.inline(bands)))
+
+    def test_screen(self) -> None:
+        """scenes with enough candidate pixels pass, others are rejected"""
+        c = fnlib.cascade.cascade({"enabled": True, "index": "nbr"})
+
+        # a burn ratio below 0 makes a pixel a candidate
+        self.assertTrue(c.screen(self.scene(10, 100)))
+        self.assertFalse(c.screen(self.scene(100, 10)))
+
+    def test_size(self) -> None:
+        """size is [width, height], like everywhere else"""
+        c = fnlib.cascade.cascade({"enabled": True, "size": [32, 16]})
+        s = self.scene(10, 100)
+        c.screen(s)
+
+        self.assertEqual(s.band("B8A", c.size).shape, (16, 32))
+
+    def test_metrics(self) -> None:
+        """both stages record into fnlib.metrics"""
+        c = fnlib.cascade.cascade({"enabled": True, "index": "nbr"})
+        c.screen(self.scene(10, 100))
+        c.screen(self.scene(100, 10))
+        c.screen(self.scene(100, 10))
+
+        with c.stage2(2):
+            pass
+
+        counters, histograms = fnlib.metrics.pending.take()
+
+        screened = "tfaas_cascade_screened_total"
+        self.assertEqual(counters[(screened, (("outcome", "pass"),))], 1)
+        self.assertEqual(counters[(screened, (("outcome", "reject"),))], 2)
+        self.assertEqual(counters[("tfaas_cascade_full_model_images_total", ())], 2)
+
+        stage = "tfaas_cascade_stage_duration_seconds"
+        self.assertEqual(sum(histograms[(stage, (("stage", "1"),))][0]), 3)
+        self.assertEqual(sum(histograms[(stage, (("stage", "2"),))][0]), 1)
+
+    def test_disabled(self) -> None:
+        """a disabled cascade passes everything and records nothing"""
+        c = fnlib.cascade.cascade({"enabled": False})
+
+        self.assertTrue(c.screen(self.scene(100, 10)))
+        with c.stage2(2):
+            pass
+
+        self.assertEqual(fnlib.metrics.pending.take(), ({}, {}))
+
+
+class TestEncode(unittest.TestCase):
+    # formats that need a package that may not be installed
+    packages = {"zstd": "zstandard", "lz4": "lz4"}
+
+    def formats(self) -> typing.Iterator[str]:
+        for fmt in fnlib.encode.FORMATS:
+            package = self.packages.get(fmt)
+            if package is None or importlib.util.find_spec(package) is not None:
+                yield fmt
+
+    def images(self) -> typing.List[np.ndarray]:
+        rng = np.random.default_rng(0)
+        return [
+            rng.integers(0, 256, (32, 48, 4), dtype=np.uint8),
+            rng.integers(0, 256, (32, 48, 3), dtype=np.uint8),
+            # a class mask, which packed stores in 3 bits
+            rng.integers(0, 6, (31, 17), dtype=np.uint8),
+            np.zeros((8, 8, 1), dtype=np.uint8),
+        ]
+
+    def round_trip(
+        self, img: np.ndarray, fmt: str, meta: typing.Optional[fnlib.encode.Meta]
+    ) -> typing.Tuple[np.ndarray, fnlib.encode.Meta]:
+        out = io.BytesIO()
+        fnlib.encode.save(out, img, fmt, meta)
+
+        data = out.getvalue()
+        return (
+            fnlib.encode.load(io.BytesIO(data), fmt),
+            fnlib.encode.load_meta(io.BytesIO(data), fmt),
+        )
+
+    def test_round_trip(self) -> None:
+        """every format decodes to the image it encoded"""
+        for fmt in self.formats():
+            for img in self.images():
+                with self.subTest(fmt=fmt, shape=img.shape):
+                    decoded, meta = self.round_trip(img, fmt, None)
+
+                    self.assertEqual(decoded.shape, img.shape)
+                    self.assertEqual(decoded.dtype, img.dtype)
+                    self.assertTrue(np.array_equal(decoded, img))
+                    self.assertEqual(meta, {})
+
+    def test_meta(self) -> None:
+        """metadata comes back with the image"""
+        meta = {"labels": "Water,Road", "proportions": '{"0": 12}'}
+
+        for fmt in self.formats():
+            img = self.images()[0]
+            with self.subTest(fmt=fmt):
+                decoded, decoded_meta = self.round_trip(img, fmt, meta)
+
+                self.assertTrue(np.array_equal(decoded, img))
+                self.assertEqual(decoded_meta, meta)
+
+    def test_not_uint8(self) -> None:
+        """image formats only take uint8 results"""
+        img = np.zeros((8, 8), dtype=np.float32)
+
+        for fmt in ["png", "tiff", "packed"]:
+            with self.subTest(fmt=fmt), self.assertRaises(ValueError):
+                fnlib.encode.save(io.BytesIO(), img, fmt)
+
+
+class TestGeofence(unittest.TestCase):
+    def polygon(
+        self, rng: np.random.Generator, lon: float, lat: float
+    ) -> fnlib.geofence.Polygon:
+        # a star-shaped ring around (lon, lat) with a square hole in it
+        a = np.sort(rng.uniform(0, 2 * np.pi, int(rng.integers(5, 30))))
+        r = rng.uniform(1.0, 3.0, len(a))
+        ring = list(zip((lon + r * np.cos(a)).tolist(), (lat + r * np.sin(a)).tolist()))
+        hole = [(lon - 0.5, lat - 0.5), (lon + 0.5, lat - 0.5), (lon, lat + 0.5)]
+
+        return [ring, hole]
+
+    def test_random(self) -> None:
+        """lookups agree with ray casting against every polygon"""
+        rng = np.random.default_rng(0)
+        polygons = [
+            self.polygon(rng, lon, lat)
+            for lon, lat in rng.uniform(-20, 20, (8, 2)).tolist()
+        ]
+        g = fnlib.geofence.geofence(polygons, 0.5)
+
+        points = rng.uniform(-25, 25, (2000, 2)).tolist()
+        for lon, lat in points:
+            self.assertEqual(
+                g.contains(lon, lat),
+                any(fnlib.geofence.in_polygon(lon, lat, p) for p in polygons),
+                (lon, lat),
+            )
+
+    def test_vertices(self) -> None:
+        """the vertices of every ring are in the geofence"""
+        rng = np.random.default_rng(1)
+        polygons = [self.polygon(rng, 0, 0), self.polygon(rng, 10, 5)]
+        g = fnlib.geofence.geofence(polygons, 0.5)
+
+        for lon, lat in [v for p in polygons for r in p for v in r]:
+            self.assertTrue(g.contains(lon, lat), (lon, lat))
+            self.assertTrue(
+                any(fnlib.geofence.in_polygon(lon, lat, p) for p in polygons)
+            )
+
+    def test_china(self) -> None:
+        """the region of segment accepts what its bounding box did"""
+        g = fnlib.geofence.load([path.join(fns_path, "segment", "china.geojson")])
+
+        # the bounding box check that china.geojson replaced
+        min_lon, max_lon, min_lat, max_lat = 72.59, 136.05, 17.14, 54.97
+
+        lons = [min_lon - 0.01, min_lon, 100.0, max_lon, max_lon + 0.01]
+        lats = [min_lat - 0.01, min_lat, 30.0, max_lat, max_lat + 0.01]
+        for lon in lons:
+            for lat in lats:
+                self.assertEqual(
+                    g.contains(lon, lat),
+                    min_lon <= lon <= max_lon and min_lat <= lat <= max_lat,
+                    (lon, lat),
+                )
+
+
+class TestMask(unittest.TestCase):
+    def test_argmax_ties(self) -> None:
+        """ties go to the lower index as with np.argmax, across chunks"""
+        # few distinct scores, so most pixels have ties, and more pixels than
+        # one chunk
+        scores = np.random.default_rng(0).integers(0, 3, (300, 300, 6))
+        scores = scores.astype(np.float32)
+        self.assertGreater(300 * 300, fnlib.mask._CHUNK)
+
+        expected = np.argmax(scores, axis=-1)
+
+        mask = fnlib.mask.argmax(scores)
+        self.assertEqual(mask.dtype, np.uint8)
+        self.assertTrue(np.array_equal(mask, expected))
+
+        out = np.empty((300, 300), dtype=np.uint8)
+        self.assertIs(fnlib.mask.argmax(scores, out), out)
+        self.assertTrue(np.array_equal(out, expected))
+
+    def test_argmax_not_contiguous(self) -> None:
+        """a mask that is not contiguous cannot be written in chunks"""
+        scores = np.zeros((4, 4, 3), dtype=np.float32)
+        out = np.empty((4, 8), dtype=np.uint8)[:, ::2]
+
+        with self.assertRaises(ValueError):
+            fnlib.mask.argmax(scores, out)
+
+    def test_counts(self) -> None:
+        """counts agrees with np.bincount with few and many classes"""
+        rng = np.random.default_rng(0)
+        for n in [fnlib.mask._FEW_CLASSES, fnlib.mask._FEW_CLASSES + 1]:
+            with self.subTest(classes=n):
+                mask = rng.integers(0, n - 1, (64, 64), dtype=np.uint8)
+
+                self.assertTrue(
+                    np.array_equal(
+                        fnlib.mask.counts(mask, n),
+                        np.bincount(mask.reshape(-1), minlength=n),
+                    )
+                )
+
+    def test_downsample(self) -> None:
+        """every pixel is the most frequent class of its block, ties go to
+        the class that comes first in the block"""
+        mask = np.array(
+            [
+                [1, 2, 3, 4],
+                [2, 2, 4, 3],
+            ],
+            dtype=np.uint8,
+        )
+
+        self.assertEqual(fnlib.mask.downsample(mask, (2, 1)).tolist(), [[2, 3]])
+
+    def test_downsample_not_multiple(self) -> None:
+        """a mask is only downsampled by an integer factor"""
+        mask = np.zeros((512, 500), dtype=np.uint8)
+
+        with self.assertRaises(ValueError):
+            fnlib.mask.downsample(mask, (256, 256))
+
+    def test_resize(self) -> None:
+        """masks of any size resize to the size we save"""
+        mask = np.zeros((900, 700), dtype=np.uint8)
+        mask[450:, :] = 3
+
+        small = fnlib.mask.resize(mask, (256, 256))
+        self.assertEqual(small.shape, (256, 256))
+        self.assertEqual(set(np.unique(small)), {0, 3})
+        self.assertEqual(small[0, 0], 0)
+        self.assertEqual(small[-1, -1], 3)
+
+    def test_resize_multiple(self) -> None:
+        """masks that are a multiple of the size are downsampled"""
+        mask = np.random.default_rng(0).integers(0, 6, (512, 512), dtype=np.uint8)
+
+        self.assertTrue(
+            np.array_equal(
+                fnlib.mask.resize(mask, (256, 256)),
+                fnlib.mask.downsample(mask, (256, 256)),
+            )
+        )
+
+
+class TestTiles(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self.img = rng.integers(0, 256, (100, 150, 3), dtype=np.uint8)
+        # scores of every class from the bands of its pixel alone, so the
+        # scores of a pixel are the same in every tile that covers it
+        self.weights = rng.uniform(-1, 1, (3, 5)).astype(np.float32)
+        self.batches: typing.List[int] = []
+
+    def infer(self, tiles: typing.List[np.ndarray]) -> np.ndarray:
+        self.batches.append(len(tiles))
+        return np.stack(tiles).astype(np.float32) @ self.weights
+
+    def untiled(self, img: np.ndarray) -> np.ndarray:
+        return np.argmax(self.infer([img])[0], axis=-1).astype(np.uint8)
+
+    def test_one_tile(self) -> None:
+        """a scene of one tile gets the mask of the model output"""
+        img = self.img[:64, :64]
+        mask = fnlib.tiles.run(img, (64, 64), 5, self.infer, overlap=16)
+
+        self.assertTrue(np.array_equal(mask, self.untiled(img)))
+
+    def test_seams(self) -> None:
+        """blending overlapping tiles does not change the mask at seams"""
+        mask = fnlib.tiles.run(self.img, (64, 48), 5, self.infer, overlap=16)
+
+        self.assertTrue(np.array_equal(mask, self.untiled(self.img)))
+
+    def test_batches(self) -> None:
+        """every invocation takes the same number of tiles"""
+        # 5 tiles per row take two batches of 3, the last one padded, not
+        # one of 4 and one of 1
+        img = self.img[:64, :130]
+        mask = fnlib.tiles.run(img, (32, 64), 5, self.infer, overlap=4, batch=4)
+
+        self.assertEqual(self.batches, [3, 3])
+        self.assertTrue(np.array_equal(mask, self.untiled(img)))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_route(self) -> None:
+        """request paths map to the known routes or other"""
+        self.assertEqual(fnlib.metrics.route("/fn"), "/fn")
+        self.assertEqual(fnlib.metrics.route("/batch?x=1"), "/batch")
+        self.assertEqual(fnlib.metrics.route("/made/up"), "other")
+
+    def test_escape(self) -> None:
+        """label values cannot break the exposition format"""
+        r = fnlib.metrics.registry()
+        r.inc("tfaas_requests_total", path='a"b\\c\nd', outcome="ok")
+
+        self.assertIn(
+            'tfaas_requests_total{outcome="ok",path="a\\"b\\\\c\\nd"} 1',
+            r.render().splitlines(),
+        )
+
+    def test_merge(self) -> None:
+        """metrics taken from a worker add up in the handler"""
+        worker = fnlib.metrics.registry()
+        worker.inc("tfaas_bytes_written_total", 3)
+        worker.observe("tfaas_invoke_duration_seconds", 0.02)
+
+        handler = fnlib.metrics.registry()
+        handler.inc("tfaas_bytes_written_total", 4)
+        handler.merge(worker.take())
+
+        lines = handler.render(fnlib.metrics.gauge("tfaas_pending", 2)).splitlines()
+        self.assertIn("tfaas_bytes_written_total 7", lines)
+        self.assertIn('tfaas_invoke_duration_seconds_bucket{le="0.025"} 1', lines)
+        self.assertIn('tfaas_invoke_duration_seconds_bucket{le="0.01"} 0', lines)
+        self.assertIn("# TYPE tfaas_pending gauge", lines)
+        self.assertIn("tfaas_pending 2", lines)
+
+
+class TestModelBatch(unittest.TestCase):
+    def test_errors(self) -> None:
+        """requests fail on their own, skipped requests are not predicted"""
+        requests = [
+            {"in_path": p, "out_writer": io.BytesIO()}
+            for p in ["ok", "skip", "load", "predict", "save"]
+        ]
+        predicted: typing.List[typing.List[str]] = []
+
+        def load(
+            scene: fnlib.bands.scene, r: typing.Dict[str, typing.Any]
+        ) -> typing.Optional[str]:
+            if r["in_path"] == "load":
+                raise ValueError("load")
+            return None if r["in_path"] == "skip" else r["in_path"]
+
+        def predict(imgs: typing.List[str]) -> typing.List[typing.Any]:
+            predicted.append(imgs)
+            return [ValueError("predict") if i == "predict" else i for i in imgs]
+
+        def save(result: str, scene: fnlib.bands.scene, f: typing.BinaryIO) -> None:
+            if result == "save":
+                raise ValueError("save")
+            f.write(result.encode("utf-8"))
+
+        errors = fnlib.model.batch(requests, load, predict, save)
+
+        self.assertEqual(predicted, [["ok", "predict", "save"]])
+        self.assertEqual(
+            [str(e) if e is not None else None for e in errors],
+            [None, None, "load", "predict", "save"],
+        )
+        self.assertEqual(requests[0]["out_writer"].getvalue(), b"ok")
+        self.assertEqual(requests[1]["out_writer"].getvalue(), b"")
+
+
+class TestPrefilter(unittest.TestCase):
+    def acquisition(self, **kwargs: typing.Any) -> typing.Dict[str, typing.Any]:
+        i = {"lat": 30.0, "lon": 110.0, "alt": 500.0, "clouds": 0.0, "sunlit": True}
+        i.update(kwargs)
+        return i
+
+    def test_valid(self) -> None:
+        """requests that pass every predicate run"""
+        p = fnlib.prefilter.prefilter(
+            {"sunlit": True, "max_clouds": 0.5, "min_alt": 100, "max_alt": 1000}
+        )
+        self.assertIsNone(p.check(self.acquisition()))
+
+    def test_reasons(self) -> None:
+        """the first predicate that fails is the reason"""
+        p = fnlib.prefilter.prefilter(
+            {
+                "sunlit": True,
+                "max_clouds": 0.5,
+                "max_alt": 1000,
+                "regions": [[[100, 20], [120, 20], [120, 40], [100, 40]]],
+            }
+        )
+
+        for i, reason in [
+            (self.acquisition(sunlit=False), fnlib.prefilter.NOT_SUNLIT),
+            (self.acquisition(clouds=0.9), fnlib.prefilter.CLOUDS),
+            (self.acquisition(alt=2000), fnlib.prefilter.ALTITUDE),
+            (self.acquisition(lon=90.0), fnlib.prefilter.OUTSIDE_REGIONS),
+            (self.acquisition(lon=120.0), None),
+        ]:
+            self.assertEqual(p.check(i), reason, i)
+
+    def test_malformed(self) -> None:
+        """malformed requests raise ValueError instead of any other error"""
+        p = fnlib.prefilter.prefilter({"sunlit": True, "max_clouds": 0.5})
+
+        missing = self.acquisition()
+        del missing["clouds"]
+
+        for i in [
+            [self.acquisition()],
+            "lat=30",
+            None,
+            missing,
+            self.acquisition(clouds="none"),
+            self.acquisition(lat=None),
+            self.acquisition(alt=True),
+        ]:
+            with self.assertRaises(ValueError, msg=repr(i)):
+                p.check(i)  # type: ignore
+
+    def test_fields(self) -> None:
+        """validate only needs the fields it is given"""
+        fnlib.prefilter.validate({"in_path": "/tmp/in"}, ["in_path"])
+
+        with self.assertRaises(ValueError):
+            fnlib.prefilter.validate({}, ["in_path"])
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_pss(self) -> None:
+        """the PSS of a process is at most its RSS"""
+        self.assertGreater(fnlib.memory.pss(), 0)
+        self.assertLessEqual(fnlib.memory.pss(), fnlib.memory.rss())
+
+    def test_exited(self) -> None:
+        """processes that have exited have no memory"""
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(fnlib.memory.rss(pid), 0)
+        self.assertEqual(fnlib.memory.pss(pid), 0)
+
+    def test_shared(self) -> None:
+        """pages a forked worker shares with us count once"""
+        shared = np.ones(64 * 1024 * 1024 // 8)
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(w)
+            os.read(r, 1)
+            os._exit(0)
+
+        os.close(r)
+        try:
+            pids = [os.getpid(), pid]
+            total_rss = sum(fnlib.memory.rss(p) for p in pids)
+
+            b = fnlib.memory.budget(total_rss - shared.nbytes // 2)
+
+            # counting RSS, the shared array would count twice and not fit
+            self.assertLessEqual(b.expected(pids), total_rss - shared.nbytes // 2)
+            self.assertTrue(b.admit(lambda: pids))
+        finally:
+            os.close(w)
+            os.waitpid(pid, 0)
+
+    def test_growth(self) -> None:
+        """the budget expects the largest recent growth on top"""
+        b = fnlib.memory.budget(1)
+        pids = [os.getpid()]
+        before = b.expected(pids)
+
+        b.observe({"rss_before": 0, "peak_rss": 1 << 30})
+        self.assertGreaterEqual(b.expected(pids) - before, (1 << 30) - (1 << 24))
+
+    def test_reject(self) -> None:
+        """requests that do not fit are rejected and counted"""
+        b = fnlib.memory.budget(1024)
+
+        if fnlib.memory.POLICY != "reject":
+            self.skipTest("TFAAS_MEMORY_POLICY is not reject")
+
+        self.assertFalse(b.admit(lambda: [os.getpid()]))
+        self.assertEqual(b.rejected, 1)
+
+    def test_unlimited(self) -> None:
+        """without a budget, everything is admitted"""
+        self.assertTrue(fnlib.memory.budget(0).admit(lambda: [os.getpid()]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import http.client
+import json
+import os
+import os.path as path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+import urllib.error
+import urllib.request
+
+# Tests of the python3 runtime without tfaas and Docker: the asyncio function
+# handler runs as a plain process in a temporary function directory with a
+# function that does nothing, so these only need Python.
+
+src_path = path.dirname(path.dirname(path.abspath(__file__)))
+runtimes_path = path.join(src_path, "pkg", "dockerlight", "runtimes")
+
+host = "localhost"
+http_port = 8000
+
+fn_source = """#!/usr/bin/env python3
+
+import typing
+
+
+def fn(
+    lat: float,
+    lon: float,
+    alt: float,
+    clouds: float,
+    sunlit: bool,
+    in_path: str,
+    out_writer: typing.BinaryIO,
+) -> None:
+    out_writer.write(b"done")
+"""
+
+handler: typing.Optional[subprocess.Popen] = None  # type: ignore
+fn_dir = ""
+
+
+def start() -> None:
+    """start the function handler and wait until it is healthy"""
+    global handler, fn_dir
+
+    fn_dir = tempfile.mkdtemp()
+    shutil.copy(path.join(runtimes_path, "python3", "functionhandler.py"), fn_dir)
+
+    # the parts of fnlib the python3 image ships, see its build.Dockerfile
+    os.makedirs(path.join(fn_dir, "fnlib"))
+    for m in ["__init__.py", "metrics.py", "startup.py"]:
+        shutil.copy(
+            path.join(runtimes_path, "tflite", "fnlib", m), path.join(fn_dir, "fnlib")
+        )
+
+    with open(path.join(fn_dir, "fn.py"), "w") as f:
+        f.write(fn_source)
+
+    os.makedirs(path.join(fn_dir, "out"))
+
+    with open(path.join(fn_dir, "handler.log"), "w") as log:
+        handler = subprocess.Popen(
+            [sys.executable, "functionhandler.py", "test"],
+            cwd=fn_dir,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+
+    for _ in range(300):
+        if handler.poll() is not None:
+            break
+
+        if health() == 200:
+            return
+
+        time.sleep(0.1)
+
+    stop()
+    raise Exception("function handler did not become healthy")
+
+
+def stop() -> None:
+    """stop the function handler"""
+    if handler is not None:
+        handler.kill()
+        handler.wait()
+
+    shutil.rmtree(fn_dir, ignore_errors=True)
+
+
+def health() -> int:
+    """returns the status of /health, 0 if the handler does not answer"""
+    try:
+        with urllib.request.urlopen(f"http://{host}:{http_port}/health", timeout=1):
+            return 200
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return 0
+
+
+def request(p: str, body: bytes) -> typing.Tuple[int, bytes]:
+    conn = http.client.HTTPConnection(host, http_port, timeout=10)
+    conn.request("POST", p, body=body)
+    res = conn.getresponse()
+    data = res.read()
+    conn.close()
+    return res.status, data
+
+
+def raw(data: bytes) -> bytes:
+    """sends data as is and returns everything until the handler closes the
+    connection"""
+    # http.client cannot send requests that are broken on purpose
+    with socket.create_connection((host, http_port), timeout=10) as s:
+        s.sendall(data)
+
+        res = b""
+        while True:
+            d = s.recv(4096)
+            if d == b"":
+                return res
+            res += d
+
+
+def acquisition(**kwargs: typing.Any) -> typing.Dict[str, typing.Any]:
+    i = {
+        "lat": 30.0,
+        "lon": 110.0,
+        "alt": 500.0,
+        "clouds": 0.0,
+        "sunlit": True,
+        "in_path": "/tmp/in",
+        "out_path": path.join(fn_dir, "out"),
+    }
+    i.update(kwargs)
+    return i
+
+
+class handlerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        stop()
+
+
+class TestServer(handlerTest):
+    def test_health(self) -> None:
+        """a warm handler is healthy"""
+        self.assertEqual(health(), 200)
+
+    def test_status(self) -> None:
+        """/status reports the state of the handler"""
+        with urllib.request.urlopen(f"http://{host}:{http_port}/status") as res:
+            status = json.load(res)
+
+        self.assertTrue(status["ready"])
+        self.assertEqual(status["in_flight"], 0)
+
+    def test_fn(self) -> None:
+        """a valid request runs the function"""
+        status, _ = request("/fn", json.dumps(acquisition()).encode("utf-8"))
+        self.assertEqual(status, 200)
+
+        with open(path.join(fn_dir, "out", "test-in"), "rb") as f:
+            self.assertEqual(f.read(), b"done")
+
+    def test_batch(self) -> None:
+        """every item of a batch runs the function"""
+        items = [acquisition(in_path=f"/tmp/in{n}") for n in range(2)]
+
+        status, data = request("/batch", json.dumps(items).encode("utf-8"))
+        self.assertEqual(status, 200)
+        self.assertEqual([r["status"] for r in json.loads(data)], ["ok", "ok"])
+
+    def test_keep_alive(self) -> None:
+        """one connection serves several requests"""
+        conn = http.client.HTTPConnection(host, http_port, timeout=10)
+        for _ in range(3):
+            conn.request("POST", "/fn", body=json.dumps(acquisition()))
+            res = conn.getresponse()
+            res.read()
+            self.assertEqual(res.status, 200)
+        conn.close()
+
+
+class TestMalformed(handlerTest):
+    def test_request_line(self) -> None:
+        """a malformed request line is answered with 400 and closes the
+        connection"""
+        res = raw(b"hello\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.1 400"), res)
+        self.assertIn(b"Connection: close", res)
+
+    def test_request_version(self) -> None:
+        """a request line without an HTTP version is a bad request"""
+        res = raw(b"GET /health hello\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.1 400"), res)
+
+    def test_fn_list(self) -> None:
+        """a body that is not an object is a bad request"""
+        status, _ = request("/fn", json.dumps([acquisition()]).encode("utf-8"))
+        self.assertEqual(status, 400)
+
+    def test_fn_missing(self) -> None:
+        """a body without all fields is a bad request"""
+        i = acquisition()
+        del i["out_path"]
+
+        status, data = request("/fn", json.dumps(i).encode("utf-8"))
+        self.assertEqual(status, 400)
+        self.assertIn(b"out_path", data)
+
+    def test_batch_item(self) -> None:
+        """a batch with a malformed item is a bad request"""
+        status, _ = request("/batch", json.dumps([acquisition(), 1]).encode("utf-8"))
+        self.assertEqual(status, 400)
+
+    def test_still_serving(self) -> None:
+        """malformed requests do not take the handler down"""
+        raw(b"hello\r\n\r\n")
+        request("/fn", b"[1, 2, 3]")
+
+        status, _ = request("/fn", json.dumps(acquisition()).encode("utf-8"))
+        self.assertEqual(status, 200)
+
+
+class TestChunked(handlerTest):
+    def chunked(self, body: bytes) -> bytes:
+        return raw(
+            b"POST /fn HTTP/1.1\r\n"
+            b"Host: localhost\r\n"
+            b"Connection: close\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n" + body
+        )
+
+    def test_chunked(self) -> None:
+        """a chunked body is read in full"""
+        d = json.dumps(acquisition()).encode("utf-8")
+        body = b"".join(
+            f"{len(c):x}\r\n".encode("utf-8") + c + b"\r\n" for c in [d[:10], d[10:]]
+        )
+
+        res = self.chunked(body + b"0\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.1 200"), res)
+
+    def test_chunk_size(self) -> None:
+        """a chunk size that is not hex is a bad request"""
+        res = self.chunked(b"zz\r\nhello\r\n0\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.1 400"), res)
+
+    def test_negative_chunk_size(self) -> None:
+        """a negative chunk size is a bad request"""
+        res = self.chunked(b"-5\r\nhello\r\n0\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.1 400"), res)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+import unittest
+
+import http.client
+import json
+import os
+import os.path as path
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.error
+import urllib.request
+
+# Tests of the tflite runtime without tfaas and Docker: the function handler
+# runs as a plain process in a temporary function directory with a function
+# that does nothing, so these only need the Python packages of the runtime.
+# Every test class starts its own handler, with the settings it needs.
+
+src_path = path.dirname(path.dirname(path.abspath(__file__)))
+runtime_path = path.join(src_path, "pkg", "dockerlight", "runtimes", "tflite")
+
+host = "localhost"
+http_port = 8000
+
+fn_source = """#!/usr/bin/env python3
+
+import typing
+
+
+def fn(
+    lat: float,
+    lon: float,
+    alt: float,
+    clouds: float,
+    sunlit: bool,
+    in_path: str,
+    out_writer: typing.BinaryIO,
+) -> None:
+    out_writer.write(b"done")
+"""
+
+handler: typing.Optional[subprocess.Popen] = None  # type: ignore
+fn_dir = ""
+
+
+def start(
+    env: typing.Dict[str, str] = {},
+    source: str = fn_source,
+    healthy: bool = True,
+) -> None:
+    """start the function handler with the environment variables in env,
+    and wait until it is healthy, or only until it answers"""
+    global handler, fn_dir
+
+    fn_dir = tempfile.mkdtemp()
+    shutil.copytree(path.join(runtime_path, "fnlib"), path.join(fn_dir, "fnlib"))
+    shutil.copy(path.join(runtime_path, "functionhandler.py"), fn_dir)
+
+    with open(path.join(fn_dir, "fn.py"), "w") as f:
+        f.write(source)
+
+    with open(path.join(fn_dir, "manifest.json"), "w") as f:
+        json.dump({"prefilter": {"sunlit": True}}, f)
+
+    os.makedirs(path.join(fn_dir, "out"))
+
+    # rebind the port even if connections of an earlier run linger on it
+    with open(path.join(fn_dir, "handler.log"), "w") as log:
+        handler = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import runpy, socketserver, sys\n"
+                "socketserver.TCPServer.allow_reuse_address = True\n"
+                "sys.argv = ['functionhandler.py', 'test']\n"
+                "sys.path.insert(0, '.')\n"
+                "runpy.run_path('functionhandler.py', run_name='__main__')\n",
+            ],
+            cwd=fn_dir,
+            env={**os.environ, **env},
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+
+    for _ in range(300):
+        if handler.poll() is not None:
+            break
+
+        if health() == 200 or (not healthy and health() != 0):
+            return
+
+        time.sleep(0.1)
+
+    stop()
+    raise Exception("function handler did not become healthy")
+
+
+def stop() -> None:
+    """stop the function handler"""
+    if handler is not None:
+        handler.kill()
+        handler.wait()
+
+    shutil.rmtree(fn_dir, ignore_errors=True)
+
+
+def health() -> int:
+    """returns the status of /health, 0 if the handler does not answer"""
+    try:
+        with urllib.request.urlopen(f"http://{host}:{http_port}/health", timeout=1):
+            return 200
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return 0
+
+
+def log() -> str:
+    """returns what the handler logged so far"""
+    with open(path.join(fn_dir, "handler.log"), "r") as f:
+        return f.read()
+
+
+class handlerTest(unittest.TestCase):
+    # environment variables and function of the handler of this class
+    env: typing.Dict[str, str] = {}
+    source = fn_source
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        start(cls.env, cls.source)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        stop()
+
+
+def request(
+    p: str, body: bytes, headers: typing.Dict[str, str] = {}
+) -> typing.Tuple[int, bytes]:
+    conn = http.client.HTTPConnection(host, http_port, timeout=10)
+    conn.request("POST", p, body=body, headers=headers)
+    res = conn.getresponse()
+    data = res.read()
+    conn.close()
+    return res.status, data
+
+
+def acquisition(**kwargs: typing.Any) -> typing.Dict[str, typing.Any]:
+    i = {
+        "lat": 30.0,
+        "lon": 110.0,
+        "alt": 500.0,
+        "clouds": 0.0,
+        "sunlit": True,
+        "in_path": "/tmp/in",
+        "out_path": path.join(fn_dir, "out"),
+    }
+    i.update(kwargs)
+    return i
+
+
+class TestMalformed(handlerTest):
+    def test_fn_valid(self) -> None:
+        """a valid request runs the function"""
+        status, _ = request("/fn", json.dumps(acquisition()).encode("utf-8"))
+        self.assertEqual(status, 200)
+
+        with open(path.join(fn_dir, "out", "test-in"), "rb") as f:
+            self.assertEqual(f.read(), b"done")
+
+    def test_fn_list(self) -> None:
+        """a body that is not an object is a bad request"""
+        status, _ = request("/fn", json.dumps([acquisition()]).encode("utf-8"))
+        self.assertEqual(status, 400)
+
+    def test_fn_missing(self) -> None:
+        """a body without the metadata the prefilter needs is a bad request"""
+        i = acquisition()
+        del i["sunlit"]
+
+        status, data = request("/fn", json.dumps(i).encode("utf-8"))
+        self.assertEqual(status, 400)
+        self.assertIn(b"sunlit", data)
+
+    def test_fn_not_a_number(self) -> None:
+        """metadata that is not a number is a bad request"""
+        i = acquisition(clouds="none")
+
+        status, _ = request("/fn", json.dumps(i).encode("utf-8"))
+        self.assertEqual(status, 400)
+
+    def test_batch_item(self) -> None:
+        """a batch with a malformed item is a bad request"""
+        i = acquisition()
+        del i["in_path"]
+
+        status, _ = request("/batch", json.dumps([acquisition(), i]).encode("utf-8"))
+        self.assertEqual(status, 400)
+
+    def test_still_serving(self) -> None:
+        """malformed requests do not take the handler down"""
+        request("/fn", b"[1, 2, 3]")
+
+        status, _ = request("/fn", json.dumps(acquisition()).encode("utf-8"))
+        self.assertEqual(status, 200)
+
+
+class TestChunked(handlerTest):
+    def raw(self, body: bytes) -> bytes:
+        # http.client cannot send chunks that are broken on purpose
+        with socket.create_connection((host, http_port), timeout=10) as s:
+            s.sendall(
+                b"POST /fn HTTP/1.1\r\n"
+                b"Host: localhost\r\n"
+                b"Transfer-Encoding: chunked\r\n\r\n" + body
+            )
+
+            res = b""
+            while True:
+                d = s.recv(4096)
+                if d == b"":
+                    return res
+                res += d
+
+    def test_chunked(self) -> None:
+        """a chunked body is read in full"""
+        d = json.dumps(acquisition()).encode("utf-8")
+        body = b"".join(
+            f"{len(c):x}\r\n".encode("utf-8") + c + b"\r\n" for c in [d[:10], d[10:]]
+        )
+
+        res = self.raw(body + b"0\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.0 200"), res)
+
+    def test_chunk_size(self) -> None:
+        """a chunk size that is not hex is a bad request"""
+        res = self.raw(b"zz\r\nhello\r\n0\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.0 400"), res)
+
+    def test_negative_chunk_size(self) -> None:
+        """a negative chunk size is a bad request"""
+        res = self.raw(b"-5\r\nhello\r\n0\r\n\r\n")
+        self.assertTrue(res.startswith(b"HTTP/1.0 400"), res)
+
+
+def busy(p: str, body: bytes) -> http.client.HTTPResponse:
+    """sends a request that should be rejected and returns the response"""
+    conn = http.client.HTTPConnection(host, http_port, timeout=10)
+    conn.request("POST", p, body=body)
+    res = conn.getresponse()
+    res.read()
+    conn.close()
+    return res
+
+
+class TestQueueFull(handlerTest):
+    env = {"TFAAS_WORKERS": "1", "TFAAS_QUEUE_SIZE": "1"}
+    source = fn_source + """
+    if in_path.endswith("slow"):
+        import time
+
+        time.sleep(2)
+"""
+
+    def pending(self) -> int:
+        with urllib.request.urlopen(f"http://{host}:{http_port}/status") as res:
+            return json.load(res)["pending"]
+
+    def test_queue_full(self) -> None:
+        """a request that finds the worker busy and the queue full is
+        rejected with 503"""
+        slow = json.dumps(acquisition(in_path="/tmp/slow")).encode("utf-8")
+        statuses: typing.List[int] = []
+
+        # one request runs, the other waits in the queue
+        threads = [
+            threading.Thread(target=lambda: statuses.append(request("/fn", slow)[0]))
+            for _ in range(2)
+        ]
+        for t in threads:
+            t.start()
+
+        for _ in range(100):
+            if self.pending() == 2:
+                break
+            time.sleep(0.01)
+
+        res = busy("/fn", json.dumps(acquisition()).encode("utf-8"))
+        self.assertEqual(res.status, 503)
+        self.assertEqual(res.getheader("Retry-After"), "1")
+        self.assertEqual(res.getheader("X-TFaas-Busy-Reason"), "queue full")
+
+        for t in threads:
+            t.join()
+        self.assertEqual(statuses, [200, 200])
+
+
+class TestMemoryBudget(handlerTest):
+    # less than the handler alone needs
+    env = {"TFAAS_MEMORY_BUDGET": "1M"}
+
+    def test_rejected(self) -> None:
+        """a request that does not fit into the memory budget is rejected
+        with 503, for its own reason"""
+        for p, body in [
+            ("/fn", acquisition()),
+            ("/batch", [acquisition()]),
+        ]:
+            with self.subTest(path=p):
+                res = busy(p, json.dumps(body).encode("utf-8"))
+                self.assertEqual(res.status, 503)
+                self.assertEqual(res.getheader("Retry-After"), "1")
+                self.assertEqual(
+                    res.getheader("X-TFaas-Busy-Reason"), "memory budget exceeded"
+                )
+
+        self.assertIn("memory budget exceeded, rejecting request", log())
+
+
+class TestRestart(handlerTest):
+    env = {"TFAAS_WORKER_MODE": "process", "TFAAS_WORKERS": "2"}
+
+    def workers(self) -> typing.List[int]:
+        # workers that were restarted are children of a thread of the handler
+        assert handler is not None
+        pids = []
+        for task in os.listdir(f"/proc/{handler.pid}/task"):
+            with open(f"/proc/{handler.pid}/task/{task}/children") as f:
+                pids.extend(int(pid) for pid in f.read().split())
+        return pids
+
+    def test_restart(self) -> None:
+        """a worker that is killed is replaced and the pool recovers"""
+        before = self.workers()
+        self.assertEqual(len(before), 2)
+
+        os.kill(before[0], signal.SIGKILL)
+
+        for _ in range(300):
+            after = self.workers()
+            if before[0] not in after and len(after) == 2 and health() == 200:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("the pool did not recover")
+
+        for _ in range(4):
+            status, _ = request("/fn", json.dumps(acquisition()).encode("utf-8"))
+            self.assertEqual(status, 200)
+
+
+class TestRestartBackoff(unittest.TestCase):
+    def test_backoff(self) -> None:
+        """workers that die right after every fork are restarted ever later"""
+        # os._exit cannot be caught, so the worker dies while warming up
+        start(
+            {"TFAAS_WORKER_MODE": "process"},
+            fn_source + "\n\ndef init() -> None:\n    import os\n\n    os._exit(3)\n",
+            healthy=False,
+        )
+        self.addCleanup(stop)
+
+        time.sleep(4)
+
+        # immediately, then after 1s and 2s, but not in a loop
+        deaths = log().count("died with exit code 3")
+        self.assertGreaterEqual(deaths, 2)
+        self.assertLessEqual(deaths, 4)
+        self.assertEqual(health(), 503)
+
+
+if __name__ == "__main__":
+    unittest.main()